@@ -0,0 +1,101 @@
+"""
+Benchmark of the scan preprocessing of score_essay_with_vision.
+Compares the bytes, the encoding time and the vision tokens of a scan sent as it is and preprocessed,
+and the time of a cached scan. Needs Pillow.
+
+    python benchmarks/image_benchmark.py [scan.jpg]
+
+Without a path a 12 megapixel photo of a handwritten page is generated.
+"""
+import base64
+import io
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+# upload speed of a school network, for the estimated upload time of the payload
+UPLOAD_MEGABITS_PER_SECOND = 20
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    sys.exit("The image benchmark needs Pillow: pip install pillow")
+
+from tensaku.src.cyten.cyten import encode_image
+from tensaku.src.cyten.image import encode_image_url
+from tensaku.utils.cache import InMemoryCache
+
+
+def sample_scan() -> bytes:
+    # a page on a darker desk, with lines of strokes for the handwriting and sensor noise
+    random.seed(0)
+    scan = Image.new("RGB", (3024, 4032), (92, 80, 70))
+    draw = ImageDraw.Draw(scan)
+    draw.rectangle((260, 300, 2780, 3800), fill=(236, 234, 226))
+    for line in range(30):
+        y = 500 + line * 105
+        x = 400
+        while x < 2550:
+            width = random.randint(30, 160)
+            draw.line([(x, y + random.randint(-12, 12)), (x + width, y + random.randint(-12, 12))], fill=(40, 40, 60), width=6)
+            x += width + random.randint(20, 60)
+    noise = Image.effect_noise(scan.size, 24).convert("RGB")
+    scan = Image.blend(scan, noise, 0.12)
+    output = io.BytesIO()
+    scan.save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+def vision_tokens(width: int, height: int) -> int:
+    # high detail: fit into 2048x2048, scale the short side down to 768, then 170 tokens per 512px tile and 85 on top
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+def upload_ms(payload_bytes: int) -> float:
+    return payload_bytes * 8 / (UPLOAD_MEGABITS_PER_SECOND * 1_000_000) * 1000
+
+
+def timed(function, repeat: int = 5) -> tuple[float, object]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        image_path = sys.argv[1]
+    else:
+        image_path = os.path.join(tempfile.mkdtemp(), "scan.jpg")
+        with open(image_path, "wb") as image_file:
+            image_file.write(sample_scan())
+
+    original = Image.open(image_path)
+    raw_ms, raw = timed(lambda: encode_image(image_path))
+    print(f"original: {os.path.getsize(image_path):,} bytes {original.size[0]}x{original.size[1]}")
+    print(
+        f"as it is: {len(raw):,} base64 bytes in {raw_ms:.1f} ms (+{upload_ms(len(raw)):,.0f} ms upload), "
+        f"{vision_tokens(*original.size)} vision tokens"
+    )
+
+    cache = InMemoryCache()
+    processed_ms, url = timed(lambda: encode_image_url(image_path, cache=None))
+    processed = Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1])))
+    print(
+        f"preprocessed: {len(url):,} base64 bytes in {processed_ms:.1f} ms (+{upload_ms(len(url)):,.0f} ms upload), "
+        f"{processed.size[0]}x{processed.size[1]}, {vision_tokens(*processed.size)} vision tokens"
+    )
+
+    encode_image_url(image_path, cache=cache)
+    cached_ms, _ = timed(lambda: encode_image_url(image_path, cache=cache))
+    print(f"cached: {cached_ms:.1f} ms")
+    print(f"payload {len(url) / len(raw):.1%} of the original")
@@ -0,0 +1,81 @@
+"""
+Benchmark of the offline spelling detector.
+Measures word lookups per second and the share of classifier requests that are avoided on a small sample corpus.
+
+    python benchmarks/spelling_benchmark.py
+"""
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+from tensaku.src.edit_classifier.alignment import align
+from tensaku.src.edit_classifier.classifier import Classifier
+from tensaku.src.edit_classifier.spelling import is_known_word, is_spelling_fix, load_words
+
+# (original, corrected) sentence pairs in the style of student diaries
+SAMPLE_CORPUS = [
+    ("I went to the libraly yesterday.", "I went to the library yesterday."),
+    ("I looked a moovie with my friends.", "I watched a movie with my friends."),
+    ("It was very intresting.", "It was very interesting."),
+    ("I like swiming in the sea.", "I like swimming in the sea."),
+    ("My freind gave me a present.", "My friend gave me a present."),
+    ("I goed to school by bus.", "I went to school by bus."),
+    ("I am study English every day.", "I study English every day."),
+    ("Tommorow I will meet my grandmother.", "Tomorrow I will meet my grandmother."),
+    ("I recieved a letter from my teacher.", "I received a letter from my teacher."),
+    ("The wether was beautiful.", "The weather was beautiful."),
+    ("I have many homeworks.", "I have a lot of homework."),
+    ("Fun is English.", "English is fun."),
+    ("I definately want to visit London.", "I definitely want to visit London."),
+    ("We eated sushi for dinner.", "We ate sushi for dinner."),
+    ("It was fun.", "It was fun."),
+    ("I was very tierd becuase I worked a lot.", "I was very tired because I worked a lot."),
+    ("She don't like vegetables.", "She doesn't like vegetables."),
+    ("I bought a new dictionery.", "I bought a new dictionary."),
+    ("My brother is more tall than me.", "My brother is taller than me."),
+    ("I enjoyed the festivel with my family.", "I enjoyed the festival with my family."),
+]
+
+
+def benchmark_lookups(repeat: int = 20) -> float:
+    words = [token for original, corrected in SAMPLE_CORPUS for token in (original + " " + corrected).split()]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for word in words:
+            is_known_word(word)
+    return len(words) * repeat / (time.perf_counter() - start)
+
+
+def benchmark_detection(repeat: int = 20) -> float:
+    edits = [(span.before, span.after) for original, corrected in SAMPLE_CORPUS for span in align(original, corrected)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for before, after in edits:
+            is_spelling_fix(before, after)
+    return len(edits) * repeat / (time.perf_counter() - start)
+
+
+def avoided_requests() -> tuple[int, int, int, int]:
+    classifier = Classifier(detect_spelling_locally=True)
+    changed, avoided, spelling_mistakes, edits = 0, 0, 0, 0
+    for original, corrected in SAMPLE_CORPUS:
+        mistakes, needs_gpt = classifier.classify_locally(original, corrected)
+        edits += len(align(original, corrected))
+        spelling_mistakes += len(mistakes)
+        if needs_gpt or mistakes:
+            changed += 1
+            avoided += not needs_gpt
+    return changed, avoided, spelling_mistakes, edits
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    words = load_words()
+    print(f"loaded {len(words)} words in {(time.perf_counter() - start) * 1000:.1f} ms")
+    print(f"lookups: {benchmark_lookups():,.0f} per second")
+    print(f"spelling checks: {benchmark_detection():,.0f} edits per second")
+
+    changed, avoided, spelling_mistakes, edits = avoided_requests()
+    print(f"{spelling_mistakes} of {edits} edits classified locally as spelling mistakes")
+    print(f"{avoided} of {changed} changed sentences need no classifier request ({avoided / changed:.0%})")
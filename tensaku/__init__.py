@@ -1,3 +1,9 @@
-from .tensaku_generator import TensakuGenerator
-from .src.cyten.cyten import score_essay
+from .tensaku_generator import TensakuGenerator, TensakuEvent, TensakuEventType
+from .src.explanation_generator.knowledge_base import ExplanationKnowledgeBase
+from .src.quiz_generator import QuizBank
+from .src.cyten.cyten import (
+    score_essay, ascore_essay, score_essays, ScoringMode, SampleAggregation, CompiledScoreSettings, compile_score_settings,
+)
 from .src.cyten import cyten
+from .src.cyten.batch import BulkScoringJob, LocalBatchBackend, OpenAIBatchBackend
+from .src.cyten.image import ImageSettings
@@ -3,8 +3,10 @@ import re
 from tensaku.utils.openai_utils import (
     create_completion,
     create_chat,
+    acreate_chat,
     GPTConfig,
     create_chat_and_parse,
+    acreate_chat_and_parse,
 )
 from tensaku.src.essay import Essay, split_into_sentences
 from tensaku.utils.utils import concat_examples
@@ -43,41 +45,55 @@ Output: 1-a It's heavy snow in Niigata prefecture.
 
     def generate(self, essay_text: str, token_logger: TokenLogger = None) -> tuple[Essay, Essay]:
 
-        messages = self.initial_conversation + [{
-            "role": "user", "content": essay_text
-        }]
+        messages = self._messages(essay_text)
+        sentences_1, sentences_2 = create_chat_and_parse(messages=messages, gpt_config=self.gpt_config, parsing_function=self._parsing_function, token_logger=token_logger)
+
+        return Essay(sentences_1), Essay(sentences_2)
 
-        def parsing_function(output: str) -> tuple[str, str]:
-            lines = output.strip().split('\n\n')
-            sentences_1 = []
-            sentences_2 = []
-            for line in lines:
-                line = line.split('\n')
-                sentences_1.append(line[0][4:])
-                sentences_2.append(line[1][4:])
-            return sentences_1, sentences_2
+    async def agenerate(self, essay_text: str, token_logger: TokenLogger = None) -> tuple[Essay, Essay]:
 
-        sentences_1, sentences_2 = create_chat_and_parse(messages=messages, gpt_config=self.gpt_config, parsing_function=parsing_function, token_logger=token_logger)
+        messages = self._messages(essay_text)
+        sentences_1, sentences_2 = await acreate_chat_and_parse(messages=messages, gpt_config=self.gpt_config, parsing_function=self._parsing_function, token_logger=token_logger)
 
-        essay = Essay(sentences_1)
-        corrected_essay = Essay(sentences_2)
+        return Essay(sentences_1), Essay(sentences_2)
+
+    def _messages(self, essay_text: str) -> list[dict]:
+        return self.initial_conversation + [{
+            "role": "user", "content": essay_text
+        }]
 
-        return essay, corrected_essay
+    @staticmethod
+    def _parsing_function(output: str) -> tuple[list[str], list[str]]:
+        lines = output.strip().split('\n\n')
+        sentences_1 = []
+        sentences_2 = []
+        for line in lines:
+            line = line.split('\n')
+            sentences_1.append(line[0][4:])
+            sentences_2.append(line[1][4:])
+        return sentences_1, sentences_2
 
 
 class NativeGenerator:
+    order_prompt = "Make the paragraph sound more natural. Use many words that are not in the original paragraph. Do not make it too complex, and keep the essay simple. The essay should be elementary school level."
+
     def __init__(self, print_prompt=False):
         self.print_prompt = print_prompt
 
     def generate(self, essay: Essay, token_logger: TokenLogger = None) -> Essay:
-        order_prompt = "Make the paragraph sound more natural. Use many words that are not in the original paragraph. Do not make it too complex, and keep the essay simple. The essay should be elementary school level."
+        native_paragraph = create_chat(messages=self._messages(essay), token_logger=token_logger)
+        return Essay(split_into_sentences(native_paragraph))
 
-        messages = [
-            {"role": "user", "content": f"{order_prompt}\n\n{essay.paragraph}\n\n"}
-        ]
-        native_paragraph = create_chat(messages=messages, token_logger=token_logger)
+    async def agenerate(self, essay: Essay, token_logger: TokenLogger = None) -> Essay:
+        native_paragraph = await acreate_chat(messages=self._messages(essay), token_logger=token_logger)
         return Essay(split_into_sentences(native_paragraph))
 
+    def _messages(self, essay: Essay) -> list[dict]:
+        return [
+            {"role": "user", "content": f"{self.order_prompt}\n\n{essay.paragraph}\n\n"}
+        ]
+
+
 if __name__ == "__main__":
     essay_text = "I looked a movie."
     essay, corrected_essay = CorrectionGenerator().generate(essay_text)
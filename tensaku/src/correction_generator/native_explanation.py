@@ -1,10 +1,14 @@
-from tensaku.utils.openai_utils import create_chat, GPTConfig, create_chat_and_parse, TokenLogger
+from tensaku.utils.openai_utils import create_chat, acreate_chat, GPTConfig, create_chat_and_parse, acreate_chat_and_parse, TokenLogger
+from tensaku.utils.utils import iterate_sections, aiterate_sections
 from tensaku.src.explanation_generator.generatorbase import ExplanationGenerator
 from tensaku.src.documents import NativeExplanationDocument, ExpressionDocument
 
-from typing import List
+from typing import List, Iterator, AsyncIterator
 import re
 
+# every expression starts with "# expression" on a new line
+EXPRESSION_SEPARATOR = r'\n(?=# )'
+
 class NativeExplanationGenerator(ExplanationGenerator):
 
     initial_conversation = [
@@ -51,28 +55,67 @@ let off steam または let off some steam といいます。
         if original == edited:
             return NativeExplanationDocument(explanations=[], exists=False)
 
-        messages = self.initial_conversation + [{
-            "role": "user", "content": f"Original: {original}\nEdited: {edited}"
-        }]
-
+        result = create_chat_and_parse(messages=self._messages(original, edited), gpt_config=self.gpt_config, parsing_function=self._parsing_function, token_logger=token_logger)
 
-        def parsing_function(text):
-          expressions_list = []
+        explanations = [ExpressionDocument(one_result['expression'], one_result['explanation']) for one_result in result]
 
-          # Find all expressions and their explanations using Regex
-          expression_pattern = re.compile(r'# (.+?)\n((?:- [^\n]+\n)+)((?:[^#]+)?)', re.S)
-          matches = expression_pattern.findall(text)
+        return NativeExplanationDocument(explanations=explanations)
 
-          for match in matches:
-              expression_dict = {}
-              expression_dict['expression'] = match[0]
-              expression_dict['explanation'] = match[1] + match[2]
-              expressions_list.append(expression_dict)
+    async def agenerate(self, original: str, edited: str, token_logger: TokenLogger = None) -> NativeExplanationDocument:
 
-          return expressions_list
+        if original == edited:
+            return NativeExplanationDocument(explanations=[], exists=False)
 
-        result = create_chat_and_parse(messages=messages, gpt_config=self.gpt_config, parsing_function=parsing_function, token_logger=token_logger)
+        result = await acreate_chat_and_parse(messages=self._messages(original, edited), gpt_config=self.gpt_config, parsing_function=self._parsing_function, token_logger=token_logger)
 
         explanations = [ExpressionDocument(one_result['expression'], one_result['explanation']) for one_result in result]
 
         return NativeExplanationDocument(explanations=explanations)
+
+    def generate_stream(self, original: str, edited: str, token_logger: TokenLogger = None) -> Iterator[ExpressionDocument]:
+        """
+        Streams the completion and yields each expression as soon as its section is complete.
+        Unlike generate, the output is not regenerated when it can not be parsed.
+        """
+        if original == edited:
+            return
+
+        deltas = create_chat(messages=self._messages(original, edited), gpt_config=self.gpt_config, token_logger=token_logger, stream=True)
+        for section in iterate_sections(deltas, EXPRESSION_SEPARATOR):
+            yield from self._section_to_expressions(section)
+
+    async def agenerate_stream(self, original: str, edited: str, token_logger: TokenLogger = None) -> AsyncIterator[ExpressionDocument]:
+        if original == edited:
+            return
+
+        deltas = await acreate_chat(messages=self._messages(original, edited), gpt_config=self.gpt_config, token_logger=token_logger, stream=True)
+        async for section in aiterate_sections(deltas, EXPRESSION_SEPARATOR):
+            for expression in self._section_to_expressions(section):
+                yield expression
+
+    def _section_to_expressions(self, section: str) -> List[ExpressionDocument]:
+        return [
+            ExpressionDocument(one_result['expression'], one_result['explanation'])
+            for one_result in self._parsing_function(section.strip() + "\n")
+        ]
+
+    def _messages(self, original: str, edited: str) -> list[dict]:
+        return self.initial_conversation + [{
+            "role": "user", "content": f"Original: {original}\nEdited: {edited}"
+        }]
+
+    @staticmethod
+    def _parsing_function(text):
+      expressions_list = []
+
+      # Find all expressions and their explanations using Regex
+      expression_pattern = re.compile(r'# (.+?)\n((?:- [^\n]+\n)+)((?:[^#]+)?)', re.S)
+      matches = expression_pattern.findall(text)
+
+      for match in matches:
+          expression_dict = {}
+          expression_dict['expression'] = match[0]
+          expression_dict['explanation'] = match[1] + match[2]
+          expressions_list.append(expression_dict)
+
+      return expressions_list
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Optional
+
+from tensaku.src.cyten.cyten import (
+    CRITERIA_MODEL,
+    Category,
+    ScoreSettings,
+    ScoringMode,
+    _criteria_request,
+    _essay_result,
+    _parse_sampled_scores,
+    _score_category,
+    _words_count_result,
+    compile_score_settings,
+)
+from tensaku.utils import openai_utils
+from tensaku.utils.openai_utils import TokenLogger, chat_completion
+from tensaku.utils.utils import parallel_map
+
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+# statuses of a batch job that do not change any more
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+DEFAULT_POLL_INTERVAL = 60
+
+
+class BatchBackend(ABC):
+    """
+    Runs a JSONL file of requests in the OpenAI Batch API format
+    ({"custom_id", "method", "url", "body"} per line) and gives back the output lines
+    ({"custom_id", "response": {"status_code", "body"}, "error"} per line).
+    """
+
+    @abstractmethod
+    def submit(self, input_path: str) -> str:
+        # returns the job id
+        pass
+
+    @abstractmethod
+    def status(self, job_id: str) -> str:
+        pass
+
+    @abstractmethod
+    def download(self, job_id: str, output_path: str) -> None:
+        pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """
+    The OpenAI Batch API. The job is finished within completion_window at a discounted price,
+    and its requests do not count against the rate limits of the interactive requests.
+    """
+
+    def __init__(self, completion_window: str = "24h") -> None:
+        if not hasattr(openai_utils.client, "batches"):
+            raise ImportError("OpenAIBatchBackend needs openai>=1.17 (client.batches)")
+        self.completion_window = completion_window
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as input_file:
+            uploaded = openai_utils.client.files.create(file=input_file, purpose="batch")
+        batch = openai_utils.client.batches.create(
+            input_file_id=uploaded.id, endpoint=CHAT_COMPLETIONS_ENDPOINT, completion_window=self.completion_window
+        )
+        return batch.id
+
+    def status(self, job_id: str) -> str:
+        return openai_utils.client.batches.retrieve(job_id).status
+
+    def download(self, job_id: str, output_path: str) -> None:
+        # the failed requests are in the error file, both are written to output_path
+        batch = openai_utils.client.batches.retrieve(job_id)
+        with open(output_path, "w", encoding="utf-8") as output_file:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    text = openai_utils.client.files.content(file_id).text
+                    output_file.write(text if text.endswith("\n") else text + "\n")
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    Stand-in for tests and development. submit runs every request of the file right away with complete(body),
+    which returns the response body (chat_completion by default), and the output is kept next to the input file.
+    """
+
+    def __init__(self, complete: Optional[Callable[[dict], dict]] = None) -> None:
+        self.complete = complete or (lambda body: chat_completion(**body).model_dump())
+
+    def submit(self, input_path: str) -> str:
+        job_id = f"{input_path}.local-output.jsonl"
+        with open(input_path, encoding="utf-8") as input_file, open(job_id, "w", encoding="utf-8") as output_file:
+            for line in input_file:
+                request = json.loads(line)
+                try:
+                    output = {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": self.complete(request["body"])}, "error": None}
+                except Exception as e:
+                    output = {"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}
+                output_file.write(json.dumps(output, ensure_ascii=False) + "\n")
+        return job_id
+
+    def status(self, job_id: str) -> str:
+        return "completed" if os.path.exists(job_id) else "failed"
+
+    def download(self, job_id: str, output_path: str) -> None:
+        with open(job_id, encoding="utf-8") as job_file, open(output_path, "w", encoding="utf-8") as output_file:
+            output_file.write(job_file.read())
+
+
+class BulkScoringJob():
+    """
+    Scores many essays (e.g. a term-end exam) against the same ScoreSettings through a batch job.
+    Every category request of score_base_on_criteria is written to one JSONL file and submitted to backend.
+
+    The job id and its status are kept in the JSON file at state_path, next to the request and output files.
+    Running a job again with the same essays and state_path resumes it: a submitted job is not submitted again
+    and a downloaded output is not downloaded again.
+    Requests that failed in the job are scored with the interactive request when the results are read.
+    A job that did not complete (failed, expired, cancelled) is only scored interactively with fallback_interactive.
+    """
+
+    def __init__(
+        self,
+        essays: Iterable[str],
+        scoring_settings: ScoreSettings,
+        state_path: str = "tensaku_bulk_scoring.json",
+        backend: Optional[BatchBackend] = None,
+        token_logger: Optional[TokenLogger] = None,
+    ) -> None:
+        self.essays = list(essays)
+        self.scoring_settings = compile_score_settings(scoring_settings)
+        self.state_path = state_path
+        self.backend = backend or OpenAIBatchBackend()
+        self.token_logger = token_logger
+        # essays rejected by their word count are not sent, identical essays are sent once
+        self.unique_essays = list(dict.fromkeys(
+            essay for essay in self.essays if _words_count_result(essay, self.scoring_settings) is None
+        ))
+
+        base_path = os.path.splitext(state_path)[0]
+        self.input_path = f"{base_path}.input.jsonl"
+        self.output_path = f"{base_path}.output.jsonl"
+        self.state = self._load_state()
+
+    def _fingerprint(self) -> str:
+        content = json.dumps([self.essays, self.scoring_settings.key], ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _load_state(self) -> dict:
+        if not os.path.exists(self.state_path):
+            return {"fingerprint": self._fingerprint(), "job_id": None, "status": None}
+        with open(self.state_path, encoding="utf-8") as state_file:
+            state = json.load(state_file)
+        if state["fingerprint"] != self._fingerprint():
+            raise ValueError(f"{self.state_path} belongs to a job with other essays or settings")
+        return state
+
+    def _save_state(self) -> None:
+        temporary_path = f"{self.state_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as state_file:
+            json.dump(self.state, state_file)
+        os.replace(temporary_path, self.state_path)
+
+    def _requests(self) -> dict[str, tuple[str, Category]]:
+        # custom_id -> (essay, category)
+        return {
+            f"{number}-{target_skill.value}": (essay, target_skill)
+            for number, essay in enumerate(self.unique_essays)
+            for target_skill in self.scoring_settings.score_categories
+        }
+
+    def write_requests(self) -> int:
+        requests = self._requests()
+        with open(self.input_path, "w", encoding="utf-8") as input_file:
+            for custom_id, (essay, target_skill) in requests.items():
+                body = _criteria_request(self.scoring_settings.criteria_prompt(target_skill, essay))
+                line = {"custom_id": custom_id, "method": "POST", "url": CHAT_COMPLETIONS_ENDPOINT, "body": body}
+                input_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        return len(requests)
+
+    def submit(self) -> str:
+        if self.state["job_id"] is None:
+            self.write_requests()
+            self.state["job_id"] = self.backend.submit(self.input_path)
+            self.state["status"] = "submitted"
+            self._save_state()
+        return self.state["job_id"]
+
+    def poll(self) -> str:
+        if self.state["status"] not in FINAL_STATUSES:
+            self.state["status"] = self.backend.status(self.state["job_id"])
+            self._save_state()
+        return self.state["status"]
+
+    def wait(self, poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: Optional[float] = None) -> str:
+        started_at = time.monotonic()
+        while self.poll() not in FINAL_STATUSES:
+            if timeout is not None and time.monotonic() - started_at > timeout:
+                raise TimeoutError(f"Batch job {self.state['job_id']} is still {self.state['status']}")
+            time.sleep(poll_interval)
+        return self.state["status"]
+
+    def _download(self) -> None:
+        # the output is written to a temporary file first, so an interrupted download is not taken for the output
+        temporary_path = f"{self.output_path}.tmp"
+        self.backend.download(self.state["job_id"], temporary_path)
+        os.replace(temporary_path, self.output_path)
+
+    def results(self, max_concurrency: int = 8, fallback_interactive: bool = False) -> list[dict]:
+        """
+        Results of score_essay in the order of the essays.
+        Raises RuntimeError if the job did not complete, unless fallback_interactive is set:
+        then the requests without an output of the job are scored with the interactive request (at the interactive price).
+        A job that is still running always raises, its requests would be paid for twice.
+        """
+        status = self.state["status"]
+        if self.state["job_id"] is not None and status not in FINAL_STATUSES:
+            raise RuntimeError(f"Batch job {self.state['job_id']} is still {status}, wait for it to end")
+        if status != "completed" and not fallback_interactive:
+            raise RuntimeError(
+                f"Batch job {self.state['job_id']} is {status}, "
+                "pass fallback_interactive=True to score its requests with the interactive request"
+            )
+        if status in FINAL_STATUSES and not os.path.exists(self.output_path):
+            self._download()
+
+        requests = self._requests()
+        scores: dict[tuple[str, Category], int] = {}
+        if os.path.exists(self.output_path):
+            with open(self.output_path, encoding="utf-8") as output_file:
+                for line in output_file:
+                    if not line.strip():
+                        continue
+                    output = json.loads(line)
+                    if output.get("custom_id") not in requests:
+                        continue
+                    score = self._parse_output(output, *requests[output["custom_id"]])
+                    if score is not None:
+                        scores[requests[output["custom_id"]]] = score
+
+        # requests that failed in the job are scored with the interactive request
+        missing = [key for key in requests.values() if key not in scores]
+
+        def score_interactively(key: tuple[str, Category]) -> int:
+            essay, target_skill = key
+            return _score_category(essay, target_skill, self.scoring_settings, ScoringMode.concurrent, token_logger=self.token_logger)
+
+        scores.update(zip(missing, parallel_map(score_interactively, missing, max_workers=max_concurrency)))
+
+        results = []
+        for essay in self.essays:
+            words_count_result = _words_count_result(essay, self.scoring_settings)
+            if words_count_result:
+                results.append(words_count_result)
+                continue
+            category_scores = {target_skill: scores[(essay, target_skill)] for target_skill in self.scoring_settings.score_categories}
+            results.append(_essay_result(essay, category_scores, self.scoring_settings))
+        return results
+
+    def _parse_output(self, output: dict, essay: str, target_skill: Category) -> Optional[int]:
+        response = output.get("response")
+        if not response or response.get("status_code") != 200:
+            return None
+        body = response["body"]
+        usage = body.get("usage")
+        if self.token_logger and usage:
+            self.token_logger.log(
+                prompt_tokens=usage["prompt_tokens"], completion_tokens=usage["completion_tokens"], model=CRITERIA_MODEL, batch=True
+            )
+        try:
+            content = body["choices"][0]["message"]["content"]
+            return _parse_sampled_scores([content], self.scoring_settings.score_categories[target_skill].points_allocated)[0]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+
+    def run(
+        self, poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: Optional[float] = None, fallback_interactive: bool = False
+    ) -> list[dict]:
+        """
+        Submits the job (unless it was submitted before), waits until it ends and returns the results.
+        """
+        self.submit()
+        self.wait(poll_interval, timeout)
+        return self.results(fallback_interactive=fallback_interactive)
@@ -1,13 +1,61 @@
+import asyncio
 import base64
+import hashlib
 import json
+import math
+import re
+import statistics
+import string
+import threading
 import warnings
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from enum import Enum
-from typing import Optional, Union
+from typing import Iterable, Iterator, Optional, Union
 
 import yaml
-from pydantic import BaseModel
-
-from tensaku.utils.openai_utils import SEED, client
+from pydantic import BaseModel, ConfigDict, PrivateAttr
+
+from tensaku.src.cyten.image import ImageSettings, encode_image_url
+from tensaku.utils.openai_utils import (
+    SEED,
+    RequestSlots,
+    TokenLogger,
+    _cache_lookup,
+    _cache_store,
+    achat_completion,
+    async_retry,
+    chat_completion,
+    retry_request,
+)
+from tensaku.utils.rate_limit import estimate_text_tokens
+from tensaku.utils.utils import parallel_map, split_by_token_budget
+
+CRITERIA_MODEL = "gpt-4-1106-preview"
+# completion tokens reserved for the reason and the score of one essay in a packed request
+PACKED_SCORE_TOKENS = 150
+# estimated essay + completion tokens of the essays packed into one request, the rubric is sent once on top of it
+DEFAULT_PACK_TOKEN_BUDGET = 4000
+# number of compiled rubrics kept by compile_score_settings
+COMPILED_SETTINGS_CACHE_SIZE = 128
+# share of the word limits within which the word count of the OCR text is left to the vision model
+WORD_COUNT_TOLERANCE = 0.2
+# below this share of word-like tokens the OCR text is garbage and its word count is not trusted
+MIN_WORD_SHARE = 0.5
+WORD_PATTERN = re.compile(r"[A-Za-z]+(?:['’-][A-Za-z]+)*")
+# stripped from the tokens of the OCR text before they are counted
+WORD_PUNCTUATION = string.punctuation + "。、「」『』“”‘’"
+
+
+@retry_request(tries=3, delay=5, backoff=2)
+def _chat_completion(token_logger: Optional[TokenLogger] = None, **request):
+    # the OpenAI client does not retry, the requests of cyten are retried like create_chat
+    return chat_completion(token_logger=token_logger, **request)
+
+
+@async_retry(tries=3, delay=5, backoff=2)
+async def _achat_completion(token_logger: Optional[TokenLogger] = None, **request):
+    return await achat_completion(token_logger=token_logger, **request)
 
 
 class Category(str, Enum):
@@ -16,6 +64,26 @@ class Category(str, Enum):
     grammar = "grammar"
 
 
+class ScoringMode(str, Enum):
+    # sequential: one request per category, one after another
+    sequential = "sequential"
+    # concurrent: one request per category, all at the same time
+    concurrent = "concurrent"
+    # combined: one request that scores all the categories
+    combined = "combined"
+    # logprobs: one request per category that outputs only the score token, scored from its probabilities
+    logprobs = "logprobs"
+    # packed: one request per category for several essays under one copy of the rubric (score_essays only)
+    packed = "packed"
+
+
+class SampleAggregation(str, Enum):
+    # the most frequent score of the samples, ties go to the score closest to the median
+    majority = "majority"
+    # the (lower) median of the samples
+    median = "median"
+
+
 class Criteria(BaseModel):
     point: Optional[int] = None
     content: Optional[str] = None
@@ -55,6 +123,41 @@ class ScoreSettings(BaseModel):
     score_categories: Optional[dict[Category, ScoreCategorySettings]] = None
 
 
+class ScoreDistribution(BaseModel):
+    # score is the most probable score, or the score of the reasoned request when the distribution was uncertain
+    score: int
+    probabilities: dict[int, float]
+    expected_score: float
+    reason: Optional[str] = None
+    rescored: bool = False
+
+    @property
+    def confidence(self) -> float:
+        return max(self.probabilities.values())
+
+
+class ScoreSamples(BaseModel):
+    score: int
+    samples: list[int]
+
+    @property
+    def agreement(self) -> float:
+        # share of the samples that agree with the aggregated score
+        return self.samples.count(self.score) / len(self.samples)
+
+
+def aggregate_samples(samples: list[int], aggregation: SampleAggregation = SampleAggregation.majority) -> ScoreSamples:
+    median = statistics.median_low(samples)
+    if aggregation == SampleAggregation.median:
+        return ScoreSamples(score=median, samples=samples)
+    counts = Counter(samples)
+    most_common = max(counts.values())
+    score = min(
+        (score for score, count in counts.items() if count == most_common), key=lambda score: (abs(score - median), score)
+    )
+    return ScoreSamples(score=score, samples=samples)
+
+
 def penalty_by_word_count(
     essay: str,
     more_than_subtractions: dict[int:int],
@@ -81,13 +184,7 @@ def penalty_by_word_count(
     return 0  # no penalty
 
 
-def score_base_on_criteria(
-    essay: str,
-    points_allocated: int,
-    criteria: dict[int:str],
-    first_prompt: str,
-    essay_topic: str = None,
-) -> int:
+def _rubric_prompt(points_allocated: int, criteria: dict[int:str], first_prompt: str, essay_topic: str = None) -> str:
     if essay_topic:
         topic_prompt = f"エッセイのトピック: {essay_topic}\n"
     else:
@@ -104,6 +201,16 @@ def score_base_on_criteria(
         criteria_prompt += f"{score}点: {description}\n"
     criteria_prompt = criteria_prompt.strip()
 
+    return f"""{first_prompt}
+
+{topic_prompt}
+採点基準
+{points_allocated}点満点
+{criteria_prompt}
+"""
+
+
+def _criteria_output_prompt(points_allocated: int) -> str:
     schema = {
         "type": "object",
         "properties": {
@@ -113,35 +220,721 @@ def score_base_on_criteria(
         "required": ["reason", "score"],
     }
     schema_string = json.dumps(schema, indent=4)
+    return f"jsonでアウトプットしてください\n{schema_string}"
 
-    prompt = f"""{first_prompt}
 
-{topic_prompt}
-採点基準
-{points_allocated}点満点
-{criteria_prompt}
+def _essay_prompt(prefix: str, essay: str) -> str:
+    # the essay comes last, so all the prompts of a rubric share their prefix and hit the prompt cache of the API
+    return f"{prefix}\n# エッセイ\n{essay}\n"
 
-{essay}
 
-jsonでアウトプットしてください
-{schema_string}
-"""
-    result = client.chat.completions.create(
-        model="gpt-4-1106-preview",
+def _criteria_prompt(
+    essay: str,
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    output_prompt: Optional[str] = None,
+) -> str:
+    if output_prompt is None:
+        output_prompt = _criteria_output_prompt(points_allocated)
+    return _essay_prompt(f"{_rubric_prompt(points_allocated, criteria, first_prompt, essay_topic)}\n{output_prompt}\n", essay)
+
+
+def _criteria_request(prompt: str) -> dict:
+    # request of score_base_on_criteria, also written to the job files of the batch scoring
+    return dict(
+        model=CRITERIA_MODEL,
         response_format={"type": "json_object"},
         messages=[{"role": "user", "content": prompt}],
         temperature=0.5,
         seed=SEED,
     )
-    print(prompt)
+
+
+def _request_score(prompt: str, token_logger: Optional[TokenLogger] = None) -> int:
+    result = _chat_completion(token_logger=token_logger, **_criteria_request(prompt))
     return json.loads(result.choices[0].message.content)["score"]
 
 
-def score_essay(essay: str, scoring_settings: ScoreSettings) -> dict:
+async def _arequest_score(prompt: str, token_logger: Optional[TokenLogger] = None) -> int:
+    result = await _achat_completion(token_logger=token_logger, **_criteria_request(prompt))
+    return json.loads(result.choices[0].message.content)["score"]
+
+
+def score_base_on_criteria(
+    essay: str,
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    token_logger: Optional[TokenLogger] = None,
+) -> int:
+    prompt = _criteria_prompt(essay, points_allocated, criteria, first_prompt, essay_topic)
+    score = _request_score(prompt, token_logger)
+    print(prompt)
+    return score
+
+
+async def ascore_base_on_criteria(
+    essay: str,
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    token_logger: Optional[TokenLogger] = None,
+) -> int:
+    prompt = _criteria_prompt(essay, points_allocated, criteria, first_prompt, essay_topic)
+    return await _arequest_score(prompt, token_logger)
+
+
+def _parse_sampled_scores(contents: list[str], points_allocated: int) -> list[int]:
+    # samples that can not be parsed or are out of range are left out
+    scores = []
+    for content in contents:
+        try:
+            score = int(json.loads(content)["score"])
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            continue
+        if 0 <= score <= points_allocated:
+            scores.append(score)
+    if not scores:
+        raise ValueError(f"No valid score in the samples: {contents}")
+    return scores
+
+
+def _request_samples(prompt: str, points_allocated: int, samples: int, token_logger: Optional[TokenLogger] = None) -> list[int]:
+    result = _chat_completion(token_logger=token_logger, **_criteria_request(prompt), n=samples)
+    return _parse_sampled_scores([choice.message.content for choice in result.choices], points_allocated)
+
+
+async def _arequest_samples(
+    prompt: str, points_allocated: int, samples: int, token_logger: Optional[TokenLogger] = None
+) -> list[int]:
+    result = await _achat_completion(token_logger=token_logger, **_criteria_request(prompt), n=samples)
+    return _parse_sampled_scores([choice.message.content for choice in result.choices], points_allocated)
+
+
+def score_samples_base_on_criteria(
+    essay: str,
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    token_logger: Optional[TokenLogger] = None,
+    samples: int = 3,
+) -> list[int]:
+    """
+    score_base_on_criteria with samples completions of the same request (the n parameter), the prompt is paid for once.
+    """
+    prompt = _criteria_prompt(essay, points_allocated, criteria, first_prompt, essay_topic)
+    return _request_samples(prompt, points_allocated, samples, token_logger)
+
+
+async def ascore_samples_base_on_criteria(
+    essay: str,
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    token_logger: Optional[TokenLogger] = None,
+    samples: int = 3,
+) -> list[int]:
+    """
+    asyncio version of score_samples_base_on_criteria.
+    """
+    prompt = _criteria_prompt(essay, points_allocated, criteria, first_prompt, essay_topic)
+    return await _arequest_samples(prompt, points_allocated, samples, token_logger)
+
+
+def _packed_output_prompt(essays_count: int, points_allocated: int) -> str:
+    schema = {
+        "type": "object",
+        "properties": {
+            "scores": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "essay": {"type": "integer", "minimum": 1, "maximum": essays_count},
+                        "reason": {"type": "string"},
+                        "score": {"type": "integer", "minimum": 0, "maximum": points_allocated},
+                    },
+                    "required": ["essay", "reason", "score"],
+                },
+            },
+        },
+        "required": ["scores"],
+    }
+    schema_string = json.dumps(schema, indent=4)
+    return f"""下の{essays_count}個のエッセイは別々の生徒が書いたものです。ほかのエッセイと比べないで、それぞれのエッセイを採点基準だけで採点してください。
+scoresにはすべてのエッセイを番号順に入れて、jsonでアウトプットしてください
+{schema_string}"""
+
+
+def _parse_packed_scores(content: str, essays_count: int, points_allocated: int) -> list[Optional[int]]:
+    # None for the essays whose score is missing, duplicated or invalid
+    try:
+        items = json.loads(content)["scores"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return [None] * essays_count
+    if not isinstance(items, list):
+        return [None] * essays_count
+
+    scores: list[Optional[int]] = [None] * essays_count
+    seen = set()
+    for item in items:
+        try:
+            number, score = int(item["essay"]), int(item["score"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not 1 <= number <= essays_count or not 0 <= score <= points_allocated:
+            continue
+        if number in seen:
+            # two scores for the same essay, neither of them is trusted
+            scores[number - 1] = None
+            continue
+        seen.add(number)
+        scores[number - 1] = score
+    return scores
+
+
+def score_packed_base_on_criteria(
+    essays: list[str],
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    token_logger: Optional[TokenLogger] = None,
+) -> list[Optional[int]]:
+    """
+    Scores several essays with one request: the rubric is sent once and the numbered essays follow it.
+    Returns the scores in the order of essays, None for the essays whose output is missing or invalid.
+    """
+    prompt = _criteria_prompt(
+        _packed_essays(essays), points_allocated, criteria, first_prompt, essay_topic,
+        output_prompt=_packed_output_prompt(len(essays), points_allocated),
+    )
+    return _request_packed(prompt, len(essays), points_allocated, token_logger)
+
+
+def _packed_essays(essays: list[str]) -> str:
+    return "\n\n".join(f"[{number}]\n{essay}" for number, essay in enumerate(essays, start=1))
+
+
+def _request_packed(
+    prompt: str, essays_count: int, points_allocated: int, token_logger: Optional[TokenLogger] = None
+) -> list[Optional[int]]:
+    result = _chat_completion(token_logger=token_logger, **_criteria_request(prompt))
+    return _parse_packed_scores(result.choices[0].message.content, essays_count, points_allocated)
+
+
+SCORE_ONLY_PROMPT = "点数の整数だけをアウトプットしてください。"
+SCORE_AND_REASON_PROMPT = "1行目に点数の整数だけを、2行目から理由をアウトプットしてください。"
+
+
+def _distribution_request(points_allocated: int, prompt: str, with_reason: bool) -> dict:
+    return dict(
+        model=CRITERIA_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0,
+        max_tokens=500 if with_reason else 1,
+        logprobs=True,
+        # a few more than the scores, the same digit can come with and without a leading space
+        top_logprobs=min(points_allocated + 5, 20),
+        seed=SEED,
+    )
+
+
+def _parse_score_distribution(choice, points_allocated: int, with_reason: bool) -> ScoreDistribution:
+    probabilities = {score: 0.0 for score in range(points_allocated + 1)}
+    content = choice.message.content or ""
+    logprobs = getattr(choice, "logprobs", None)
+    if logprobs is not None and logprobs.content:
+        # the score is the first token of the output
+        for top_logprob in logprobs.content[0].top_logprobs:
+            token = top_logprob.token.strip()
+            if token.isdigit() and int(token) <= points_allocated:
+                probabilities[int(token)] += math.exp(top_logprob.logprob)
+
+    total = sum(probabilities.values())
+    if total == 0:
+        # no logprobs (e.g. a cached or an Azure response), the output is taken as certain
+        match = re.match(r"\s*(\d+)", content)
+        if match is None or int(match.group(1)) > points_allocated:
+            raise ValueError(f"Invalid score output: {content}")
+        probabilities[int(match.group(1))] = 1.0
+        total = 1.0
+
+    probabilities = {score: probability / total for score, probability in probabilities.items()}
+    score = max(probabilities, key=probabilities.get)
+    reason = content.partition("\n")[2].strip() or None if with_reason else None
+    return ScoreDistribution(
+        score=score,
+        probabilities=probabilities,
+        expected_score=sum(score * probability for score, probability in probabilities.items()),
+        reason=reason,
+    )
+
+
+def _request_distribution(
+    prompt: str, points_allocated: int, with_reason: bool = False, token_logger: Optional[TokenLogger] = None
+) -> ScoreDistribution:
+    result = _chat_completion(token_logger=token_logger, **_distribution_request(points_allocated, prompt, with_reason))
+    return _parse_score_distribution(result.choices[0], points_allocated, with_reason)
+
+
+async def _arequest_distribution(
+    prompt: str, points_allocated: int, with_reason: bool = False, token_logger: Optional[TokenLogger] = None
+) -> ScoreDistribution:
+    result = await _achat_completion(token_logger=token_logger, **_distribution_request(points_allocated, prompt, with_reason))
+    return _parse_score_distribution(result.choices[0], points_allocated, with_reason)
+
+
+def score_distribution_base_on_criteria(
+    essay: str,
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    token_logger: Optional[TokenLogger] = None,
+    with_reason: bool = False,
+) -> ScoreDistribution:
+    """
+    Faster version of score_base_on_criteria. The model outputs the score first (and only the score without with_reason),
+    and the probabilities of the score token give the distribution over 0..points_allocated and the expected score.
+    """
+    prompt = _criteria_prompt(
+        essay, points_allocated, criteria, first_prompt, essay_topic,
+        output_prompt=SCORE_AND_REASON_PROMPT if with_reason else SCORE_ONLY_PROMPT,
+    )
+    return _request_distribution(prompt, points_allocated, with_reason, token_logger)
+
+
+async def ascore_distribution_base_on_criteria(
+    essay: str,
+    points_allocated: int,
+    criteria: dict[int:str],
+    first_prompt: str,
+    essay_topic: str = None,
+    token_logger: Optional[TokenLogger] = None,
+    with_reason: bool = False,
+) -> ScoreDistribution:
+    """
+    asyncio version of score_distribution_base_on_criteria.
+    """
+    prompt = _criteria_prompt(
+        essay, points_allocated, criteria, first_prompt, essay_topic,
+        output_prompt=SCORE_AND_REASON_PROMPT if with_reason else SCORE_ONLY_PROMPT,
+    )
+    return await _arequest_distribution(prompt, points_allocated, with_reason, token_logger)
+
+
+def _combined_prefix(scoring_settings: ScoreSettings) -> str:
+    if scoring_settings.topic:
+        topic_prompt = f"エッセイのトピック: {scoring_settings.topic}\n"
+    else:
+        topic_prompt = ""
+
+    criteria_prompt = ""
+    properties = {}
+    for target_skill, settings in scoring_settings.score_categories.items():
+        criteria_prompt += f"{_category_name(target_skill)}({target_skill.value}) {settings.points_allocated}点満点\n"
+        for criteria in sorted(settings.criteria, key=lambda item: item.point):
+            criteria_prompt += f"{criteria.point}点: {criteria.content}\n"
+        criteria_prompt += "\n"
+        properties[target_skill.value] = {
+            "type": "object",
+            "properties": {
+                "reason": {"type": "string"},
+                "score": {"type": "integer", "minimum": 0, "maximum": settings.points_allocated},
+            },
+            "required": ["reason", "score"],
+        }
+    criteria_prompt = criteria_prompt.strip()
+
+    schema = {"type": "object", "properties": properties, "required": list(properties.keys())}
+    schema_string = json.dumps(schema, indent=4)
+
+    return f"""生徒のエッセイを観点ごとに日本語で採点してください。それぞれの観点は、ほかの観点を考慮しないで、その観点の採点基準だけで採点してください。
+
+{topic_prompt}
+採点基準
+{criteria_prompt}
+
+jsonでアウトプットしてください
+{schema_string}
+"""
+
+
+def _parse_combined_scores(content: str, scoring_settings: ScoreSettings) -> dict[Category, int]:
+    # categories whose score is missing or out of range are left out, they are scored on their own
+    try:
+        result = json.loads(content)
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(result, dict):
+        return {}
+
+    category_scores = {}
+    for target_skill, settings in scoring_settings.score_categories.items():
+        info = result.get(target_skill.value)
+        if not isinstance(info, dict):
+            continue
+        try:
+            score = int(info.get("score"))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= score <= settings.points_allocated:
+            category_scores[target_skill] = score
+    return category_scores
+
+
+def _combined_category_scores(
+    contents: list[str], scoring_settings: ScoreSettings, aggregation: SampleAggregation
+) -> dict[Category, Union[int, ScoreSamples]]:
+    # one output gives ints, several samples are aggregated by category
+    if len(contents) == 1:
+        return _parse_combined_scores(contents[0], scoring_settings)
+    category_samples: dict[Category, list[int]] = {}
+    for content in contents:
+        for target_skill, score in _parse_combined_scores(content, scoring_settings).items():
+            category_samples.setdefault(target_skill, []).append(score)
+    return {target_skill: aggregate_samples(samples, aggregation) for target_skill, samples in category_samples.items()}
+
+
+def score_all_categories(
+    essay: str,
+    scoring_settings: ScoreSettings,
+    token_logger: Optional[TokenLogger] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> dict[Category, Union[int, ScoreSamples]]:
+    """
+    Scores all the categories of scoring_settings in one request.
+    A category missing from the output (or with an invalid score) is scored with score_base_on_criteria.
+    With samples > 1 the request has samples completions and the scores of each category are aggregated.
+    """
+    scoring_settings = compile_score_settings(scoring_settings)
+    result = _chat_completion(token_logger=token_logger, **_criteria_request(scoring_settings.combined_prompt(essay)), n=samples)
+    category_scores = _combined_category_scores(
+        [choice.message.content for choice in result.choices], scoring_settings, aggregation
+    )
+    missing = [target_skill for target_skill in scoring_settings.score_categories if target_skill not in category_scores]
+    if missing:
+        category_scores.update(_score_categories(
+            essay, scoring_settings, missing, ScoringMode.concurrent, token_logger, samples=samples, aggregation=aggregation
+        ))
+    return {target_skill: category_scores[target_skill] for target_skill in scoring_settings.score_categories}
+
+
+async def ascore_all_categories(
+    essay: str,
+    scoring_settings: ScoreSettings,
+    token_logger: Optional[TokenLogger] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> dict[Category, Union[int, ScoreSamples]]:
+    """
+    asyncio version of score_all_categories.
+    """
+    scoring_settings = compile_score_settings(scoring_settings)
+    result = await _achat_completion(
+        token_logger=token_logger, **_criteria_request(scoring_settings.combined_prompt(essay)), n=samples
+    )
+    category_scores = _combined_category_scores(
+        [choice.message.content for choice in result.choices], scoring_settings, aggregation
+    )
+    missing = [target_skill for target_skill in scoring_settings.score_categories if target_skill not in category_scores]
+    if missing:
+        category_scores.update(await _ascore_categories(
+            essay, scoring_settings, missing, ScoringMode.concurrent, token_logger, samples=samples, aggregation=aggregation
+        ))
+    return {target_skill: category_scores[target_skill] for target_skill in scoring_settings.score_categories}
+
+
+def _category_name(target_skill: Category) -> str:
+    if target_skill == Category.content:
+        return "内容と構成"
+    elif target_skill == Category.vocabulary:
+        return "語彙"
+    elif target_skill == Category.grammar:
+        return "文法"
+    else:
+        raise ValueError(f"Invalid target skill: {target_skill}")
+
+
+def _first_prompt(target_skill: Category) -> str:
+    if target_skill == Category.content:
+        return f"生徒のエッセイの内容と構成を日本語で採点してください。文法と語彙は考慮しないで、内容と構成だけを採点してください。"
+    elif target_skill == Category.vocabulary:
+        return f"生徒のエッセイの語彙を日本語で採点してください。内容と構成、文法は考慮しないで、語彙だけを採点してください。"
+    elif target_skill == Category.grammar:
+        return f"生徒のエッセイの文法を日本語で採点してください。内容と構成、語彙は考慮しないで、文法だけを採点してください。"
+    else:
+        raise ValueError(f"Invalid target skill: {target_skill}")
+
+
+def _category_rubric_prompt(target_skill: Category, scoring_settings: ScoreSettings) -> str:
+    settings = scoring_settings.score_categories[target_skill]
+    return _rubric_prompt(
+        settings.points_allocated,
+        {criteria.point: criteria.content for criteria in settings.criteria},
+        _first_prompt(target_skill),
+        scoring_settings.topic if target_skill == Category.content else None,
+    )
+
+
+def _excluded_opening(additional_info: str) -> tuple[str, ...]:
+    # the English words at the start of the first quoted sentence, e.g. 最初の"I want to enjoy a day trip by + 交通機関"は語数に含めない
+    for quoted in re.findall(r'["“「『](.+?)["”」』]', additional_info):
+        opening = re.match(r"\s*[A-Za-z][A-Za-z'’ ]*", quoted)
+        words = tuple(word.lower() for word in WORD_PATTERN.findall(opening.group())) if opening else ()
+        if len(words) >= 2:
+            return words
+    return ()
+
+
+class CompiledScoreSettings(ScoreSettings):
+    """
+    ScoreSettings with everything that does not depend on the essay built once:
+    the rubric and the output format of each category, the combined and the vision prompts, and the word count penalties.
+    Every prompt starts with the rubric and ends with the essay, so the prompts of one rubric share their prefix.
+    Create it with compile_score_settings, which keeps the compiled settings of the latest rubrics by content hash.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    _key: str = PrivateAttr("")
+    _rubric_prompts: dict[Category, str] = PrivateAttr(default_factory=dict)
+    _output_prompts: dict[Category, str] = PrivateAttr(default_factory=dict)
+    _combined_prefix: str = PrivateAttr("")
+    _vision_prefix: str = PrivateAttr("")
+    _more_than_subtractions: dict[int, int] = PrivateAttr(default_factory=dict)
+    _less_than_subtractions: dict[int, int] = PrivateAttr(default_factory=dict)
+    _excluded_opening: tuple[str, ...] = PrivateAttr(())
+
+    def model_post_init(self, __context) -> None:
+        self._key = _settings_key(self)
+        for target_skill, settings in (self.score_categories or {}).items():
+            self._rubric_prompts[target_skill] = _category_rubric_prompt(target_skill, self)
+            self._output_prompts[target_skill] = _criteria_output_prompt(settings.points_allocated)
+        if self.score_categories:
+            self._combined_prefix = _combined_prefix(self)
+            self._vision_prefix = _vision_prefix(self)
+        for subtraction in (self.words_count.subtractions or []) if self.words_count else []:
+            if isinstance(subtraction, SubtractionWithWordsMoreThan):
+                self._more_than_subtractions[subtraction.words_more_than] = subtraction.subtract_points
+            elif isinstance(subtraction, SubtractionWithWordsLessThan):
+                self._less_than_subtractions[subtraction.words_less_than] = subtraction.subtract_points
+        if self.words_count and self.words_count.additional_info:
+            self._excluded_opening = _excluded_opening(self.words_count.additional_info)
+
+    @property
+    def key(self) -> str:
+        # content hash of the settings
+        return self._key
+
+    def criteria_prompt(self, target_skill: Category, essay: str, output_prompt: Optional[str] = None) -> str:
+        # the prompt of score_base_on_criteria, output_prompt replaces the JSON output format
+        return _essay_prompt(f"{self._rubric_prompts[target_skill]}\n{output_prompt or self._output_prompts[target_skill]}\n", essay)
+
+    def combined_prompt(self, essay: str) -> str:
+        return _essay_prompt(self._combined_prefix, essay)
+
+    def vision_prompt(self, essay: str) -> str:
+        return f"{self._vision_prefix}\n# OCR結果（誤りがある可能性あり）\n{essay}\n"
+
+    def words_penalty(self, essay: str) -> int:
+        return -penalty_by_word_count(essay, self._more_than_subtractions, self._less_than_subtractions)
+
+    def strip_excluded_opening(self, essay: str) -> Optional[str]:
+        """
+        Removes the opening that words_count.additional_info excludes from the count: its words and the one word
+        filled in after them (e.g. "I want to enjoy a day trip by" + 交通機関).
+        Returns None when the essay does not start with the exact opening, its word count is then left to the vision model.
+        """
+        tokens = essay.split()
+        # a blank essay has no opening either
+        if not self._excluded_opening or not tokens:
+            return essay
+        opening = tuple(token.strip(WORD_PUNCTUATION).lower() for token in tokens[: len(self._excluded_opening)])
+        if opening != self._excluded_opening or len(tokens) <= len(self._excluded_opening):
+            return None
+        return " ".join(tokens[len(self._excluded_opening) + 1:])
+
+
+_compiled_settings: OrderedDict[str, CompiledScoreSettings] = OrderedDict()
+_compiled_settings_lock = threading.Lock()
+
+
+def _settings_key(scoring_settings: ScoreSettings) -> str:
+    return hashlib.sha256(scoring_settings.model_dump_json().encode("utf-8")).hexdigest()
+
+
+def compile_score_settings(scoring_settings: ScoreSettings) -> CompiledScoreSettings:
+    """
+    Returns the compiled version of scoring_settings. Settings with the same content share one CompiledScoreSettings,
+    and the latest COMPILED_SETTINGS_CACHE_SIZE rubrics are kept. A CompiledScoreSettings is returned as it is.
+    """
+    if isinstance(scoring_settings, CompiledScoreSettings):
+        return scoring_settings
+    key = _settings_key(scoring_settings)
+    with _compiled_settings_lock:
+        compiled = _compiled_settings.get(key)
+        if compiled is not None:
+            _compiled_settings.move_to_end(key)
+            return compiled
+
+    # a deep copy, so changing scoring_settings later does not change the compiled prompts
+    compiled = CompiledScoreSettings(**dict(scoring_settings.model_copy(deep=True)))
+    with _compiled_settings_lock:
+        _compiled_settings[key] = compiled
+        while len(_compiled_settings) > COMPILED_SETTINGS_CACHE_SIZE:
+            _compiled_settings.popitem(last=False)
+    return compiled
+
+
+def _rejected_result(message: str, scoring_settings: ScoreSettings) -> dict:
+    scores = {
+        target_skill.value: 0
+        for target_skill, setting in scoring_settings.score_categories.items()
+    }
+    scores["total"] = 0
+    return {"message": message, "scores": scores}
+
+
+def _words_count_result(essay: str, scoring_settings: ScoreSettings) -> Optional[dict]:
+    # returns the final result when the essay is rejected by its word count, otherwise None.
+    words_count = len(essay.split(" "))
+    if (
+        scoring_settings.words_count.min
+        and words_count < scoring_settings.words_count.min
+    ):
+        return _rejected_result("too few words", scoring_settings)
+    if (
+        scoring_settings.words_count.max
+        and words_count > scoring_settings.words_count.max
+    ):
+        return _rejected_result("too many words", scoring_settings)
+    return None
+
+
+def _score_category(
+    essay: str,
+    target_skill: Category,
+    scoring_settings: CompiledScoreSettings,
+    mode: ScoringMode,
+    min_confidence: Optional[float] = None,
+    token_logger: Optional[TokenLogger] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> Union[int, ScoreDistribution, ScoreSamples]:
+    points_allocated = scoring_settings.score_categories[target_skill].points_allocated
+    prompt = scoring_settings.criteria_prompt(target_skill, essay)
+    if mode != ScoringMode.logprobs:
+        if samples > 1:
+            return aggregate_samples(_request_samples(prompt, points_allocated, samples, token_logger), aggregation)
+        return _request_score(prompt, token_logger)
+
+    distribution = _request_distribution(
+        scoring_settings.criteria_prompt(target_skill, essay, SCORE_ONLY_PROMPT), points_allocated, token_logger=token_logger
+    )
+    if min_confidence is not None and distribution.confidence < min_confidence:
+        # uncertain, scored again with the reasoned request
+        distribution.score = _request_score(prompt, token_logger)
+        distribution.rescored = True
+    return distribution
+
+
+async def _ascore_category(
+    essay: str,
+    target_skill: Category,
+    scoring_settings: CompiledScoreSettings,
+    mode: ScoringMode,
+    min_confidence: Optional[float] = None,
+    token_logger: Optional[TokenLogger] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> Union[int, ScoreDistribution, ScoreSamples]:
+    points_allocated = scoring_settings.score_categories[target_skill].points_allocated
+    prompt = scoring_settings.criteria_prompt(target_skill, essay)
+    if mode != ScoringMode.logprobs:
+        if samples > 1:
+            return aggregate_samples(await _arequest_samples(prompt, points_allocated, samples, token_logger), aggregation)
+        return await _arequest_score(prompt, token_logger)
+
+    distribution = await _arequest_distribution(
+        scoring_settings.criteria_prompt(target_skill, essay, SCORE_ONLY_PROMPT), points_allocated, token_logger=token_logger
+    )
+    if min_confidence is not None and distribution.confidence < min_confidence:
+        distribution.score = await _arequest_score(prompt, token_logger)
+        distribution.rescored = True
+    return distribution
+
+
+def _score_categories(
+    essay: str,
+    scoring_settings: CompiledScoreSettings,
+    target_skills: list[Category],
+    mode: ScoringMode,
+    token_logger: Optional[TokenLogger] = None,
+    min_confidence: Optional[float] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> dict[Category, Union[int, ScoreDistribution, ScoreSamples]]:
+    # one request per category, at the same time unless ScoringMode.sequential
+    def score(target_skill: Category) -> Union[int, ScoreDistribution, ScoreSamples]:
+        return _score_category(
+            essay, target_skill, scoring_settings, mode, min_confidence, token_logger, samples, aggregation
+        )
+
+    max_workers = 1 if mode == ScoringMode.sequential else len(target_skills)
+    return dict(zip(target_skills, parallel_map(score, target_skills, max_workers=max(max_workers, 1))))
+
+
+async def _ascore_categories(
+    essay: str,
+    scoring_settings: CompiledScoreSettings,
+    target_skills: list[Category],
+    mode: ScoringMode,
+    token_logger: Optional[TokenLogger] = None,
+    min_confidence: Optional[float] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> dict[Category, Union[int, ScoreDistribution, ScoreSamples]]:
+    async def score(target_skill: Category) -> Union[int, ScoreDistribution, ScoreSamples]:
+        return await _ascore_category(
+            essay, target_skill, scoring_settings, mode, min_confidence, token_logger, samples, aggregation
+        )
+
+    if mode == ScoringMode.sequential:
+        return {target_skill: await score(target_skill) for target_skill in target_skills}
+    return dict(zip(target_skills, await asyncio.gather(*[score(target_skill) for target_skill in target_skills])))
+
+
+def score_essay(
+    essay: str,
+    scoring_settings: ScoreSettings,
+    token_logger: Optional[TokenLogger] = None,
+    mode: ScoringMode = ScoringMode.sequential,
+    min_confidence: Optional[float] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> dict:
     """
     input
     scoring_settings: ScoreSettings
     essay: str
+    mode: ScoringMode
+        sequential (default): one request per category, one after another
+        concurrent: one request per category, all at the same time
+        combined: one request for all the categories
+        logprobs: one request per category (at the same time) that outputs only the score
+    min_confidence: with ScoringMode.logprobs, categories whose most probable score has a lower probability
+        are scored again with the reasoned request
+    samples: number of completions of each request (the n parameter). The scores of each category are aggregated
+        by aggregation (majority vote or median). Not used with ScoringMode.logprobs
     return dict
     {
         "message": "too many words" or "too few words" or "success",
@@ -153,64 +946,276 @@ def score_essay(essay: str, scoring_settings: ScoreSettings) -> dict:
             "total": 28
         }
     }
+    With ScoringMode.logprobs the dict also has
+        "expected_scores": {"content": 9.6, ...},
+        "confidence": {"content": 0.62, ...}
+    With samples > 1 the dict also has
+        "agreement": {"content": 0.67, ...} (share of the samples that agree with the score)
+    scoring_settings can be a CompiledScoreSettings (see compile_score_settings), otherwise it is compiled here.
     """
-    words_count = len(essay.split(" "))
-    if (
-        scoring_settings.words_count.min
-        and words_count < scoring_settings.words_count.min
-    ):
-        scores = {
-            target_skill.value: 0
-            for target_skill, setting in scoring_settings.score_categories.items()
-        }
-        scores["total"] = 0
-        return {"message": "too few words", "scores": scores}
-    if (
-        scoring_settings.words_count.max
-        and words_count > scoring_settings.words_count.max
-    ):
-        scores = {
-            target_skill.value: 0
-            for target_skill, setting in scoring_settings.score_categories.items()
-        }
-        scores["total"] = 0
-        return {"message": "too many words", "scores": scores}
+    scoring_settings = compile_score_settings(scoring_settings)
+    words_count_result = _words_count_result(essay, scoring_settings)
+    if words_count_result:
+        return words_count_result
+
+    category_scores = _essay_category_scores(
+        essay, scoring_settings, mode, token_logger, min_confidence, samples, aggregation
+    )
+    return _essay_result(essay, category_scores, scoring_settings)
 
-    scores = {}
-    for target_skill, settings in scoring_settings.score_categories.items():
-        if target_skill == Category.content:
-            first_prompt = f"生徒のエッセイの内容と構成を日本語で採点してください。文法と語彙は考慮しないで、内容と構成だけを採点してください。"
-        elif target_skill == Category.vocabulary:
-            first_prompt = f"生徒のエッセイの語彙を日本語で採点してください。内容と構成、文法は考慮しないで、語彙だけを採点してください。"
-        elif target_skill == Category.grammar:
-            first_prompt = f"生徒のエッセイの文法を日本語で採点してください。内容と構成、語彙は考慮しないで、文法だけを採点してください。"
-        else:
-            raise ValueError(f"Invalid target skill: {target_skill}")
 
-        scores[target_skill.value] = score_base_on_criteria(
-            essay,
-            settings.points_allocated,
-            {criteria.point: criteria.content for criteria in settings.criteria},
-            first_prompt,
-            scoring_settings.topic if target_skill == Category.content else None,
+async def ascore_essay(
+    essay: str,
+    scoring_settings: ScoreSettings,
+    token_logger: Optional[TokenLogger] = None,
+    mode: ScoringMode = ScoringMode.concurrent,
+    min_confidence: Optional[float] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> dict:
+    """
+    asyncio version of score_essay. By default all the categories are scored at the same time.
+    """
+    assert samples >= 1, "samples must be at least 1"
+    scoring_settings = compile_score_settings(scoring_settings)
+    words_count_result = _words_count_result(essay, scoring_settings)
+    if words_count_result:
+        return words_count_result
+
+    if mode == ScoringMode.combined:
+        category_scores = await ascore_all_categories(essay, scoring_settings, token_logger, samples, aggregation)
+    else:
+        category_scores = await _ascore_categories(
+            essay, scoring_settings, list(scoring_settings.score_categories.keys()), mode, token_logger, min_confidence,
+            samples, aggregation,
         )
+    return _essay_result(essay, category_scores, scoring_settings)
 
-    scores["words_penalty"] = -penalty_by_word_count(
-        essay,
-        {
-            subtraction.words_more_than: subtraction.subtract_points
-            for subtraction in scoring_settings.words_count.subtractions
-            if isinstance(subtraction, SubtractionWithWordsMoreThan)
-        },
-        {
-            subtraction.words_less_than: subtraction.subtract_points
-            for subtraction in scoring_settings.words_count.subtractions
-            if isinstance(subtraction, SubtractionWithWordsLessThan)
-        },
+
+def _essay_category_scores(
+    essay: str,
+    scoring_settings: CompiledScoreSettings,
+    mode: ScoringMode,
+    token_logger: Optional[TokenLogger] = None,
+    min_confidence: Optional[float] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> dict[Category, Union[int, ScoreDistribution, ScoreSamples]]:
+    assert samples >= 1, "samples must be at least 1"
+    if mode == ScoringMode.combined:
+        return score_all_categories(essay, scoring_settings, token_logger, samples, aggregation)
+    return _score_categories(
+        essay, scoring_settings, list(scoring_settings.score_categories.keys()), mode, token_logger, min_confidence,
+        samples, aggregation,
     )
+
+
+def _essay_result(
+    essay: str,
+    category_scores: dict[Category, Union[int, ScoreDistribution, ScoreSamples]],
+    scoring_settings: ScoreSettings,
+) -> dict:
+    distributions = {
+        target_skill: score for target_skill, score in category_scores.items() if isinstance(score, ScoreDistribution)
+    }
+    sampled = {target_skill: score for target_skill, score in category_scores.items() if isinstance(score, ScoreSamples)}
+    scores = {
+        target_skill.value: score if isinstance(score, int) else score.score
+        for target_skill, score in category_scores.items()
+    }
+    scores["words_penalty"] = compile_score_settings(scoring_settings).words_penalty(essay)
     scores["total"] = sum(scores.values())
+    result = {"message": "success", "scores": scores}
+    if distributions:
+        result["expected_scores"] = {target_skill.value: distribution.expected_score for target_skill, distribution in distributions.items()}
+        result["confidence"] = {target_skill.value: distribution.confidence for target_skill, distribution in distributions.items()}
+    if sampled:
+        result["agreement"] = {target_skill.value: samples.agreement for target_skill, samples in sampled.items()}
+    return result
+
+
+def score_essays(
+    essays: Iterable[str],
+    scoring_settings: ScoreSettings,
+    max_concurrency: int = 8,
+    token_logger: Optional[TokenLogger] = None,
+    mode: ScoringMode = ScoringMode.concurrent,
+    min_confidence: Optional[float] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+    token_budget: int = DEFAULT_PACK_TOKEN_BUDGET,
+) -> Iterator[tuple[int, dict]]:
+    """
+    Scores many essays (e.g. a whole class) against the same ScoreSettings.
+    Yields (index of the essay, result of score_essay) as soon as each essay is scored.
+
+    All the requests of all essays (also the fallbacks to a request per category) share max_concurrency
+    simultaneous requests, and essays with identical text are scored only once.
+    With ScoringMode.sequential the requests are sent one after another, whatever max_concurrency is.
+    With ScoringMode.combined every essay is scored in one request.
+    With ScoringMode.packed the essays of each category are packed into requests of token_budget tokens
+    that share one copy of the rubric, and essays whose output is invalid are scored on their own.
+    token_logger collects the usage of the whole batch.
+    """
+    scoring_settings = compile_score_settings(scoring_settings)
+    if mode == ScoringMode.combined:
+        yield from _score_essays_combined(
+            list(essays), scoring_settings, max_concurrency, token_logger, samples, aggregation
+        )
+        return
+    if mode == ScoringMode.packed:
+        yield from _score_essays_packed(list(essays), scoring_settings, max_concurrency, token_logger, token_budget)
+        return
+
+    essays = list(essays)
+    if mode == ScoringMode.sequential:
+        max_concurrency = 1
+    request_slots = RequestSlots(max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        category_futures: dict[tuple[str, Category], Future] = {}
+        rejected = {}
+        pending = {}
+        for index, essay in enumerate(essays):
+            words_count_result = _words_count_result(essay, scoring_settings)
+            if words_count_result:
+                rejected[index] = words_count_result
+                continue
+
+            for target_skill in scoring_settings.score_categories:
+                if (essay, target_skill) not in category_futures:
+                    category_futures[(essay, target_skill)] = executor.submit(
+                        request_slots.run, _score_category,
+                        essay, target_skill, scoring_settings, mode, min_confidence, token_logger, samples, aggregation,
+                    )
+            pending[index] = {
+                target_skill: category_futures[(essay, target_skill)]
+                for target_skill in scoring_settings.score_categories
+            }
+
+        yield from rejected.items()
+
+        def finished() -> Iterator[tuple[int, dict]]:
+            for index in [index for index, futures in pending.items() if all(future.done() for future in futures.values())]:
+                futures = pending.pop(index)
+                yield index, _essay_result(
+                    essays[index],
+                    {target_skill: future.result() for target_skill, future in futures.items()},
+                    scoring_settings,
+                )
+
+        # essays without any category are finished right away
+        yield from finished()
+        for _ in as_completed(set(category_futures.values())):
+            yield from finished()
+
+
+def _score_essays_combined(
+    essays: list[str],
+    scoring_settings: ScoreSettings,
+    max_concurrency: int,
+    token_logger: Optional[TokenLogger] = None,
+    samples: int = 1,
+    aggregation: SampleAggregation = SampleAggregation.majority,
+) -> Iterator[tuple[int, dict]]:
+    # the categories missing from a combined output are scored on their own within the same budget
+    request_slots = RequestSlots(max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        essay_futures: dict[str, Future] = {}
+        indexes: dict[Future, list[int]] = {}
+        rejected = {}
+        for index, essay in enumerate(essays):
+            words_count_result = _words_count_result(essay, scoring_settings)
+            if words_count_result:
+                rejected[index] = words_count_result
+                continue
+            if essay not in essay_futures:
+                essay_futures[essay] = executor.submit(
+                    request_slots.run, score_all_categories, essay, scoring_settings, token_logger, samples, aggregation
+                )
+            indexes.setdefault(essay_futures[essay], []).append(index)
+
+        yield from rejected.items()
+
+        for future in as_completed(indexes):
+            for index in indexes[future]:
+                yield index, _essay_result(essays[index], future.result(), scoring_settings)
+
+
+def _score_packed_category(
+    essays: list[str],
+    target_skill: Category,
+    scoring_settings: CompiledScoreSettings,
+    token_logger: Optional[TokenLogger] = None,
+) -> dict[str, int]:
+    points_allocated = scoring_settings.score_categories[target_skill].points_allocated
+    if len(essays) == 1:
+        scores = [None]
+    else:
+        prompt = scoring_settings.criteria_prompt(
+            target_skill, _packed_essays(essays), _packed_output_prompt(len(essays), points_allocated)
+        )
+        scores = _request_packed(prompt, len(essays), points_allocated, token_logger)
+
+    # essays that failed validation are unpacked and scored on their own
+    failed = [essay for essay, score in zip(essays, scores) if score is None]
+    retried = parallel_map(
+        lambda essay: _score_category(essay, target_skill, scoring_settings, ScoringMode.concurrent, token_logger=token_logger),
+        failed,
+        max_workers=max(len(failed), 1),
+    )
+    essay_scores = {essay: score for essay, score in zip(essays, scores) if score is not None}
+    essay_scores.update(zip(failed, retried))
+    return essay_scores
+
+
+def _score_essays_packed(
+    essays: list[str],
+    scoring_settings: ScoreSettings,
+    max_concurrency: int,
+    token_logger: Optional[TokenLogger] = None,
+    token_budget: int = DEFAULT_PACK_TOKEN_BUDGET,
+) -> Iterator[tuple[int, dict]]:
+    rejected = {}
+    unique_essays = []
+    for index, essay in enumerate(essays):
+        words_count_result = _words_count_result(essay, scoring_settings)
+        if words_count_result:
+            rejected[index] = words_count_result
+        elif essay not in unique_essays:
+            unique_essays.append(essay)
+    batches = split_by_token_budget(
+        unique_essays, lambda essay: estimate_text_tokens(essay) + PACKED_SCORE_TOKENS, token_budget
+    )
+
+    # the essays of a failed packed output are scored on their own within the same budget
+    request_slots = RequestSlots(max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        batch_futures: dict[Future, Category] = {
+            executor.submit(request_slots.run, _score_packed_category, batch, target_skill, scoring_settings, token_logger): target_skill
+            for target_skill in scoring_settings.score_categories
+            for batch in batches
+        }
+        yield from rejected.items()
+
+        category_scores: dict[str, dict[Category, int]] = {essay: {} for essay in unique_essays}
+        pending = [index for index, essay in enumerate(essays) if index not in rejected]
+
+        def finished() -> Iterator[tuple[int, dict]]:
+            for index in [index for index in pending if len(category_scores[essays[index]]) == len(scoring_settings.score_categories)]:
+                pending.remove(index)
+                scores = category_scores[essays[index]]
+                yield index, _essay_result(
+                    essays[index],
+                    {target_skill: scores[target_skill] for target_skill in scoring_settings.score_categories},
+                    scoring_settings,
+                )
 
-    return {"message": "success", "scores": scores}
+        # essays without any category are finished right away
+        yield from finished()
+        for future in as_completed(batch_futures):
+            for essay, score in future.result().items():
+                category_scores[essay][batch_futures[future]] = score
+            yield from finished()
 
 
 def encode_image(image_path):
@@ -218,11 +1223,7 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode("utf-8")
 
 
-def score_essay_with_vision(
-    essay: str, image_path: str, scoring_settings: ScoreSettings
-) -> dict:
-    base64_image = encode_image(image_path)
-
+def _vision_prefix(scoring_settings: ScoreSettings) -> str:
     skill_prompt = ""
     output_format_prompt = ""
     for target_skill, settings in scoring_settings.score_categories.items():
@@ -243,16 +1244,15 @@ def score_essay_with_vision(
             skill_prompt += f"{one_criteria.point}点: {one_criteria.content}\n"
         skill_prompt += "\n"
 
-    if scoring_settings.words_count.additional_info:
+    if scoring_settings.words_count and scoring_settings.words_count.additional_info:
         skill_prompt += f"ワードカウント（word_count_textにワードカウントに使う文章を書いてください。）\n{scoring_settings.words_count.additional_info}\n"
         output_format_prompt += "word_count_text: 'ワードカウントに使う文章'\n"
 
     output_format_prompt += "fixed_essay: 'エッセイの修正したもの。文法を修正し、接続表現(First, Alsoなど)などを追加したり、必要であれば順番を変更してパラグラフ全体の流れを改善してください。アイデアには変更を加えないでください。単語はオリジナルの英文と同じものをできるだけ使って、文構造もシンプルなものだけを使ってください(CEFR: A1-A2)。'\n"
     output_format_prompt += "comments:\n    - 'エッセイの内容についてクリティカルなミスがあれば、改善点を一文でアドバイス。また、明らかな文法ミスについても3文以内で理由も含めて[具体的な]なアドバイス。「例えば」などを使って具体的な改善案を示してください。(アドバイスごとにリストにしてください。語彙や文構造の豊富さについてはアドバイスしないでください。）'"
 
-    prompt = f"""生徒のエッセイの内容と構成を日本語で採点してください。アウトプットをコードでパースするので、アウトプットのYAMLフォーマットに厳格に従ってください。
-# OCR結果（誤りがある可能性あり）
-{essay}
+    # the OCR result is added after the output format by CompiledScoreSettings.vision_prompt
+    return f"""生徒のエッセイの内容と構成を日本語で採点してください。アウトプットをコードでパースするので、アウトプットのYAMLフォーマットに厳格に従ってください。
 
 # トピック
 {scoring_settings.topic}
@@ -268,30 +1268,97 @@ def score_essay_with_vision(
 {output_format_prompt}
 
 """
-    response = client.chat.completions.create(
-        model="gpt-4-vision-preview",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
+
+
+def _ocr_words_count(essay: str, scoring_settings: CompiledScoreSettings) -> Optional[int]:
+    # words of the OCR text without the excluded opening, None when the text is too garbled to count
+    # or the opening is not found
+    essay = scoring_settings.strip_excluded_opening(essay)
+    if essay is None:
+        return None
+    tokens = [token.strip(WORD_PUNCTUATION) for token in essay.split()]
+    tokens = [token for token in tokens if token]
+    words_count = sum(1 for token in tokens if WORD_PATTERN.fullmatch(token))
+    if tokens and words_count < len(tokens) * MIN_WORD_SHARE:
+        return None
+    return words_count
+
+
+def _vision_preflight(
+    essay: str, scoring_settings: CompiledScoreSettings, tolerance: float
+) -> tuple[Optional[dict], bool]:
+    """
+    Checks the word count of the OCR text before the vision request. Returns (result, settled):
+    the result when the essay is rejected without the request, and whether the count needs no check by the vision model.
+    Counts within tolerance (a share of the limit) of min or max are left to the vision model, as OCR adds and drops words.
+    A blank text has no words, a garbled one or one without the excluded opening is always left to the vision model.
+    """
+    words_count_settings = scoring_settings.words_count
+    if not words_count_settings or not (words_count_settings.min or words_count_settings.max):
+        return None, True
+    words_count = _ocr_words_count(essay, scoring_settings)
+    if words_count is None:
+        return None, False
+
+    settled = True
+    if words_count_settings.min:
+        if words_count < words_count_settings.min * (1 - tolerance):
+            return _rejected_result("too few words", scoring_settings), True
+        settled = settled and words_count >= words_count_settings.min * (1 + tolerance)
+    if words_count_settings.max:
+        if words_count > words_count_settings.max * (1 + tolerance):
+            return _rejected_result("too many words", scoring_settings), True
+        settled = settled and words_count <= words_count_settings.max * (1 - tolerance)
+    return None, settled
+
+
+def score_essay_with_vision(
+    essay: str,
+    image_path: str,
+    scoring_settings: ScoreSettings,
+    token_logger: Optional[TokenLogger] = None,
+    image_settings: Optional[ImageSettings] = None,
+    word_count_tolerance: float = WORD_COUNT_TOLERANCE,
+) -> dict:
+    """
+    The scan is preprocessed and cached by encode_image_url (see ImageSettings).
+    With the response cache of openai_utils enabled, scoring the same scan and essay again is answered from the cache
+    without uploading the scan (the cache key holds the content hash of the scan instead of its data).
+    essay is the OCR text of the scan. Essays clearly too short or too long by its word count are rejected
+    without the vision request, and only word counts within word_count_tolerance of the limits are checked
+    with the word count of the vision model (see _vision_preflight).
+    """
+    scoring_settings = compile_score_settings(scoring_settings)
+    rejected, words_count_settled = _vision_preflight(essay, scoring_settings, word_count_tolerance)
+    if rejected:
+        return rejected
+
+    image_url = encode_image_url(image_path, image_settings)
+    prompt = scoring_settings.vision_prompt(essay)
+    request = dict(model="gpt-4-vision-preview", max_tokens=2000, temperature=0, seed=SEED)
+    image_hash = hashlib.sha256(image_url.encode("utf-8")).hexdigest()
+    cache_key, content = _cache_lookup({**request, "prompt": prompt, "image_sha256": image_hash}, token_logger)
+    if content is None:
+        response = _chat_completion(
+            token_logger=token_logger,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url,
+                            },
                         },
-                    },
-                ],
-            }
-        ],
-        max_tokens=2000,
-        temperature=0,
-        seed=SEED,
-    )
-    print(prompt)
-    print(response.choices[0].message.content)
-    result_dict = yaml.safe_load(response.choices[0].message.content)
-    print(result_dict)
+                    ],
+                }
+            ],
+            **request,
+        )
+        content = response.choices[0].message.content
+    result_dict = yaml.safe_load(content)
     scores = {}
 
     for category, info in result_dict.items():
@@ -303,43 +1370,24 @@ def score_essay_with_vision(
             continue
         result_dict[category]["score"] = int(info["score"])
 
-    if scoring_settings.words_count:
-        word_count_text = result_dict["word_count_text"].split(" ")
-        words_count = len(word_count_text)
+    if scoring_settings.words_count and not words_count_settled:
+        # the word_count_text of the vision model is only asked for with additional_info
+        if "word_count_text" in result_dict:
+            words_count = len(str(result_dict["word_count_text"]).split(" "))
+        else:
+            words_count = len(essay.split(" "))
         if (
             scoring_settings.words_count.min
             and words_count < scoring_settings.words_count.min
         ):
-            scores = {
-                target_skill.value: 0
-                for target_skill, setting in scoring_settings.score_categories.items()
-            }
-            scores["total"] = 0
-            return {"message": "too few words", "scores": scores}
+            return _rejected_result("too few words", scoring_settings)
         if (
             scoring_settings.words_count.max
             and words_count > scoring_settings.words_count.max
         ):
-            scores = {
-                target_skill.value: 0
-                for target_skill, setting in scoring_settings.score_categories.items()
-            }
-            scores["total"] = 0
-            return {"message": "too many words", "scores": scores}
-
-    scores["words_penalty"] = -penalty_by_word_count(
-        essay,
-        {
-            subtraction.words_more_than: subtraction.subtract_points
-            for subtraction in scoring_settings.words_count.subtractions
-            if isinstance(subtraction, SubtractionWithWordsMoreThan)
-        },
-        {
-            subtraction.words_less_than: subtraction.subtract_points
-            for subtraction in scoring_settings.words_count.subtractions
-            if isinstance(subtraction, SubtractionWithWordsLessThan)
-        },
-    )
+            return _rejected_result("too many words", scoring_settings)
+
+    scores["words_penalty"] = scoring_settings.words_penalty(essay)
 
     score_dict = {
         category: info
@@ -363,6 +1411,8 @@ def score_essay_with_vision(
             warnings.warn(f"Invalid score for {category}: {info['score']}")
             raise ValueError(f"Invalid score for {category}: {info['score']}")
 
+    # only a valid output is cached
+    _cache_store(cache_key, content)
     return {
         "message": "success",
         "scores": scores,
@@ -0,0 +1,139 @@
+import base64
+import hashlib
+import io
+import warnings
+from typing import Optional
+
+from pydantic import BaseModel
+
+from tensaku.utils.cache import CacheBackend, InMemoryCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # without Pillow the scans are sent as they are, with a warning
+    Image = None
+    ImageOps = None
+
+# the vision model fits a high detail image into 2048x2048 and then scales its short side down to 768
+VISION_MAX_LONG_SIDE = 2048
+VISION_MAX_SHORT_SIDE = 768
+# number of encoded scans kept by image_cache
+IMAGE_CACHE_SIZE = 64
+
+# leading bytes of the formats accepted by the vision model
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+}
+
+
+class ImageSettings(BaseModel):
+    """
+    Preprocessing of the scans sent to the vision model. Needs Pillow (a dependency of tensaku), without it the scans are only encoded.
+    """
+
+    preprocess: bool = True
+    grayscale: bool = True
+    crop_margins: bool = True
+    # pixels brighter than this are paper, the photo is cropped to them first (the desk around the page)
+    paper_threshold: int = 180
+    # pixels darker than this are ink, the page is cropped to them (the blank margins)
+    ink_threshold: int = 160
+    # kept around the cropped text, as a share of the image size
+    margin_padding: float = 0.02
+    max_long_side: int = VISION_MAX_LONG_SIDE
+    max_short_side: int = VISION_MAX_SHORT_SIDE
+    jpeg_quality: int = 80
+
+
+# encoded scans by content hash of the file and the settings
+image_cache: CacheBackend = InMemoryCache(max_size=IMAGE_CACHE_SIZE)
+
+
+def detect_image_format(data: bytes) -> Optional[str]:
+    # mime type of the image, None if it is not a format the vision model accepts
+    for signature, mime_type in IMAGE_SIGNATURES.items():
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def _crop_to(image, box: Optional[tuple[int, int, int, int]], padding: int):
+    if box is None:
+        return image
+    left, top, right, bottom = box
+    return image.crop((
+        max(left - padding, 0), max(top - padding, 0),
+        min(right + padding, image.width), min(bottom + padding, image.height),
+    ))
+
+
+def _crop_margins(image, settings: ImageSettings):
+    padding = round(max(image.size) * settings.margin_padding)
+    paper = image.convert("L").point(lambda value: 255 if value > settings.paper_threshold else 0).getbbox()
+    # a dim photo has no bright page, only a few bright spots
+    if paper and (paper[2] - paper[0]) * (paper[3] - paper[1]) >= image.width * image.height / 4:
+        image = _crop_to(image, paper, 0)
+    ink = image.convert("L").point(lambda value: 255 if value < settings.ink_threshold else 0)
+    # a blank page is kept as it is
+    return _crop_to(image, ink.getbbox(), padding)
+
+
+def preprocess_image(data: bytes, settings: Optional[ImageSettings] = None) -> tuple[bytes, str]:
+    """
+    Returns (image, mime type). The image is rotated by its EXIF orientation, cropped to the text, converted to grayscale,
+    scaled down to the resolution the vision model uses and saved as JPEG.
+    Without Pillow (with a warning), or with settings.preprocess off, the image is returned as it is.
+    """
+    settings = settings or ImageSettings()
+    mime_type = detect_image_format(data)
+    if Image is None and settings.preprocess:
+        warnings.warn("Pillow is not installed, the scan is sent at full resolution without preprocessing (pip install pillow)")
+    if Image is None or not settings.preprocess:
+        if mime_type is None:
+            raise ValueError("Unsupported image format, the vision model accepts PNG, JPEG, GIF and WEBP")
+        return data, mime_type
+
+    try:
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    except OSError:
+        if mime_type is None:
+            raise ValueError("Unsupported image format, the vision model accepts PNG, JPEG, GIF and WEBP")
+        return data, mime_type
+
+    image = image.convert("L" if settings.grayscale else "RGB")
+    if settings.crop_margins:
+        image = _crop_margins(image, settings)
+
+    scale = min(1.0, settings.max_long_side / max(image.size), settings.max_short_side / min(image.size))
+    if scale < 1.0:
+        image = image.resize((max(round(image.width * scale), 1), max(round(image.height * scale), 1)), Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=settings.jpeg_quality, optimize=True)
+    return output.getvalue(), "image/jpeg"
+
+
+def encode_image_url(image_path: str, settings: Optional[ImageSettings] = None, cache: Optional[CacheBackend] = image_cache) -> str:
+    """
+    data URL of the preprocessed image for the image_url part of a vision request.
+    The URL is cached by the content of the file, so scoring the same scan again skips the preprocessing.
+    score_essay_with_vision keys the response cache of openai_utils by the hash of the URL, so with the cache enabled
+    the same scan is not uploaded again.
+    """
+    settings = settings or ImageSettings()
+    with open(image_path, "rb") as image_file:
+        data = image_file.read()
+
+    cache_key = hashlib.sha256(data + settings.model_dump_json().encode("utf-8")).hexdigest()
+    url = cache.get(cache_key) if cache is not None else None
+    if url is None:
+        image, mime_type = preprocess_image(data, settings)
+        url = f"data:{mime_type};base64,{base64.b64encode(image).decode('utf-8')}"
+        if cache is not None:
+            cache.set(cache_key, url)
+    return url
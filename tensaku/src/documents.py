@@ -5,6 +5,8 @@ from typing import List
 from typing import Type, Optional
 from dataclasses import dataclass, field, asdict
 
+from tensaku.utils.pipeline import StageTiming
+from tensaku.src.edit_classifier.alignment import EditSpan
 
 
 class TensakuDocument(ABC):
@@ -86,18 +88,33 @@ class SentenceExplanationDocument(TensakuDocument):
     mistake_explanations: List[MistakeExplanationDocument]
     japanese: bool
     complement_comment: Optional[str] = None
+    # offsets of the explained changes, the changed words are shown in bold
+    spans: List[EditSpan] = field(default_factory=list)
 
 
     def generate_html(self):
         mistake_explanations_html = "".join([mistake_explanation.generate_html() for mistake_explanation in self.mistake_explanations])
         complement_comment_html = f"<p class='body-text'>{self.complement_comment}</p>" if self.complement_comment else ""
+        original_html = _mark_spans(self.original_sentence, [(span.original_start, span.original_end) for span in self.spans])
+        edited_html = _mark_spans(self.edited_sentence, [(span.corrected_start, span.corrected_end) for span in self.spans])
         return f"""<div class='box'>
-                        <p class='body-text'><span class='highlight'>{self.original_sentence}</span></p>
-                        <p class='body-text'><span class='corrected'>{self.edited_sentence}</span></p>{mistake_explanations_html}
+                        <p class='body-text'><span class='highlight'>{original_html}</span></p>
+                        <p class='body-text'><span class='corrected'>{edited_html}</span></p>{mistake_explanations_html}
                         {complement_comment_html}
                     </div>"""
 
 
+def _mark_spans(sentence: str, offsets: List[tuple[int, int]]) -> str:
+    # a part that overlaps an already marked one is not marked again
+    html = ""
+    position = 0
+    for start, end in sorted(offsets):
+        if start < position or start == end:
+            continue
+        html += f"{sentence[position:start]}<b>{sentence[start:end]}</b>"
+        position = end
+    return html + sentence[position:]
+
 
 
 
@@ -443,6 +460,10 @@ class AllTensakuDocument(TensakuDocument):
     quizzes: QuizzesDocument
     total_cost: int = 0
     VERSION: str = "0.0.1"
+    # start and end time of each generation stage (correction, mistakes, explanations, ...)
+    stage_timings: dict[str, StageTiming] = field(default_factory=dict)
+    # TokenLogger.summary() of the request: tokens, cost, latency and cache hits in total, by stage and by model
+    usage: dict = field(default_factory=dict)
 
     def generate_dict(self) -> dict:
         sentence_wise_explanations_list = []
@@ -474,4 +495,9 @@ class AllTensakuDocument(TensakuDocument):
             "comment": self.comment,
             "sentence_wise_explanations": sentence_wise_explanations_list,
             "quizzes": self.quizzes,
+            "stage_timings": {
+                name: {"start": timing.start, "end": timing.end}
+                for name, timing in self.stage_timings.items()
+            },
+            "usage": self.usage,
         }
@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+from typing import List, Optional
+import re
+
+# words (with an apostrophe part like don't, I'm) and single punctuation marks
+TOKEN_PATTERN = re.compile(r"\w+(?:['’]\w+)*|[^\w\s]")
+
+
+@dataclass
+class Token():
+    text: str
+    start: int  # character offset in the sentence
+    end: int
+
+
+@dataclass
+class EditSpan():
+    """
+    One edit between an original and a corrected sentence, with character offsets into both sentences.
+    original[original_start:original_end] was replaced by corrected[corrected_start:corrected_end].
+    """
+    before: str
+    after: str
+    original_start: int
+    original_end: int
+    corrected_start: int
+    corrected_end: int
+
+
+def tokenize(sentence: str) -> List[Token]:
+    return [Token(match.group(), match.start(), match.end()) for match in TOKEN_PATTERN.finditer(sentence)]
+
+
+def is_unchanged(original: str, corrected: str) -> bool:
+    # only whitespace differs
+    return [token.text for token in tokenize(original)] == [token.text for token in tokenize(corrected)]
+
+
+def align(original: str, corrected: str) -> List[EditSpan]:
+    """
+    Token-level diff of a sentence pair. Insertions and deletions are widened by one neighbouring token,
+    so that both sides of every span are non empty ("went to there" -> "went there" gives "to there -> there").
+    """
+    original_tokens = tokenize(original)
+    corrected_tokens = tokenize(corrected)
+    matcher = SequenceMatcher(
+        a=[token.text for token in original_tokens], b=[token.text for token in corrected_tokens], autojunk=False
+    )
+
+    spans = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if i1 == i2 or j1 == j2:
+            # widen to the next token, or to the previous one at the end of the sentence
+            if i2 < len(original_tokens) and j2 < len(corrected_tokens):
+                i2, j2 = i2 + 1, j2 + 1
+            elif i1 > 0 and j1 > 0:
+                i1, j1 = i1 - 1, j1 - 1
+        if spans and (spans[-1][1] > i1 or spans[-1][3] > j1):
+            # the widened span reaches into the previous edit, merge them
+            previous = spans.pop()
+            i1, j1 = previous[0], previous[2]
+        spans.append((i1, i2, j1, j2))
+
+    return [_edit_span(original, corrected, original_tokens, corrected_tokens, *span) for span in spans]
+
+
+def locate_change(original: str, corrected: str, before: str, after: str) -> Optional[EditSpan]:
+    """
+    Character offsets of a "before -> after" change (e.g. from the classifier) in the sentence pair.
+    None when before or after can not be found.
+    """
+    before, after = before.strip(), after.strip()
+    original_start = _find_word(original, before)
+    corrected_start = _find_word(corrected, after)
+    if original_start is None or corrected_start is None:
+        return None
+    return EditSpan(
+        before=before,
+        after=after,
+        original_start=original_start,
+        original_end=original_start + len(before),
+        corrected_start=corrected_start,
+        corrected_end=corrected_start + len(after),
+    )
+
+
+def _find_word(sentence: str, text: str) -> Optional[int]:
+    if text == "":
+        return None
+    match = re.search(r"(?<!\w)" + re.escape(text) + r"(?!\w)", sentence)
+    if match is None:
+        match = re.search(re.escape(text), sentence, flags=re.I)
+    return match.start() if match else None
+
+
+def _edit_span(original: str, corrected: str, original_tokens: List[Token], corrected_tokens: List[Token],
+               i1: int, i2: int, j1: int, j2: int) -> EditSpan:
+    original_start, original_end = _offsets(original_tokens, i1, i2)
+    corrected_start, corrected_end = _offsets(corrected_tokens, j1, j2)
+    return EditSpan(
+        before=original[original_start:original_end],
+        after=corrected[corrected_start:corrected_end],
+        original_start=original_start,
+        original_end=original_end,
+        corrected_start=corrected_start,
+        corrected_end=corrected_end,
+    )
+
+
+def _offsets(tokens: List[Token], start: int, end: int) -> tuple[int, int]:
+    if start == end:  # nothing on this side even after widening (one of the sentences is empty)
+        offset = tokens[start].start if start < len(tokens) else (tokens[-1].end if tokens else 0)
+        return offset, offset
+    return tokens[start].start, tokens[end - 1].end
@@ -1,14 +1,22 @@
 from dataclasses import dataclass, field
 from abc import ABC, abstractmethod
-from typing import Type, List
+from typing import Type, List, Optional
 import re
 from enum import Enum, auto
+import asyncio
+import warnings
 
 
-from tensaku.utils.openai_utils import create_chat, GPTConfig, TokenLogger
+from tensaku.utils.openai_utils import create_chat, acreate_chat, GPTConfig, TokenLogger, ParsingError
+from tensaku.utils.rate_limit import estimate_text_tokens
 from tensaku.utils.utils import concat_examples
-from tensaku.utils.utils import paragraph2sentences
+from tensaku.utils.utils import paragraph2sentences, split_by_token_budget
 from tensaku.src.essay import Essay
+from tensaku.src.edit_classifier.alignment import EditSpan, align, is_unchanged, locate_change
+from tensaku.src.edit_classifier.spelling import split_spelling_fixes
+
+# tokens of sentence pairs sent in one essay-level request. Longer essays are split into several requests.
+DEFAULT_CHUNK_TOKEN_BUDGET = 1000
 
 
 class MistakeType(str, Enum):
@@ -48,10 +56,12 @@ class Mistake():
     corrected_sentence: str
     type: MistakeType
     change: ChangeReplace #TODO convert it to union when you add more change types
+    span: Optional[EditSpan] = None  # character offsets of the change in both sentences, None if it was not found
 
     def get_change_prompt(self):
         return self.change.get_change_prompt()
 
+
 class Classifier():
     initial_conversation = [
         {"role": "system", "content": "You are a English teacher. Classify student's mistakes. Try to split the mistake into small chunks as much as possible. Detect all the mistakes."},
@@ -91,21 +101,172 @@ Edited: This movie is known to everyone in Japan."""},
         {"role": "assistant", "content": """is knowing -> is known (Grammar)"""}
     ]
 
-    def __init__(self):
-        return
+    # same instructions, but several numbered sentence pairs are classified in one request
+    essay_initial_conversation = initial_conversation[:2] + [
+        {"role": "user", "content": """Several numbered pairs can be given at once. Answer every pair under its number, and write "No mistakes" when there is nothing to classify.
+
+1.
+Original: This movie is knowing to everyone in Japan.
+Edited: This movie is known to everyone in Japan.
+2.
+Original: I like dogs.
+Edited: I like dogs.
+3.
+Original: She don't like swiming.
+Edited: She doesn't like swimming."""},
+        {"role": "assistant", "content": """1.
+is knowing -> is known (Grammar)
+2.
+No mistakes
+3.
+don't -> doesn't (Grammar)
+swiming -> swimming (Spelling)"""}
+    ]
+
+    essay_gpt_config = GPTConfig(model="gpt-4", max_tokens=1500)
+
+    def __init__(self, detect_spelling_locally: bool = False):
+        # spelling fixes found with the bundled word list become Spelling mistakes without asking GPT.
+        # off by default: a real word missing from the list (e.g. "fell -> feel") would be taken for a misspelling
+        self.detect_spelling_locally = detect_spelling_locally
 
 
     def classify(self, original_sentence: str, corrected_sentence: str, print_prompt = False, token_logger: TokenLogger = None) -> List[Type[Mistake]]:
 
-        messages = self.initial_conversation + [{"role": "user", "content": f"Original: {original_sentence}\nEdited: {corrected_sentence}"}]
+        local_mistakes, needs_gpt = self.classify_locally(original_sentence, corrected_sentence)
+        if not needs_gpt:
+            return local_mistakes
+
+        messages = self._messages(original_sentence, corrected_sentence)
         completion = create_chat(messages=messages, gpt_config = GPTConfig(model="gpt-4"), token_logger=token_logger)
         mistakes = self._gptoutput2mistakes(completion, original_sentence, corrected_sentence)
 
-        return mistakes
+        return self._merge_local(local_mistakes, mistakes)
+
+    async def aclassify(self, original_sentence: str, corrected_sentence: str, print_prompt = False, token_logger: TokenLogger = None) -> List[Type[Mistake]]:
+
+        local_mistakes, needs_gpt = self.classify_locally(original_sentence, corrected_sentence)
+        if not needs_gpt:
+            return local_mistakes
+
+        messages = self._messages(original_sentence, corrected_sentence)
+        completion = await acreate_chat(messages=messages, gpt_config = GPTConfig(model="gpt-4"), token_logger=token_logger)
+        mistakes = self._gptoutput2mistakes(completion, original_sentence, corrected_sentence)
+
+        return self._merge_local(local_mistakes, mistakes)
+
+    def classify_locally(self, original_sentence: str, corrected_sentence: str) -> tuple[List[Mistake], bool]:
+        """
+        Mistakes found without any API call, and whether the sentence still has to be sent to GPT.
+        Unchanged sentences have no mistakes. A sentence whose edits are all confident spelling fixes is not sent either.
+        """
+        if is_unchanged(original_sentence, corrected_sentence):
+            return [], False
+        if not self.detect_spelling_locally:
+            return [], True
+
+        spelling_spans, other_spans = split_spelling_fixes(original_sentence, corrected_sentence)
+        mistakes = [
+            Mistake(original_sentence=original_sentence,
+                    corrected_sentence=corrected_sentence,
+                    type=MistakeType.SPELLING,
+                    change=ChangeReplace(span.before, span.after),
+                    span=span)
+            for span in spelling_spans
+        ]
+        return mistakes, len(other_spans) > 0
+
+    def classify_chunk(self, sentence_pairs: List[tuple[str, str]], token_logger: TokenLogger = None) -> List[List[Mistake]]:
+        """
+        One numbered request for all the changed pairs. Falls back to classify for each pair when the output can not be parsed.
+        """
+        local = [self.classify_locally(original, corrected) for original, corrected in sentence_pairs]
+        changed = [index for index, (_, needs_gpt) in enumerate(local) if needs_gpt]
+        changed_pairs = [sentence_pairs[index] for index in changed]
+        if len(changed_pairs) <= 1:
+            return self._merge_changed([self.classify(*pair, token_logger=token_logger) for pair in changed_pairs], changed, local)
+
+        completion = create_chat(messages=self._essay_messages(changed_pairs), gpt_config=self.essay_gpt_config, token_logger=token_logger)
+        try:
+            mistakes = [
+                self._merge_local(local[index][0], sentence_mistakes)
+                for index, sentence_mistakes in zip(changed, self._essay_output2mistakes(completion, changed_pairs))
+            ]
+        except ParsingError as e:
+            warnings.warn(f"{e}\nThe sentences are classified one by one.")
+            mistakes = [self.classify(original, corrected, token_logger=token_logger) for original, corrected in changed_pairs]
+        return self._merge_changed(mistakes, changed, local)
+
+    async def aclassify_chunk(self, sentence_pairs: List[tuple[str, str]], token_logger: TokenLogger = None) -> List[List[Mistake]]:
+        local = [self.classify_locally(original, corrected) for original, corrected in sentence_pairs]
+        changed = [index for index, (_, needs_gpt) in enumerate(local) if needs_gpt]
+        changed_pairs = [sentence_pairs[index] for index in changed]
+        if len(changed_pairs) <= 1:
+            return self._merge_changed([await self.aclassify(*pair, token_logger=token_logger) for pair in changed_pairs], changed, local)
+
+        completion = await acreate_chat(messages=self._essay_messages(changed_pairs), gpt_config=self.essay_gpt_config, token_logger=token_logger)
+        try:
+            mistakes = [
+                self._merge_local(local[index][0], sentence_mistakes)
+                for index, sentence_mistakes in zip(changed, self._essay_output2mistakes(completion, changed_pairs))
+            ]
+        except ParsingError as e:
+            warnings.warn(f"{e}\nThe sentences are classified one by one.")
+            mistakes = list(await asyncio.gather(*[
+                self.aclassify(original, corrected, token_logger=token_logger) for original, corrected in changed_pairs
+            ]))
+        return self._merge_changed(mistakes, changed, local)
+
+    @staticmethod
+    def _merge_changed(mistakes: List[List[Mistake]], changed: List[int], local: List[tuple[List[Mistake], bool]]) -> List[List[Mistake]]:
+        # sentences that were not sent to GPT keep their local mistakes
+        all_mistakes = [local_mistakes for local_mistakes, _ in local]
+        for index, sentence_mistakes in zip(changed, mistakes):
+            all_mistakes[index] = sentence_mistakes
+        return all_mistakes
+
+    @staticmethod
+    def _merge_local(local_mistakes: List[Mistake], gpt_mistakes: List[Mistake]) -> List[Mistake]:
+        # GPT also sees the spelling fixes of the sentence, keep only one mistake per change, in sentence order
+        local_changes = {mistake.get_change_prompt() for mistake in local_mistakes}
+        mistakes = local_mistakes + [mistake for mistake in gpt_mistakes if mistake.get_change_prompt() not in local_changes]
+        if not local_mistakes:
+            return mistakes
+        return sorted(mistakes, key=lambda mistake: mistake.span.original_start if mistake.span else len(mistake.original_sentence))
+
+    @staticmethod
+    def split_into_chunks(sentence_pairs: List[tuple[str, str]], token_budget: int = DEFAULT_CHUNK_TOKEN_BUDGET) -> List[List[tuple[str, str]]]:
+        return split_by_token_budget(
+            sentence_pairs, lambda pair: estimate_text_tokens(pair[0]) + estimate_text_tokens(pair[1]), token_budget
+        )
+
+    def _essay_messages(self, sentence_pairs: List[tuple[str, str]]) -> list[dict]:
+        content = "\n".join(
+            f"{index + 1}.\nOriginal: {original}\nEdited: {corrected}"
+            for index, (original, corrected) in enumerate(sentence_pairs)
+        )
+        return self.essay_initial_conversation + [{"role": "user", "content": content}]
+
+    def _essay_output2mistakes(self, gpt_output: str, sentence_pairs: List[tuple[str, str]]) -> List[List[Mistake]]:
+        # split the output at the "1." "2." ... lines
+        parts = re.split(r'^\s*(\d+)\.\s*$', gpt_output.strip(), flags=re.M)
+        answers = {int(number): answer for number, answer in zip(parts[1::2], parts[2::2])}
+        if parts[0].strip() != "" or sorted(answers) != list(range(1, len(sentence_pairs) + 1)):
+            raise ParsingError(f"Failed to parse the classification of {len(sentence_pairs)} sentences. GPT output: \n{gpt_output}")
+
+        return [
+            self._gptoutput2mistakes(answers[index + 1], original, corrected)
+            for index, (original, corrected) in enumerate(sentence_pairs)
+        ]
+
+    def _messages(self, original_sentence: str, corrected_sentence: str) -> list[dict]:
+        return self.initial_conversation + [{"role": "user", "content": f"Original: {original_sentence}\nEdited: {corrected_sentence}"}]
 
     def _gptoutput2mistakes(self, gpt_output, original_sentence, corrected_sentence):
 
         mistakes = []
+        # the changes GPT gives usually are the edits of the local diff, which also tells which occurrence of a repeated word was changed
+        aligned_spans = {(span.before, span.after): span for span in reversed(align(original_sentence, corrected_sentence))}
 
         for match in re.finditer(r'(.+?)\s*->\s*(.+?)\s*\((.+?)\)', gpt_output):
             before = match.group(1)
@@ -119,7 +280,8 @@ Edited: This movie is known to everyone in Japan."""},
                 mistake = Mistake(original_sentence=original_sentence,
                                         corrected_sentence=corrected_sentence,
                                         type=mistake_type,
-                                        change=change)
+                                        change=change,
+                                        span=aligned_spans.get((before, after)) or locate_change(original_sentence, corrected_sentence, before, after))
 
                 mistakes.append(mistake)
 
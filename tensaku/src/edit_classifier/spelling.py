@@ -0,0 +1,118 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional
+import re
+
+from tensaku.src.edit_classifier.alignment import EditSpan, align
+
+WORDS_PATH = Path(__file__).parent / "data" / "english_words.txt"
+
+WORD_PATTERN = re.compile(r"[A-Za-z]+(?:['’][A-Za-z]+)*")
+VOWELS = set("aeiou")
+
+
+@lru_cache(maxsize=None)
+def load_words(path: Path = WORDS_PATH) -> frozenset[str]:
+    """
+    The bundled word list with the regular inflections of every word. Read once, on first use.
+    Some generated forms are not real words ("goed", "childs"). That only makes the detector more careful,
+    because a misspelling has to be an unknown word.
+    """
+    words = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            word = line.strip().lower()
+            if word == "" or word.startswith("#"):
+                continue
+            words.add(word)
+            words.update(_inflections(word))
+    return frozenset(words)
+
+
+def is_known_word(word: str) -> bool:
+    return word.lower().replace("’", "'") in load_words()
+
+
+def edit_distance(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """
+    Damerau-Levenshtein distance (optimal string alignment, so "recieve" -> "receive" is 1).
+    With max_distance it stops early and returns max_distance + 1 once the distance is known to be larger.
+    """
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous_previous, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def is_spelling_fix(before: str, after: str) -> bool:
+    """
+    True when "before -> after" is confidently a spelling mistake: one unknown word replaced by a known word that is
+    spelled almost the same. Capitalization only changes, real words replaced by other real words (then -> than)
+    and wrong inflections (goed -> went) are left to GPT.
+    """
+    before, after = before.strip(), after.strip()
+    if not WORD_PATTERN.fullmatch(before) or not WORD_PATTERN.fullmatch(after):
+        return False
+    if before.lower() == after.lower():
+        return False
+    if is_known_word(before) or not is_known_word(after):
+        return False
+
+    max_distance = 1 if len(after) <= 5 else 2
+    return edit_distance(before.lower(), after.lower(), max_distance) <= max_distance
+
+
+def split_spelling_fixes(original_sentence: str, corrected_sentence: str) -> tuple[List[EditSpan], List[EditSpan]]:
+    """
+    Splits the edits of a sentence pair into confident spelling fixes and the other edits.
+    """
+    spelling_spans, other_spans = [], []
+    for span in align(original_sentence, corrected_sentence):
+        if is_spelling_fix(span.before, span.after):
+            spelling_spans.append(span)
+        else:
+            other_spans.append(span)
+    return spelling_spans, other_spans
+
+
+def _inflections(word: str) -> List[str]:
+    if not word.isalpha():
+        return []
+
+    # only the correct stem, so that common misspellings like "makeing" or "swiming" stay unknown words
+    stems = [word]
+    if word.endswith("e") and not word.endswith(("ee", "oe", "ye")):
+        stems = [word[:-1]]  # make -> making, nice -> nicer
+    if word.endswith("ie"):
+        stems.append(word[:-2] + "y")  # lie -> lying
+    if len(word) >= 3 and word[-1] not in VOWELS | set("wxy") and word[-2] in VOWELS and word[-3] not in VOWELS:
+        doubled = word + word[-1]  # stop -> stopped, big -> bigger
+        # one syllable words always double the consonant, longer ones depend on the stress (visiting, beginning)
+        stems = [doubled] if len(re.findall(r"[aeiouy]+", word)) == 1 else [word, doubled]
+
+    forms = [stem + ending for stem in stems for ending in ("ed", "ing", "er", "est")]
+    forms += [word + "s", word + "es", word + "ly", word + "ness", word + "ment"]
+    if word.endswith("e"):
+        forms += [word + "d", word + "r", word + "st"]  # liked, nicer, nicest
+    if word.endswith("y") and len(word) > 2 and word[-2] not in VOWELS:
+        forms += [word[:-1] + ending for ending in ("ies", "ied", "ier", "iest", "ily", "iness")]
+    if word.endswith("le"):
+        forms.append(word[:-1] + "y")  # gentle -> gently
+    if word.endswith("ic"):
+        forms.append(word + "ally")  # basic -> basically
+    if word.endswith("f"):
+        forms.append(word[:-1] + "ves")
+    if word.endswith("fe"):
+        forms.append(word[:-2] + "ves")
+    return forms
@@ -1,8 +1,18 @@
-from tensaku.utils.openai_utils import create_chat, GPTConfig, TokenLogger
+from tensaku.utils.openai_utils import create_chat, acreate_chat, GPTConfig, TokenLogger
+from tensaku.utils.rate_limit import estimate_text_tokens
+from tensaku.utils.utils import split_by_token_budget
 from tensaku.src.explanation_generator.generatorbase import ExplanationGenerator
 from tensaku.src.documents import MistakeExplanationDocument
 
-from typing import List
+from typing import List, Optional
+import asyncio
+import dataclasses
+import re
+
+# completion tokens reserved for one explanation (the same as max_tokens of a single request)
+EXPLANATION_TOKENS = 500
+# estimated prompt + completion tokens of the mistakes packed into one batched request
+DEFAULT_BATCH_TOKEN_BUDGET = 3000
 
 class GeneralGenerator(ExplanationGenerator):
 
@@ -60,7 +70,30 @@ getは、もっと一般的で広い意味を持ち、物や情報、状況な
 # この場合、import restrictions は名詞句なので、because of が適切な接続詞となります。due to も because of と同じ意味なので使うことができます。"""}
      ]
 
+    batch_instruction = """複数の間違いが番号付きで与えられた場合は、それぞれの間違いを[1]、[2]のように同じ番号の後に1つずつ解説してください。
+
+[1]
+Original: I feels happy.
+Edited: I feel happy.
+feels -> feel
+
+[2]
+Original: I went to there yesterday.
+Edited: I went there yesterday.
+to there -> there"""
+
+    batch_example_answer = """[1]
+主語がIのときは、動詞に三人称単数の s をつけません。feels ではなく feel が正しい形です。
+- I feel tired.
+- She feels tired.
+
+[2]
+there は「そこへ」という意味の副詞なので、前置詞 to は不要です。
+- I went there last week.
+- I want to go there again."""
+
     gpt_config = GPTConfig(model="gpt-4")
+    supports_batch = True
 
     def __init__(self, japanese: bool = True) -> None:
         """
@@ -70,10 +103,85 @@ getは、もっと一般的で広い意味を持ち、物や情報、状況な
 
     def generate(self, original: str, edited: str, change: str, token_logger: TokenLogger = None) -> MistakeExplanationDocument:
 
-        messages = self.initial_conversation + [{
+        messages = self._messages(original, edited, change)
+        result = create_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger)
+        return self._to_document(result)
+
+    async def agenerate(self, original: str, edited: str, change: str, token_logger: TokenLogger = None) -> MistakeExplanationDocument:
+
+        messages = self._messages(original, edited, change)
+        result = await acreate_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger)
+        return self._to_document(result)
+
+    def generate_batch(self, mistakes: list[tuple[str, str, str]], token_logger: TokenLogger = None) -> list[MistakeExplanationDocument]:
+        """
+        Explains several (original, edited, change) in one numbered request.
+        Mistakes whose explanation can not be parsed are explained on their own.
+        """
+        if len(mistakes) == 1:
+            return [self.generate(*mistakes[0], token_logger=token_logger)]
+
+        result = create_chat(messages=self._batch_messages(mistakes), gpt_config=self._batch_gpt_config(len(mistakes)), token_logger=token_logger)
+        explanations = self._parse_batch(result, len(mistakes))
+        return [
+            self._to_document(explanation) if explanation else self.generate(*mistake, token_logger=token_logger)
+            for mistake, explanation in zip(mistakes, explanations)
+        ]
+
+    async def agenerate_batch(self, mistakes: list[tuple[str, str, str]], token_logger: TokenLogger = None) -> list[MistakeExplanationDocument]:
+        if len(mistakes) == 1:
+            return [await self.agenerate(*mistakes[0], token_logger=token_logger)]
+
+        result = await acreate_chat(messages=self._batch_messages(mistakes), gpt_config=self._batch_gpt_config(len(mistakes)), token_logger=token_logger)
+        explanations = self._parse_batch(result, len(mistakes))
+
+        async def to_document(mistake, explanation):
+            if explanation:
+                return self._to_document(explanation)
+            return await self.agenerate(*mistake, token_logger=token_logger)
+
+        return list(await asyncio.gather(*[to_document(mistake, explanation) for mistake, explanation in zip(mistakes, explanations)]))
+
+    @staticmethod
+    def split_into_batches(mistakes: list, token_budget: int = DEFAULT_BATCH_TOKEN_BUDGET, key=lambda mistake: mistake) -> list[list]:
+        # key returns the (original, edited, change) of an item
+        return split_by_token_budget(
+            mistakes,
+            lambda mistake: sum(estimate_text_tokens(text) for text in key(mistake)) + EXPLANATION_TOKENS,
+            token_budget,
+        )
+
+    def _batch_gpt_config(self, n_mistakes: int) -> GPTConfig:
+        return dataclasses.replace(self.gpt_config, max_tokens=self.gpt_config.max_tokens * n_mistakes)
+
+    def _batch_messages(self, mistakes: list[tuple[str, str, str]]) -> list[dict]:
+        content = "\n\n".join(
+            f"[{index + 1}]\nOriginal: {original}\nEdited: {edited}\n{change}"
+            for index, (original, edited, change) in enumerate(mistakes)
+        )
+        return self.initial_conversation + [
+            {"role": "user", "content": self.batch_instruction},
+            {"role": "assistant", "content": self.batch_example_answer},
+            {"role": "user", "content": content},
+        ]
+
+    @staticmethod
+    def _parse_batch(result: str, n_mistakes: int) -> list[Optional[str]]:
+        # explanation of each mistake, None when it is missing
+        parts = re.split(r'^\s*\[(\d+)\]\s*$', result, flags=re.M)
+        explanations = [None for _ in range(n_mistakes)]
+        for number, explanation in zip(parts[1::2], parts[2::2]):
+            index = int(number) - 1
+            if 0 <= index < n_mistakes and explanation.strip() and explanations[index] is None:
+                explanations[index] = explanation.strip()
+        return explanations
+
+    def _messages(self, original: str, edited: str, change: str) -> list[dict]:
+        return self.initial_conversation + [{
             "role": "user", "content": f"Original: {original}\nEdited: {edited}\n{change}"
         }]
-        result = create_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger)
+
+    def _to_document(self, result: str) -> MistakeExplanationDocument:
         if not self.japanese:
             return MistakeExplanationDocument('Grammar', f"[engish not implemented yet. showing jaoanese version]\n\n{result}", self.japanese)
 
@@ -1,9 +1,28 @@
 from abc import ABC, abstractmethod
+import asyncio
 from tensaku.src.documents import MistakeExplanationDocument
 
 # mistake type to Enum
 
 class ExplanationGenerator(ABC):
+    # True when generate_batch explains several mistakes in one request
+    supports_batch = False
+
     @abstractmethod
     def generate(self, original_sentence, edited_sentence, change) -> MistakeExplanationDocument:
-        pass
\ No newline at end of file
+        pass
+
+    async def agenerate(self, original_sentence, edited_sentence, change, **kwargs) -> MistakeExplanationDocument:
+        # Generators without a native async implementation run in a worker thread, so the event loop is never blocked.
+        return await asyncio.to_thread(self.generate, original_sentence, edited_sentence, change, **kwargs)
+
+    def generate_batch(self, mistakes: list[tuple[str, str, str]], **kwargs) -> list[MistakeExplanationDocument]:
+        """
+        mistakes: [(original_sentence, edited_sentence, change)]
+        """
+        return [self.generate(original_sentence, edited_sentence, change, **kwargs) for original_sentence, edited_sentence, change in mistakes]
+
+    async def agenerate_batch(self, mistakes: list[tuple[str, str, str]], **kwargs) -> list[MistakeExplanationDocument]:
+        return list(await asyncio.gather(*[
+            self.agenerate(original_sentence, edited_sentence, change, **kwargs) for original_sentence, edited_sentence, change in mistakes
+        ]))
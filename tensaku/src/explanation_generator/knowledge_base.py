@@ -0,0 +1,126 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from typing import Optional
+
+from tensaku.src.documents import MistakeExplanationDocument
+
+# changes with more words than this depend on their sentence, they are neither stored nor served
+DEFAULT_MAX_CHANGE_WORDS = 4
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def normalize_change(change: str) -> str:
+    """
+    "Because  -> because of." and "because -> Because of" give the same key "because -> because of".
+    Only case, quotes, whitespace and punctuation around the words are normalized. The words themselves are kept,
+    "feels -> feel" and "feel -> feels" are different mistakes.
+    """
+    before, _, after = change.partition("->")
+    return f"{_normalize_words(before)} -> {_normalize_words(after)}"
+
+
+def _normalize_words(text: str) -> str:
+    text = text.lower().replace("’", "'").replace("‘", "'")
+    text = re.sub(r"\s+", " ", text)
+    return text.strip().strip(".,!?;:\"'").strip()
+
+
+class ExplanationKnowledgeBase():
+    """
+    Persistent store of explanations keyed by the normalized change, the mistake type and the generator.
+    The same short change made by another student in another sentence gets the stored explanation instead of a new request.
+    A new entry starts with one use and every hit increments it. Beyond max_entries the least used entries
+    (the least recently used first among equal counts) are evicted, never the entry that was just stored.
+    """
+
+    def __init__(
+        self,
+        path: str = "tensaku_explanations.sqlite3",
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_change_words: int = DEFAULT_MAX_CHANGE_WORDS,
+    ) -> None:
+        assert max_entries >= 1, "max_entries must be at least 1"
+        self.path = path
+        self.max_entries = max_entries
+        self.max_change_words = max_change_words
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS explanations ("
+                "key TEXT PRIMARY KEY, document TEXT NOT NULL, uses INTEGER NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS explanations_eviction ON explanations (uses, last_used_at)")
+
+    def make_key(self, change: str, mistake_type: str, generator_name: str, japanese: bool) -> Optional[str]:
+        # None when the change is too long to be explained without its sentence
+        normalized = normalize_change(change)
+        before, _, after = normalized.partition(" -> ")
+        if max(len(before.split()), len(after.split())) > self.max_change_words:
+            return None
+        return json.dumps([normalized, str(mistake_type), generator_name, japanese], ensure_ascii=False)
+
+    def get(self, key: Optional[str]) -> Optional[MistakeExplanationDocument]:
+        if key is None:
+            return None
+        with self._lock:
+            row = self._connection.execute("SELECT document FROM explanations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE explanations SET uses = uses + 1, last_used_at = ? WHERE key = ?", (time.time(), key)
+                )
+        return MistakeExplanationDocument(**json.loads(row[0]))
+
+    def set(self, key: Optional[str], document: MistakeExplanationDocument) -> None:
+        if key is None:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO explanations (key, document, uses, created_at, last_used_at) VALUES (?, ?, 1, ?, ?)",
+                (key, json.dumps(asdict(document), ensure_ascii=False), now, now),
+            )
+            self._evict(key)
+
+    def _evict(self, new_key: str) -> None:
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM explanations").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM explanations WHERE key IN "
+                "(SELECT key FROM explanations WHERE key != ? ORDER BY uses, last_used_at LIMIT ?)",
+                (new_key, count - self.max_entries),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM explanations").fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "entries": len(self)}
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM explanations")
+
+    def close(self) -> None:
+        self._connection.close()
@@ -15,3 +15,6 @@ class SpellingGenerator(ExplanationGenerator):
             return MistakeExplanationDocument('Grammar', f"スペルを修正しました。 {change}" , self.japanese)
         else:
             return MistakeExplanationDocument('Grammar', f"There is a spelling mistake. {change}" , self.japanese)
+
+    async def agenerate(self, original, edited, change, token_logger: TokenLogger = None):
+        return self.generate(original, edited, change, token_logger=token_logger)
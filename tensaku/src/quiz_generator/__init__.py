@@ -1 +1,2 @@
-from tensaku.src.quiz_generator.generator import QuizGenerator
\ No newline at end of file
+from tensaku.src.quiz_generator.generator import QuizGenerator, QuizEligibility
+from tensaku.src.quiz_generator.quiz_bank import QuizBank
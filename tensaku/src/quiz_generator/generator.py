@@ -1,8 +1,34 @@
-from tensaku.utils.openai_utils import create_chat, GPTConfig
+from tensaku.utils.openai_utils import create_chat, acreate_chat, GPTConfig, TokenLogger
 from tensaku.src.documents import FreeAnswerQuizDocument, MultipleChoiceQuizDocument
-from tensaku.utils.utils import run_function_in_small_batches
+from tensaku.src.quiz_generator.quiz_bank import QuizBank
+from tensaku.utils.utils import run_function_in_small_batches, arun_function_in_small_batches, parallel_map, aparallel_map, iterate_sections, aiterate_sections, DEFAULT_MAX_WORKERS
+from functools import partial
+from typing import Optional, Iterator, AsyncIterator
+from enum import Enum
+import asyncio
+import contextvars
+import dataclasses
+import queue
+import re
+import threading
+import warnings
 
 MAX_MISTAKES_PER_PROMPT = 3
+QUIZ_SEPARATOR = '---'
+# the examples of the prompt are numbered 1 to 3, the student's mistakes continue from 4
+QUIZ_NUMBER_OFFSET = 4
+# written instead of a quiz in the single pass mode
+SKIP = 'SKIP'
+
+
+class QuizEligibility(str, Enum):
+    """
+    How QuizGenerator decides which mistakes get a quiz.
+    """
+    CHECK = 'check'  # a Yes/No request with examples before the generation
+    CONSTRAINED = 'constrained'  # one Y/N letter per mistake from a cheaper model, a few tokens long
+    SINGLE_PASS = 'single_pass'  # no separate request, the generation writes SKIP for the mistakes without a quiz
+
 
 class QuizGenerator():
     
@@ -91,38 +117,255 @@ Questions:
 4. He was kind [not only to man but also] to animals. (彼は人ばかりでなく動物に対しても親切であった。)"""}
     ]
     
+    constrained_check_instruction = """Answer with one letter per mistake in the order of the numbers: Y if a quiz should be created and N if not. Do not write anything else."""
+
+    # max_tokens is set by the number of mistakes
+    constrained_check_gpt_config = GPTConfig(model="gpt-3.5-turbo", max_tokens=1)
+
+    single_pass_instruction = f"""A valid quiz can not be created from every mistake. When the two words are interchangeable (amazing -> incredible), or when the mistake is about articles (a -> the), write only the number of the mistake and {SKIP} instead of the quiz, and separate it with --- as usual.
+
+4
+{SKIP}
+---
+5
+Aim: ..."""
+
     gpt_config = GPTConfig(model="gpt-4", max_tokens=1500)
         
-    def __init__(self, japanese: bool = True) -> None:
+    def __init__(
+        self,
+        japanese: bool = True,
+        quiz_bank: Optional[QuizBank] = None,
+        max_concurrency: int = DEFAULT_MAX_WORKERS,
+        eligibility: QuizEligibility = QuizEligibility.CHECK,
+    ) -> None:
         """
         non japanese not implemented yet
+        quiz_bank: serve the stored quizzes of recurring mistakes and store the new ones.
+        max_concurrency: number of batches of mistakes sent to GPT at the same time.
+        eligibility: how the mistakes that get a quiz are chosen, see QuizEligibility.
         """
         self.japanese = japanese
+        self.quiz_bank = quiz_bank
+        self.max_concurrency = max_concurrency
+        self.eligibility = QuizEligibility(eligibility)
     
-    def generate(self, mistakes: list[dict]) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+    def generate(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
         """
         mistakes: [{"original": "I got a lot of results.", "edited": "I achieved a lot of results.", "change": "got -> achieved"}]
         """
-        check_if_quiz_should_be_created = run_function_in_small_batches(self.check_if_quiz_should_be_created_small_batch, mistakes, MAX_MISTAKES_PER_PROMPT)
-        mistakes = [mistake for mistake, should_be_created in zip(mistakes, check_if_quiz_should_be_created) if should_be_created]
-        quizzes = run_function_in_small_batches(self.quizzes_from_small_batch_of_mistakes, mistakes,  MAX_MISTAKES_PER_PROMPT)
-            
-        return quizzes
+        banked_quizzes, mistakes = self._banked_quizzes(self._unique_mistakes(mistakes))
+        return banked_quizzes + self._generate_new(mistakes, token_logger)
+
+    def _generate_new(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+        # both passes send their batches in parallel, a failed batch only loses its own quizzes
+        mistakes = self._eligible_mistakes(mistakes, token_logger)
+        return run_function_in_small_batches(
+            partial(self.quizzes_from_small_batch_of_mistakes, token_logger=token_logger), mistakes, MAX_MISTAKES_PER_PROMPT,
+            max_workers=self.max_concurrency, on_error=self._skip_failed_quizzes,
+        )
+
+    async def agenerate(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+        """
+        mistakes: [{"original": "I got a lot of results.", "edited": "I achieved a lot of results.", "change": "got -> achieved"}]
+        """
+        banked_quizzes, mistakes = self._banked_quizzes(self._unique_mistakes(mistakes))
+        mistakes = await self._aeligible_mistakes(mistakes, token_logger)
+        quizzes = await arun_function_in_small_batches(
+            partial(self.aquizzes_from_small_batch_of_mistakes, token_logger=token_logger), mistakes, MAX_MISTAKES_PER_PROMPT,
+            max_concurrency=self.max_concurrency, on_error=self._skip_failed_quizzes,
+        )
+
+        return banked_quizzes + quizzes
+
+    @staticmethod
+    def _unique_mistakes(mistakes: list[dict]) -> list[dict]:
+        # the same change in several sentences gets one quiz
+        unique_mistakes = {}
+        for mistake in mistakes:
+            unique_mistakes.setdefault(mistake["change"].strip(), mistake)
+        return list(unique_mistakes.values())
+
+    def _eligible_mistakes(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[dict]:
+        if self.eligibility == QuizEligibility.SINGLE_PASS:
+            return mistakes
+        check = self.check_if_quiz_should_be_created_small_batch
+        if self.eligibility == QuizEligibility.CONSTRAINED:
+            check = self.constrained_check_small_batch
+        check_if_quiz_should_be_created = run_function_in_small_batches(
+            partial(check, token_logger=token_logger), mistakes, MAX_MISTAKES_PER_PROMPT,
+            max_workers=self.max_concurrency, on_error=self._skip_failed_check,
+        )
+        return [mistake for mistake, should_be_created in zip(mistakes, check_if_quiz_should_be_created) if should_be_created]
+
+    async def _aeligible_mistakes(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[dict]:
+        if self.eligibility == QuizEligibility.SINGLE_PASS:
+            return mistakes
+        check = self.acheck_if_quiz_should_be_created_small_batch
+        if self.eligibility == QuizEligibility.CONSTRAINED:
+            check = self.aconstrained_check_small_batch
+        check_if_quiz_should_be_created = await arun_function_in_small_batches(
+            partial(check, token_logger=token_logger), mistakes, MAX_MISTAKES_PER_PROMPT,
+            max_concurrency=self.max_concurrency, on_error=self._skip_failed_check,
+        )
+        return [mistake for mistake, should_be_created in zip(mistakes, check_if_quiz_should_be_created) if should_be_created]
+
+    @staticmethod
+    def _skip_failed_check(mistakes: list[dict], error: Exception) -> list[bool]:
+        warnings.warn(f"error checking if quiz should be created, the quizzes are skipped: {error!r}")
+        return [False for _ in mistakes]
+
+    @staticmethod
+    def _skip_failed_quizzes(mistakes: list[dict], error: Exception) -> list:
+        warnings.warn(f"error creating quizzes, the quizzes are skipped: {error!r}")
+        return []
+
+    def prefill_bank(self, n: int, token_logger: Optional[TokenLogger] = None) -> int:
+        """
+        Offline job: generates the quizzes of the n most frequent patterns of the quiz bank that have none yet.
+        Patterns can be counted from past essays with quiz_bank.observe(mistakes). Returns the number of new quizzes.
+        Only the patterns GPT answered No or SKIP for are marked without a quiz, the patterns of a failed batch are tried again
+        by the next prefill.
+        """
+        assert self.quiz_bank is not None, "prefill_bank needs a quiz_bank"
+        n_quizzes = len(self.quiz_bank)
+        self._generate_new(self.quiz_bank.most_frequent_patterns(n), token_logger)
+        return len(self.quiz_bank) - n_quizzes
+
+    def _banked_quizzes(self, mistakes: list[dict]) -> tuple[list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument], list[dict]]:
+        # stored quizzes of the known patterns (each title once), and the mistakes that are new to the quiz bank
+        if self.quiz_bank is None:
+            return [], mistakes
+
+        quizzes, titles, new_mistakes = [], set(), []
+        for mistake in mistakes:
+            stored_quizzes = self.quiz_bank.lookup(mistake)
+            if stored_quizzes is None:
+                new_mistakes.append(mistake)
+                continue
+            for quiz in stored_quizzes:
+                if quiz.title not in titles:
+                    titles.add(quiz.title)
+                    quizzes.append(quiz)
+        return quizzes, new_mistakes
+
+    def _bank_quizzes(self, mistakes: list[dict], result: str) -> None:
+        # stores each quiz of a completion under the mistake of its number
+        if self.quiz_bank is None:
+            return
+        for section in result.split(QUIZ_SEPARATOR):
+            lines = section.strip().split('\n')
+            if not lines[0].strip().isdigit():
+                continue
+            index = int(lines[0]) - QUIZ_NUMBER_OFFSET
+            if not 0 <= index < len(mistakes):
+                continue
+            if [line.strip() for line in lines[1:]] == [SKIP]:
+                self.quiz_bank.mark_without_quiz(mistakes[index])
+                continue
+            try:
+                quizzes = self._parse_quiz_string(section)
+            except Exception:
+                continue
+            for quiz in quizzes:
+                self.quiz_bank.add(mistakes[index], quiz)
     
-    def check_if_quiz_should_be_created_small_batch(self, mistakes: list[dict]) -> list[bool]:
+    def generate_stream(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> Iterator[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+        """
+        Same as generate, but streams the quiz completions and yields each quiz as soon as its section is complete.
+        The batches are streamed at the same time, so the quizzes are yielded in the order they are completed.
+        """
+        banked_quizzes, mistakes = self._banked_quizzes(self._unique_mistakes(mistakes))
+        yield from banked_quizzes
+        mistakes = self._eligible_mistakes(mistakes, token_logger)
+        quizzes = queue.Queue()
+        # set when the caller stops iterating, the batches that have not started are not sent
+        stop = threading.Event()
+
+        def stream_batch(batch):
+            if stop.is_set():
+                return
+            messages = self._quiz_messages(batch)
+            deltas = create_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger, stream=True)
+            for section in iterate_sections(deltas, QUIZ_SEPARATOR):
+                if stop.is_set():
+                    return
+                self._bank_quizzes(batch, section)
+                for quiz in self._section_to_quizzes(section, messages):
+                    quizzes.put(quiz)
+
+        def stream_all():
+            try:
+                batches = [mistakes[i:i + MAX_MISTAKES_PER_PROMPT] for i in range(0, len(mistakes), MAX_MISTAKES_PER_PROMPT)]
+                parallel_map(stream_batch, batches, max_workers=self.max_concurrency, on_error=self._skip_failed_quizzes)
+            finally:
+                quizzes.put(None)
+
+        threading.Thread(target=contextvars.copy_context().run, args=(stream_all,), daemon=True).start()
+        try:
+            while (quiz := quizzes.get()) is not None:
+                yield quiz
+        finally:
+            stop.set()
+
+    async def agenerate_stream(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> AsyncIterator[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+        """
+        asyncio version of generate_stream.
+        """
+        banked_quizzes, mistakes = self._banked_quizzes(self._unique_mistakes(mistakes))
+        for quiz in banked_quizzes:
+            yield quiz
+        mistakes = await self._aeligible_mistakes(mistakes, token_logger)
+        quizzes = asyncio.Queue()
+
+        async def stream_batch(batch):
+            messages = self._quiz_messages(batch)
+            deltas = await acreate_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger, stream=True)
+            async for section in aiterate_sections(deltas, QUIZ_SEPARATOR):
+                self._bank_quizzes(batch, section)
+                for quiz in self._section_to_quizzes(section, messages):
+                    quizzes.put_nowait(quiz)
+
+        async def stream_all():
+            try:
+                batches = [mistakes[i:i + MAX_MISTAKES_PER_PROMPT] for i in range(0, len(mistakes), MAX_MISTAKES_PER_PROMPT)]
+                await aparallel_map(stream_batch, batches, max_concurrency=self.max_concurrency, on_error=self._skip_failed_quizzes)
+            finally:
+                quizzes.put_nowait(None)
+
+        task = asyncio.ensure_future(stream_all())
+        try:
+            while (quiz := await quizzes.get()) is not None:
+                yield quiz
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+
+    def check_if_quiz_should_be_created_small_batch(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[bool]:
         """
         mistakes: [{"original": "I got a lot of results.", "edited": "I achieved a lot of results.", "change": "got -> achieved"}]
         """
+        messages = self._check_messages(mistakes)
+        result = create_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger)
+        return self._check_result_to_list(result, messages, mistakes)
+
+    async def acheck_if_quiz_should_be_created_small_batch(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[bool]:
+        messages = self._check_messages(mistakes)
+        result = await acreate_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger)
+        return self._check_result_to_list(result, messages, mistakes)
+
+    def _check_messages(self, mistakes: list[dict]) -> list[dict]:
         mistakes_string = ""
         for index, mistake in enumerate(mistakes):
             mistakes_string += f'{index + 1}.\n{mistake["original"]}\n{mistake["edited"]}\n{mistake["change"]}\n'
         print(mistakes_string)
         
-        messages = self.check_initial_conversation + [{
+        return self.check_initial_conversation + [{
             "role": "user", "content": mistakes_string
         }]
-        result = create_chat(messages=messages, gpt_config=self.gpt_config)
-        
+
+    def _check_result_to_list(self, result: str, messages: list[dict], mistakes: list[dict]) -> list[bool]:
         try:
             quiz_should_be_created = self._parse_quiz_should_be_created_string(result)
         except Exception as e:
@@ -145,8 +388,61 @@ Questions:
             print("mistakes: ")
             print(mistakes)
             quiz_should_be_created = [False for _ in mistakes]
+        else:
+            self._mark_without_quiz(mistakes, quiz_should_be_created)
             
         return quiz_should_be_created
+
+    def _mark_without_quiz(self, mistakes: list[dict], quiz_should_be_created: list[bool]) -> None:
+        if self.quiz_bank is None:
+            return
+        for mistake, should_be_created in zip(mistakes, quiz_should_be_created):
+            if not should_be_created:
+                self.quiz_bank.mark_without_quiz(mistake)
+
+    def constrained_check_small_batch(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[bool]:
+        """
+        Same as check_if_quiz_should_be_created_small_batch, but the answer is one letter per mistake from a cheaper model.
+        Falls back to the full check when the answer can not be parsed.
+        """
+        messages = self._constrained_check_messages(mistakes)
+        result = create_chat(messages=messages, gpt_config=self._constrained_check_gpt_config(len(mistakes)), token_logger=token_logger)
+        quiz_should_be_created = self._parse_constrained_check(result, len(mistakes))
+        if quiz_should_be_created is None:
+            return self.check_if_quiz_should_be_created_small_batch(mistakes, token_logger=token_logger)
+        self._mark_without_quiz(mistakes, quiz_should_be_created)
+        return quiz_should_be_created
+
+    async def aconstrained_check_small_batch(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[bool]:
+        messages = self._constrained_check_messages(mistakes)
+        result = await acreate_chat(messages=messages, gpt_config=self._constrained_check_gpt_config(len(mistakes)), token_logger=token_logger)
+        quiz_should_be_created = self._parse_constrained_check(result, len(mistakes))
+        if quiz_should_be_created is None:
+            return await self.acheck_if_quiz_should_be_created_small_batch(mistakes, token_logger=token_logger)
+        self._mark_without_quiz(mistakes, quiz_should_be_created)
+        return quiz_should_be_created
+
+    def _constrained_check_messages(self, mistakes: list[dict]) -> list[dict]:
+        system, example, _ = self.check_initial_conversation
+        return [
+            {"role": "system", "content": f"{system['content']}\n\n{self.constrained_check_instruction}"},
+            example,
+            {"role": "assistant", "content": "NYN"},
+            self._check_messages(mistakes)[-1],
+        ]
+
+    def _constrained_check_gpt_config(self, n_mistakes: int) -> GPTConfig:
+        # room for a separator between the letters
+        return dataclasses.replace(self.constrained_check_gpt_config, max_tokens=2 * n_mistakes)
+
+    @staticmethod
+    def _parse_constrained_check(result: str, n_mistakes: int) -> Optional[list[bool]]:
+        # None when the answer is not exactly one Y/N per mistake, the mistakes then get the full check
+        letters = re.sub(r'[\s,.\d]', '', result.upper())
+        if not re.fullmatch(f'[YN]{{{n_mistakes}}}', letters):
+            warnings.warn(f"error parsing the constrained quiz check, the full check is used instead: {result!r}")
+            return None
+        return [letter == 'Y' for letter in letters]
     
     def _parse_quiz_should_be_created_string(self, result: str) -> list[bool]:
         result = result.strip()
@@ -159,18 +455,37 @@ Questions:
                 quiz_should_be_created.append(False)
         return quiz_should_be_created
 
-    def quizzes_from_small_batch_of_mistakes(self, mistakes: list[dict]) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+    def quizzes_from_small_batch_of_mistakes(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
         """
         mistakes: [{"original": "I got a lot of results.", "edited": "I achieved a lot of results.", "change": "got -> achieved"}]
         """
+        messages = self._quiz_messages(mistakes)
+        result = create_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger)
+        self._bank_quizzes(mistakes, result)
+        return self._quiz_result_to_list(result, messages)
+
+    async def aquizzes_from_small_batch_of_mistakes(self, mistakes: list[dict], token_logger: Optional[TokenLogger] = None) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+        messages = self._quiz_messages(mistakes)
+        result = await acreate_chat(messages=messages, gpt_config=self.gpt_config, token_logger=token_logger)
+        self._bank_quizzes(mistakes, result)
+        return self._quiz_result_to_list(result, messages)
+
+    def _quiz_messages(self, mistakes: list[dict]) -> list[dict]:
         mistakes_string = ""
         for index, mistake in enumerate(mistakes):
-            mistakes_string += f'{mistake["original"]}\n{mistake["edited"]}\n{index + 4} {mistake["change"]}\n\n'
+            mistakes_string += f'{mistake["original"]}\n{mistake["edited"]}\n{index + QUIZ_NUMBER_OFFSET} {mistake["change"]}\n\n'
         
-        messages = self.initial_conversation + [{
+        instruction = []
+        if self.eligibility == QuizEligibility.SINGLE_PASS:
+            instruction = [
+                {"role": "user", "content": self.single_pass_instruction},
+                {"role": "assistant", "content": "Understood."},
+            ]
+        return self.initial_conversation + instruction + [{
             "role": "user", "content": mistakes_string
         }]
-        result = create_chat(messages=messages, gpt_config=self.gpt_config)
+
+    def _quiz_result_to_list(self, result: str, messages: list[dict]) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
         try:
             quizzes = self._parse_quiz_string(result)
         except Exception as e:
@@ -184,6 +499,12 @@ Questions:
             
         return quizzes
     
+    def _section_to_quizzes(self, section: str, messages: list[dict]) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+        # one section of a streamed completion. A broken section is skipped instead of dropping every quiz.
+        if section.strip() == "":
+            return []
+        return self._quiz_result_to_list(section, messages)
+
     @staticmethod
     def _parse_quiz_string(quiz_string: str):
         quiz_list = []
@@ -196,7 +517,7 @@ Questions:
                 lines = lines[1:]
                 quiz_section = '\n'.join(lines)
             if len(lines) < 2:
-                pass
+                continue  # e.g. SKIP
             
             quiz_type = lines[1].split(': ')[1].strip()     
 
@@ -0,0 +1,142 @@
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from typing import Optional
+
+from tensaku.src.documents import FreeAnswerQuizDocument, MultipleChoiceQuizDocument
+from tensaku.src.explanation_generator.knowledge_base import normalize_change
+
+MULTIPLE_CHOICE = "multiple-choice"
+FILL_IN_THE_BLANK = "fill-in-the-blank"
+
+
+class QuizBank():
+    """
+    Persistent store of generated quizzes, indexed by the mistake pattern (the normalized change) and the quiz title.
+    Quizzes are generalized and do not use the words of the student's sentence,
+    so a stored quiz can be served to every student who makes the same mistake.
+    The bank also counts how often each pattern was seen, which QuizGenerator.prefill_bank uses to pre-generate quizzes.
+    """
+
+    def __init__(self, path: str = "tensaku_quizzes.sqlite3") -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            # has_quiz: NULL not generated yet, 0 no quiz can be created for the pattern, 1 quizzes are stored
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS patterns ("
+                "pattern TEXT PRIMARY KEY, original TEXT NOT NULL, edited TEXT NOT NULL, change TEXT NOT NULL, "
+                "count INTEGER NOT NULL, has_quiz INTEGER)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS quizzes ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, pattern TEXT NOT NULL, title TEXT NOT NULL, kind TEXT NOT NULL, "
+                "document TEXT NOT NULL, uses INTEGER NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS quizzes_pattern ON quizzes (pattern)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS quizzes_title ON quizzes (title)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS patterns_count ON patterns (has_quiz, count)")
+
+    def lookup(self, mistake: dict) -> Optional[list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]]:
+        """
+        mistake: {"original": ..., "edited": ..., "change": ...} as given to QuizGenerator.
+        Returns the stored quizzes of the pattern, [] when no quiz can be created for it and None when it is new.
+        Every lookup counts as one occurrence of the pattern.
+        """
+        pattern = normalize_change(mistake["change"])
+        with self._lock, self._connection:
+            self._count(pattern, mistake)
+            (has_quiz,) = self._connection.execute("SELECT has_quiz FROM patterns WHERE pattern = ?", (pattern,)).fetchone()
+            if has_quiz is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            rows = self._connection.execute("SELECT kind, document FROM quizzes WHERE pattern = ? ORDER BY id", (pattern,)).fetchall()
+            self._connection.execute("UPDATE quizzes SET uses = uses + 1 WHERE pattern = ?", (pattern,))
+        return [self._to_quiz(kind, document) for kind, document in rows]
+
+    def add(self, mistake: dict, quiz: FreeAnswerQuizDocument | MultipleChoiceQuizDocument) -> None:
+        pattern = normalize_change(mistake["change"])
+        kind = MULTIPLE_CHOICE if isinstance(quiz, MultipleChoiceQuizDocument) else FILL_IN_THE_BLANK
+        document = asdict(quiz)
+        del document["quiz_id"]  # every served copy gets a new id
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO patterns (pattern, original, edited, change, count, has_quiz) VALUES (?, ?, ?, ?, 0, 1) "
+                "ON CONFLICT (pattern) DO UPDATE SET has_quiz = 1",
+                (pattern, mistake["original"], mistake["edited"], mistake["change"]),
+            )
+            exists = self._connection.execute(
+                "SELECT 1 FROM quizzes WHERE pattern = ? AND title = ?", (pattern, quiz.title)
+            ).fetchone()
+            if exists is None:
+                self._connection.execute(
+                    "INSERT INTO quizzes (pattern, title, kind, document, uses, created_at) VALUES (?, ?, ?, ?, 0, ?)",
+                    (pattern, quiz.title, kind, json.dumps(document, ensure_ascii=False), time.time()),
+                )
+
+    def mark_without_quiz(self, mistake: dict) -> None:
+        # the eligibility check said no quiz can be created, the pattern is not checked again
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE patterns SET has_quiz = 0 WHERE pattern = ? AND has_quiz IS NULL", (normalize_change(mistake["change"]),)
+            )
+
+    def find_by_title(self, title: str) -> list[FreeAnswerQuizDocument | MultipleChoiceQuizDocument]:
+        with self._lock:
+            rows = self._connection.execute("SELECT kind, document FROM quizzes WHERE title = ? ORDER BY id", (title,)).fetchall()
+        return [self._to_quiz(kind, document) for kind, document in rows]
+
+    def most_frequent_patterns(self, n: int) -> list[dict]:
+        """
+        Example mistakes of the n most frequent patterns that were not generated yet.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT original, edited, change FROM patterns WHERE has_quiz IS NULL ORDER BY count DESC LIMIT ?", (n,)
+            ).fetchall()
+        return [{"original": original, "edited": edited, "change": change} for original, edited, change in rows]
+
+    def observe(self, mistakes: list[dict]) -> None:
+        # counts the patterns of past essays (e.g. from logs) without serving quizzes
+        with self._lock, self._connection:
+            for mistake in mistakes:
+                self._count(normalize_change(mistake["change"]), mistake)
+
+    def _count(self, pattern: str, mistake: dict) -> None:
+        self._connection.execute(
+            "INSERT INTO patterns (pattern, original, edited, change, count) VALUES (?, ?, ?, ?, 1) "
+            "ON CONFLICT (pattern) DO UPDATE SET count = count + 1",
+            (pattern, mistake["original"], mistake["edited"], mistake["change"]),
+        )
+
+    @staticmethod
+    def _to_quiz(kind: str, document: str) -> FreeAnswerQuizDocument | MultipleChoiceQuizDocument:
+        if kind == MULTIPLE_CHOICE:
+            return MultipleChoiceQuizDocument(**json.loads(document))
+        return FreeAnswerQuizDocument(**json.loads(document))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM quizzes").fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "quizzes": len(self)}
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def close(self) -> None:
+        self._connection.close()
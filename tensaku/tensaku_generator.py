@@ -10,11 +10,13 @@ from .src.explanation_generator.spelling import SpellingGenerator
 from .src.explanation_generator.unnatural import UnnaturalGenerator
 from .src.explanation_generator.wordorder import WordOrderGenerator
 from .src.explanation_generator.general import GeneralGenerator
+from .src.explanation_generator.knowledge_base import ExplanationKnowledgeBase
 
-from .src.quiz_generator import QuizGenerator
+from .src.quiz_generator import QuizGenerator, QuizBank, QuizEligibility
 
 from .src.documents import (
     SentenceExplanationDocument,
+    MistakeExplanationDocument,
     AllTensakuDocument,
     QuizzesDocument,
     NativeExplanationDocument,
@@ -22,15 +24,24 @@ from .src.documents import (
 from .src.essay import Essay
 
 
-from tensaku.utils.openai_utils import TokenLogger
+from tensaku.utils.openai_utils import RequestSlots, TokenLogger
+from tensaku.utils.pipeline import Pipeline, PipelineStopped, Stage
+from tensaku.utils.utils import RequestCoalescer, aparallel_map, parallel_map
 
-from typing import Type, List, Any, Union, Optional
+from typing import Type, List, Any, Union, Optional, Callable, Iterable, Iterator, Awaitable, AsyncIterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from enum import Enum
+import asyncio
+import contextvars
+import queue
+import threading
 from dacite import from_dict, Config
 import json
 import dataclasses
 
 
-from .src.comment_generator.comment import create_comment
+from .src.comment_generator.comment import create_comment, acreate_comment
 
 
 def validate_text(text: str, max_words=150, min_words=5):
@@ -46,19 +57,126 @@ def validate_text(text: str, max_words=150, min_words=5):
     return "OK"
 
 
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+@dataclass
+class _BatchCalls:
+    # the coalescer of one generate_batch run, its request budget is the RequestSlots the essays run in
+    generator: "TensakuGenerator"
+    coalescer: RequestCoalescer
+
+
+# set only in the threads of generate_batch, so other calls of the same generator are not affected
+_batch_calls: contextvars.ContextVar[Optional[_BatchCalls]] = contextvars.ContextVar("tensaku_batch_calls", default=None)
+
+
+class TensakuEventType(str, Enum):
+    CORRECTION = "correction"  # data: edited paragraph
+    SENTENCE_EXPLANATION = "sentence_explanation"  # data: SentenceExplanationDocument, index: sentence index
+    COMMENT_DELTA = "comment_delta"  # data: next piece of the comment text while it is generated
+    COMMENT = "comment"  # data: comment
+    NATIVE_EXAMPLE = "native_example"  # data: native paragraph
+    NATIVE_EXPRESSION = "native_expression"  # data: ExpressionDocument, index: position in the native explanation
+    NATIVE_EXPLANATION = "native_explanation"  # data: NativeExplanationDocument
+    QUIZ = "quiz"  # data: one quiz document, index: position in the quizzes
+    QUIZZES = "quizzes"  # data: list of quiz documents
+    DOCUMENT = "document"  # data: AllTensakuDocument, always the last event
+
+
+@dataclass
+class TensakuEvent():
+    type: TensakuEventType
+    data: Any
+    index: Optional[int] = None
+
+
+class _SentenceExplanationStream():
+    """
+    Emits the SentenceExplanationDocument of a sentence as soon as all of its mistakes are explained.
+    """
+
+    def __init__(
+        self,
+        generator: "TensakuGenerator",
+        original_essay: Essay,
+        corrected_essay: Essay,
+        all_mistakes: List[List[Mistake]],
+        jobs: List[tuple],
+        emit: Callable[[TensakuEvent], None],
+    ) -> None:
+        self.generator = generator
+        self.original_essay = original_essay
+        self.corrected_essay = corrected_essay
+        self.all_mistakes = all_mistakes
+        self.jobs = jobs
+        self.emit = emit
+        self.sentence_jobs = [[] for _ in all_mistakes]
+        for job_index, (sentence_index, _, _) in enumerate(jobs):
+            self.sentence_jobs[sentence_index].append(job_index)
+        self.remaining = [len(job_indexes) for job_indexes in self.sentence_jobs]
+        self.explanations = [None for _ in jobs]
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        # sentences without anything to explain are ready right away
+        for sentence_index, remaining in enumerate(self.remaining):
+            if remaining == 0:
+                self._emit_sentence(sentence_index)
+
+    def done(self, job_index: int, explanation: MistakeExplanationDocument) -> None:
+        with self._lock:
+            self.explanations[job_index] = explanation
+            sentence_index = self.jobs[job_index][0]
+            self.remaining[sentence_index] -= 1
+            ready = self.remaining[sentence_index] == 0
+        if ready:
+            self._emit_sentence(sentence_index)
+
+    def _emit_sentence(self, sentence_index: int) -> None:
+        document = self.generator._sentence_explanation_document(
+            self.original_essay.sentences[sentence_index],
+            self.corrected_essay.sentences[sentence_index],
+            self.all_mistakes[sentence_index],
+            [self.explanations[job_index] for job_index in self.sentence_jobs[sentence_index]],
+        )
+        self.emit(TensakuEvent(TensakuEventType.SENTENCE_EXPLANATION, document, index=sentence_index))
+
+
 class TensakuGenerator:
     AVAILABLE_EXPLANATION_LANGUAGES = ["ja"]
     AVAILABLE_WRITING_LANGUAGES = ["en"]
 
     def __init__(
-        self, explanation_language: str = "ja", writing_language: str = "en"
+        self,
+        explanation_language: str = "ja",
+        writing_language: str = "en",
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        essay_level_classification: bool = True,
+        batch_explanations: bool = True,
+        explanation_knowledge_base: Optional[ExplanationKnowledgeBase] = None,
+        quiz_bank: Optional[QuizBank] = None,
+        quiz_eligibility: QuizEligibility = QuizEligibility.CHECK,
+        detect_spelling_locally: bool = False,
     ) -> None:
+        """
+        max_concurrency: maximum number of GPT requests sent at the same time while
+        classifying sentences and explaining mistakes. 1 runs everything sequentially.
+        essay_level_classification: classify the mistakes of all sentences in one request (split by a token budget)
+        instead of one request per sentence.
+        batch_explanations: explain several mistakes of the essay in one request, and identical changes only once.
+        explanation_knowledge_base: reuse the stored explanation of a change that other essays already had.
+        quiz_bank: reuse the stored quizzes of recurring mistakes.
+        quiz_eligibility: how the mistakes that get a quiz are chosen (a separate check, a constrained cheap check or a single pass).
+        detect_spelling_locally: classify confident spelling fixes with the bundled word list instead of GPT (see Classifier).
+        """
         assert (
             explanation_language in self.AVAILABLE_EXPLANATION_LANGUAGES
         ), f"explanation_language must be one of {self.AVAILABLE_EXPLANATION_LANGUAGES}"
         assert (
             writing_language in self.AVAILABLE_WRITING_LANGUAGES
         ), f"writing_language must be one of {self.AVAILABLE_WRITING_LANGUAGES}"
+        assert max_concurrency >= 1, "max_concurrency must be at least 1"
         self.explanation_language = explanation_language
 
         self.japanese = (
@@ -66,6 +184,13 @@ class TensakuGenerator:
         )  # TODO This is a temporary solution. We need to make this more general.
 
         self.writing_language = writing_language
+        self.max_concurrency = max_concurrency
+        self.essay_level_classification = essay_level_classification
+        self.batch_explanations = batch_explanations
+        self.explanation_knowledge_base = explanation_knowledge_base
+        self.quiz_bank = quiz_bank
+        self.quiz_eligibility = quiz_eligibility
+        self.classifier = Classifier(detect_spelling_locally=detect_spelling_locally)
         self.all_tensaku_document = None
         self.token_logger = TokenLogger()
 
@@ -76,54 +201,355 @@ class TensakuGenerator:
         generate_comment=True,
         generate_native_example=True,
         generate_native_explanation=True,
+    ) -> AllTensakuDocument:
+        # every request gets its own ledger, so the cost of one essay is not mixed with the previous ones
+        self.token_logger = TokenLogger()
+        all_tensaku_document = self._generate(
+            essay_text,
+            generate_quiz=generate_quiz,
+            generate_comment=generate_comment,
+            generate_native_example=generate_native_example,
+            generate_native_explanation=generate_native_explanation,
+            token_logger=self.token_logger,
+        )
+        self.all_tensaku_document = all_tensaku_document
+
+        return all_tensaku_document
+
+    def generate_stream(
+        self,
+        essay_text: str,
+        generate_quiz=False,
+        generate_comment=True,
+        generate_native_example=True,
+        generate_native_explanation=True,
+    ) -> Iterator[TensakuEvent]:
+        """
+        Same as generate, but yields a TensakuEvent as soon as each part is ready
+        (correction, each sentence explanation, comment, native example, ...).
+        The last event is TensakuEventType.DOCUMENT with the whole AllTensakuDocument.
+        When the caller stops iterating, no more stages are started.
+        """
+        events = queue.Queue()
+        stop = threading.Event()
+        self.token_logger = TokenLogger()
+        token_logger = self.token_logger
+
+        def run():
+            try:
+                document = self._generate(
+                    essay_text,
+                    generate_quiz=generate_quiz,
+                    generate_comment=generate_comment,
+                    generate_native_example=generate_native_example,
+                    generate_native_explanation=generate_native_explanation,
+                    token_logger=token_logger,
+                    emit=events.put,
+                    stop=stop,
+                )
+                events.put(TensakuEvent(TensakuEventType.DOCUMENT, document))
+            except PipelineStopped:
+                pass
+            except Exception as e:
+                events.put(e)
+
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+        try:
+            while True:
+                event = events.get()
+                if isinstance(event, Exception):
+                    raise event
+                if event.type == TensakuEventType.DOCUMENT:
+                    self.all_tensaku_document = event.data
+                yield event
+                if event.type == TensakuEventType.DOCUMENT:
+                    return
+        finally:
+            stop.set()
+
+    def generate_batch(
+        self,
+        essays: Iterable[str],
+        generate_quiz=False,
+        generate_comment=True,
+        generate_native_example=True,
+        generate_native_explanation=True,
+        max_concurrency: Optional[int] = None,
+    ) -> Iterator[tuple[int, AllTensakuDocument]]:
+        """
+        Generates documents for many essays (e.g. a whole class) at once.
+        Yields (index of the essay, document) as soon as each essay is finished, so the order is not the input order.
+
+        All GPT calls of all essays share one budget of max_concurrency (defaults to self.max_concurrency)
+        simultaneous requests, and identical classification / explanation requests across essays
+        (same sentence pair, same mistake) are sent only once.
+        """
+        essays = list(essays)
+        max_concurrency = max_concurrency or self.max_concurrency
+        options = dict(
+            generate_quiz=generate_quiz,
+            generate_comment=generate_comment,
+            generate_native_example=generate_native_example,
+            generate_native_explanation=generate_native_explanation,
+        )
+
+        # every request of every essay, also those of the nested fan-outs (e.g. the quiz batches), holds a slot
+        request_slots = RequestSlots(max_concurrency)
+        batch_calls = _BatchCalls(self, RequestCoalescer())
+        with ThreadPoolExecutor(max_workers=max(len(essays), 1)) as essay_executor:
+
+            def generate(essay_text: str) -> AllTensakuDocument:
+                _batch_calls.set(batch_calls)
+                return request_slots.run(self._generate, essay_text, token_logger=TokenLogger(), **options)
+
+            futures = {
+                essay_executor.submit(contextvars.copy_context().run, generate, essay_text): index
+                for index, essay_text in enumerate(essays)
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def _generate(
+        self,
+        essay_text: str,
+        generate_quiz: bool,
+        generate_comment: bool,
+        generate_native_example: bool,
+        generate_native_explanation: bool,
+        token_logger: TokenLogger,
+        emit: Optional[Callable[[TensakuEvent], None]] = None,
+        stop: Optional[threading.Event] = None,
     ) -> AllTensakuDocument:
         # TODO Process emoji and stuff, so that any text can be split into sentences.
+        assert (
+            generate_native_example or not generate_native_explanation
+        ), "native_example must be generated if you want to generate native_explanation"
 
         essay_text = self._preprocess(essay_text)
 
-        essay, corrected_essay = CorrectionGenerator().generate(
-            essay_text, self.token_logger
+        stages = [
+            Stage("correction", lambda: CorrectionGenerator().generate(essay_text, token_logger)),
+            Stage("mistakes", lambda correction: self._generate_mistakes(*correction, token_logger), ["correction"]),
+            Stage(
+                "explanations",
+                lambda correction, mistakes: self._generate_sentence_explanation_documents(
+                    *correction, mistakes, token_logger, emit=emit
+                ),
+                ["correction", "mistakes"],
+            ),
+        ]
+        if generate_quiz:
+            stages.append(Stage(
+                "quizzes",
+                lambda correction, mistakes: self._generate_quizzes(*correction, mistakes, token_logger, emit=emit),
+                ["correction", "mistakes"],
+            ))
+        if generate_native_example:
+            stages.append(Stage(
+                "native_example",
+                lambda: NativeGenerator().generate(Essay([essay_text]), token_logger=token_logger),
+            ))
+        if generate_native_explanation:
+            stages.append(Stage(
+                "native_explanation",
+                lambda correction, native_example: self._generate_native_explanation(
+                    correction[1].paragraph, native_example.paragraph, token_logger, emit=emit
+                ),
+                ["correction", "native_example"],
+            ))
+        if generate_comment:
+            stages.append(Stage(
+                "comment", lambda: self._generate_comment(essay_text, token_logger, emit=emit)
+            ))
+
+        pipeline = Pipeline(stages)
+        pipeline.run(on_stage_done=self._stage_event_emitter(emit), stop=stop)
+        return self._build_document(pipeline, token_logger)
+
+    async def agenerate(
+        self,
+        essay_text: str,
+        generate_quiz=False,
+        generate_comment=True,
+        generate_native_example=True,
+        generate_native_explanation=True,
+    ) -> AllTensakuDocument:
+        """
+        asyncio version of generate. At most max_concurrency requests are sent at the same time.
+        """
+        self.token_logger = TokenLogger()
+        all_tensaku_document = await self._agenerate(
+            essay_text,
+            generate_quiz=generate_quiz,
+            generate_comment=generate_comment,
+            generate_native_example=generate_native_example,
+            generate_native_explanation=generate_native_explanation,
+            token_logger=self.token_logger,
         )
+        self.all_tensaku_document = all_tensaku_document
 
-        all_mistakes = self._generate_mistakes(essay, corrected_essay)
-        all_explanations = self._generate_sentence_explanation_documents(
-            essay, corrected_essay, all_mistakes
-        )
+        return all_tensaku_document
 
-        #TODO implement token logger for quizes.
-        quizzes = (
-            self._generate_quizzes(essay, corrected_essay, all_mistakes)
-            if generate_quiz
-            else []
-        )
+    async def agenerate_stream(
+        self,
+        essay_text: str,
+        generate_quiz=False,
+        generate_comment=True,
+        generate_native_example=True,
+        generate_native_explanation=True,
+    ) -> AsyncIterator[TensakuEvent]:
+        """
+        asyncio version of generate_stream.
+        """
+        events = asyncio.Queue()
+        self.token_logger = TokenLogger()
+        token_logger = self.token_logger
+
+        async def run():
+            try:
+                document = await self._agenerate(
+                    essay_text,
+                    generate_quiz=generate_quiz,
+                    generate_comment=generate_comment,
+                    generate_native_example=generate_native_example,
+                    generate_native_explanation=generate_native_explanation,
+                    token_logger=token_logger,
+                    emit=events.put_nowait,
+                )
+                events.put_nowait(TensakuEvent(TensakuEventType.DOCUMENT, document))
+            except Exception as e:
+                events.put_nowait(e)
+
+        task = asyncio.ensure_future(run())
+        try:
+            while True:
+                event = await events.get()
+                if isinstance(event, Exception):
+                    raise event
+                if event.type == TensakuEventType.DOCUMENT:
+                    self.all_tensaku_document = event.data
+                yield event
+                if event.type == TensakuEventType.DOCUMENT:
+                    return
+        finally:
+            # the consumer stopped early
+            if not task.done():
+                task.cancel()
+
+    async def _agenerate(
+        self,
+        essay_text: str,
+        generate_quiz: bool,
+        generate_comment: bool,
+        generate_native_example: bool,
+        generate_native_explanation: bool,
+        token_logger: TokenLogger,
+        emit: Optional[Callable[[TensakuEvent], None]] = None,
+    ) -> AllTensakuDocument:
+        assert (
+            generate_native_example or not generate_native_explanation
+        ), "native_example must be generated if you want to generate native_explanation"
 
-        native_example = (
-            NativeGenerator().generate(essay, token_logger=self.token_logger) if generate_native_example else None
-        )
+        essay_text = self._preprocess(essay_text)
 
+        async def correction_stage():
+            return await CorrectionGenerator().agenerate(essay_text, token_logger)
+
+        async def mistakes_stage(correction):
+            return await self._agenerate_mistakes(*correction, token_logger)
+
+        async def explanations_stage(correction, mistakes):
+            return await self._agenerate_sentence_explanation_documents(*correction, mistakes, token_logger, emit=emit)
+
+        async def quizzes_stage(correction, mistakes):
+            mistakes = self._quiz_inputs(*correction, mistakes)
+            if emit is None:
+                return await self._quiz_generator().agenerate(mistakes, token_logger=token_logger)
+            quizzes = []
+            async for quiz in self._quiz_generator().agenerate_stream(mistakes, token_logger=token_logger):
+                emit(TensakuEvent(TensakuEventType.QUIZ, quiz, index=len(quizzes)))
+                quizzes.append(quiz)
+            return quizzes
+
+        async def native_example_stage():
+            return await NativeGenerator().agenerate(Essay([essay_text]), token_logger=token_logger)
+
+        async def native_explanation_stage(correction, native_example):
+            original, edited = correction[1].paragraph, native_example.paragraph
+            if emit is None:
+                return await NativeExplanationGenerator().agenerate(
+                    original=original, edited=edited, token_logger=token_logger
+                )
+            expressions = []
+            async for expression in NativeExplanationGenerator().agenerate_stream(original, edited, token_logger=token_logger):
+                emit(TensakuEvent(TensakuEventType.NATIVE_EXPRESSION, expression, index=len(expressions)))
+                expressions.append(expression)
+            return NativeExplanationDocument(explanations=expressions, exists=original != edited)
+
+        async def comment_stage():
+            if emit is None:
+                return await acreate_comment(essay_text, token_logger=token_logger)
+            comment = ""
+            async for delta in await acreate_comment(essay_text, token_logger=token_logger, stream=True):
+                emit(TensakuEvent(TensakuEventType.COMMENT_DELTA, delta))
+                comment += delta
+            return comment.strip()
+
+        stages = [
+            Stage("correction", correction_stage),
+            Stage("mistakes", mistakes_stage, ["correction"]),
+            Stage("explanations", explanations_stage, ["correction", "mistakes"]),
+        ]
+        if generate_quiz:
+            stages.append(Stage("quizzes", quizzes_stage, ["correction", "mistakes"]))
+        if generate_native_example:
+            stages.append(Stage("native_example", native_example_stage))
         if generate_native_explanation:
-            assert (
-                native_example != None
-            ), "native_example must be generated if you want to generate native_explanation"
-            native_explanation = NativeExplanationGenerator().generate(
-                original=corrected_essay.paragraph, edited=native_example.paragraph, token_logger=self.token_logger
-            )
-        else:
-            native_explanation = None
-
-        comment = create_comment(essay.paragraph, token_logger=self.token_logger) if generate_comment else None
+            stages.append(Stage("native_explanation", native_explanation_stage, ["correction", "native_example"]))
+        if generate_comment:
+            stages.append(Stage("comment", comment_stage))
+
+        pipeline = Pipeline(stages)
+        await pipeline.arun(on_stage_done=self._stage_event_emitter(emit))
+        return self._build_document(pipeline, token_logger)
+
+    def _stage_event_emitter(
+        self, emit: Optional[Callable[[TensakuEvent], None]]
+    ) -> Optional[Callable[[str, Any], None]]:
+        # turns finished pipeline stages into events. Sentence explanations are emitted one by one by the stage itself.
+        if emit is None:
+            return None
+
+        def on_stage_done(name: str, output: Any) -> None:
+            if name == "correction":
+                emit(TensakuEvent(TensakuEventType.CORRECTION, output[1].paragraph))
+            elif name == "native_example":
+                emit(TensakuEvent(TensakuEventType.NATIVE_EXAMPLE, output.paragraph))
+            elif name == "native_explanation":
+                emit(TensakuEvent(TensakuEventType.NATIVE_EXPLANATION, output))
+            elif name == "comment":
+                emit(TensakuEvent(TensakuEventType.COMMENT, output))
+            elif name == "quizzes":
+                emit(TensakuEvent(TensakuEventType.QUIZZES, output))
+
+        return on_stage_done
+
+    def _build_document(self, pipeline: Pipeline, token_logger: TokenLogger) -> AllTensakuDocument:
+        essay, corrected_essay = pipeline.results["correction"]
+        native_example = pipeline.results.get("native_example")
 
         all_tensaku_document = AllTensakuDocument(
             original_paragraph=essay.paragraph,
             edited_paragraph=corrected_essay.paragraph,
             native_paragraph=native_example.paragraph if native_example != None else "",
-            native_explanation=native_explanation,
-            comment=comment,
-            sentence_wise_explanations=all_explanations,
-            quizzes=quizzes,
-            total_cost= self.token_logger.get_total_cost(),
+            native_explanation=pipeline.results.get("native_explanation"),
+            comment=pipeline.results.get("comment"),
+            sentence_wise_explanations=pipeline.results["explanations"],
+            quizzes=pipeline.results.get("quizzes", []),
+            total_cost= token_logger.get_total_cost(),
+            stage_timings=pipeline.timings,
+            usage=token_logger.summary(),
         )
-        self.all_tensaku_document = all_tensaku_document
 
         return all_tensaku_document
 
@@ -132,13 +558,36 @@ class TensakuGenerator:
         essay_text = essay_text.replace("\r", " ").replace("\n", " ")
         return essay_text
 
-    def _generate_quizzes(
+    def _batch_calls(self) -> Optional[_BatchCalls]:
+        # the generate_batch run of this generator that the current thread belongs to
+        batch_calls = _batch_calls.get()
+        return batch_calls if batch_calls is not None and batch_calls.generator is self else None
+
+    def _coalesce(self, key: tuple, function: Callable, *args, **kwargs):
+        # During generate_batch identical requests of different essays are sent only once.
+        batch_calls = self._batch_calls()
+        if batch_calls is None:
+            return function(*args, **kwargs)
+        return batch_calls.coalescer.run(key, function, *args, **kwargs)
+
+    def _map(self, function: Callable, items: Iterable) -> list:
+        # Run independent GPT calls concurrently. The order of the outputs follows the order of items.
+        # During generate_batch every request of the calls waits for a slot of the shared request budget.
+        return parallel_map(function, items, max_workers=self.max_concurrency)
+
+    async def _amap(self, function: Callable[[Any], Awaitable], items: Iterable) -> list:
+        # asyncio version of _map.
+        return await aparallel_map(function, items, max_concurrency=self.max_concurrency)
+
+    def _quiz_generator(self) -> QuizGenerator:
+        return QuizGenerator(quiz_bank=self.quiz_bank, max_concurrency=self.max_concurrency, eligibility=self.quiz_eligibility)
+
+    def _quiz_inputs(
         self,
         original_essay: Essay,
         corrected_essay: Essay,
         all_mistakes: List[List[Mistake]],
-    ) -> List[QuizzesDocument]:
-        generator = QuizGenerator()
+    ) -> List[dict]:
         input_dictionary_list = []
         for original_sentence, corrected_sentence, sentence_mistakes in zip(
             original_essay.sentences, corrected_essay.sentences, all_mistakes
@@ -152,10 +601,62 @@ class TensakuGenerator:
                             "change": mistake.get_change_prompt(),
                         }
                     )
-        documents = generator.generate(input_dictionary_list)
+        return input_dictionary_list
+
+    def _generate_quizzes(
+        self,
+        original_essay: Essay,
+        corrected_essay: Essay,
+        all_mistakes: List[List[Mistake]],
+        token_logger: Optional[TokenLogger] = None,
+        emit: Optional[Callable[[TensakuEvent], None]] = None,
+    ) -> List[QuizzesDocument]:
+        generator = self._quiz_generator()
+        mistakes = self._quiz_inputs(original_essay, corrected_essay, all_mistakes)
+        if emit is None:
+            return generator.generate(mistakes, token_logger=token_logger)
+
+        documents = []
+        for quiz in generator.generate_stream(mistakes, token_logger=token_logger):
+            emit(TensakuEvent(TensakuEventType.QUIZ, quiz, index=len(documents)))
+            documents.append(quiz)
 
         return documents
 
+    def _generate_native_explanation(
+        self,
+        original: str,
+        edited: str,
+        token_logger: TokenLogger,
+        emit: Optional[Callable[[TensakuEvent], None]] = None,
+    ) -> NativeExplanationDocument:
+        generator = NativeExplanationGenerator()
+        if emit is None:
+            return generator.generate(original=original, edited=edited, token_logger=token_logger)
+
+        expressions = []
+        for expression in generator.generate_stream(original, edited, token_logger=token_logger):
+            emit(TensakuEvent(TensakuEventType.NATIVE_EXPRESSION, expression, index=len(expressions)))
+            expressions.append(expression)
+
+        return NativeExplanationDocument(explanations=expressions, exists=original != edited)
+
+    def _generate_comment(
+        self,
+        essay_text: str,
+        token_logger: TokenLogger,
+        emit: Optional[Callable[[TensakuEvent], None]] = None,
+    ) -> str:
+        if emit is None:
+            return create_comment(essay_text, token_logger=token_logger)
+
+        comment = ""
+        for delta in create_comment(essay_text, token_logger=token_logger, stream=True):
+            emit(TensakuEvent(TensakuEventType.COMMENT_DELTA, delta))
+            comment += delta
+
+        return comment.strip()
+
     def _get_explanation_generator(
         self, mistake_type: MistakeType
     ) -> Optional[Type[ExplanationGenerator]]:
@@ -179,67 +680,287 @@ class TensakuGenerator:
         return generator
 
     def _generate_mistakes(
-        self, original_essay: Essay, corrected_essay: Essay
+        self, original_essay: Essay, corrected_essay: Essay, token_logger: TokenLogger
     ) -> List[List[Type[Mistake]]]:
-        all_mistakes = []
-        for original_sentence, corrected_sentence in zip(
-            original_essay.sentences, corrected_essay.sentences
-        ):
-            sentence_explanations = []
-            sentence_mistakes = Classifier().classify(
-                original_sentence, corrected_sentence, token_logger=self.token_logger
+        sentence_pairs = list(zip(original_essay.sentences, corrected_essay.sentences))
+        if self.essay_level_classification:
+            # unchanged sentences are "Perfect!" and spelling-only sentences are classified without any request
+            local = [self.classifier.classify_locally(*pair) for pair in sentence_pairs]
+            changed = [index for index, (_, needs_gpt) in enumerate(local) if needs_gpt]
+            chunk_mistakes = self._map(
+                lambda chunk: self._coalesce(
+                    ("classify_chunk", tuple(chunk)),
+                    self.classifier.classify_chunk, chunk, token_logger=token_logger
+                ),
+                Classifier.split_into_chunks([sentence_pairs[index] for index in changed]),
             )
-            all_mistakes.append(sentence_mistakes)
+            return self._merge_changed_mistakes(local, changed, chunk_mistakes)
+
+        all_mistakes = self._map(
+            lambda pair: self._coalesce(
+                ("classify", *pair),
+                self.classifier.classify, pair[0], pair[1], token_logger=token_logger
+            ),
+            sentence_pairs,
+        )
 
         return all_mistakes
 
+    async def _agenerate_mistakes(
+        self, original_essay: Essay, corrected_essay: Essay, token_logger: TokenLogger
+    ) -> List[List[Type[Mistake]]]:
+        sentence_pairs = list(zip(original_essay.sentences, corrected_essay.sentences))
+        if self.essay_level_classification:
+            local = [self.classifier.classify_locally(*pair) for pair in sentence_pairs]
+            changed = [index for index, (_, needs_gpt) in enumerate(local) if needs_gpt]
+            chunk_mistakes = await self._amap(
+                lambda chunk: self.classifier.aclassify_chunk(chunk, token_logger=token_logger),
+                Classifier.split_into_chunks([sentence_pairs[index] for index in changed]),
+            )
+            return self._merge_changed_mistakes(local, changed, chunk_mistakes)
+
+        all_mistakes = await self._amap(
+            lambda pair: self.classifier.aclassify(
+                pair[0], pair[1], token_logger=token_logger
+            ),
+            sentence_pairs,
+        )
+
+        return all_mistakes
+
+    def _merge_changed_mistakes(
+        self, local: List[tuple[List[Mistake], bool]], changed: List[int], chunk_mistakes: List[List[List[Mistake]]]
+    ) -> List[List[Mistake]]:
+        all_mistakes = [local_mistakes for local_mistakes, _ in local]
+        changed_mistakes = [mistakes for one_chunk_mistakes in chunk_mistakes for mistakes in one_chunk_mistakes]
+        for index, mistakes in zip(changed, changed_mistakes):
+            all_mistakes[index] = mistakes
+        return all_mistakes
+
+    def _explanation_jobs(
+        self, all_mistakes: List[List[Type[Mistake]]]
+    ) -> List[tuple[int, ExplanationGenerator, Mistake]]:
+        # Collect every mistake of the essay first, so that all explanations can be generated at once.
+        jobs = []
+        for sentence_index, sentence_mistakes in enumerate(all_mistakes):
+            for mistake in sentence_mistakes:
+                explanation_generator = self._get_explanation_generator(mistake.type)
+                if explanation_generator != None:
+                    jobs.append((sentence_index, explanation_generator, mistake))
+        return jobs
+
     def _generate_sentence_explanation_documents(
         self,
         original_essay: Essay,
         corrected_essay: Essay,
         all_mistakes: List[List[Type[Mistake]]],
+        token_logger: TokenLogger,
+        emit: Optional[Callable[[TensakuEvent], None]] = None,
     ) -> List[SentenceExplanationDocument]:
-        all_explanations = []
-        for original_sentence, corrected_sentence, sentence_mistakes in zip(
-            original_essay.sentences, corrected_essay.sentences, all_mistakes
-        ):
-            sentence_explanations = []
-            if sentence_mistakes == []:  # No mistake
-                all_explanations.append(
-                    SentenceExplanationDocument(
-                        original_sentence,
-                        corrected_sentence,
-                        [],
-                        self.japanese,
-                        complement_comment="Perfect!",
-                    )
-                )
+        jobs = self._explanation_jobs(all_mistakes)
+        stream = None
+        if emit is not None:
+            stream = _SentenceExplanationStream(self, original_essay, corrected_essay, all_mistakes, jobs, emit)
+            stream.start()
+
+        known = self._known_explanations(jobs)
+        self._finish_task([[job_index] for job_index in known], list(known.values()), stream)
+
+        def explain(task: List[List[int]]) -> List[MistakeExplanationDocument]:
+            explanation_generator, mistakes = self._task_mistakes(jobs, task)
+            explanations = self._coalesce(
+                ("explain", tuple((mistake.type, *self._mistake_triple(mistake)) for mistake in mistakes)),
+                explanation_generator.generate_batch,
+                [self._mistake_triple(mistake) for mistake in mistakes],
+                token_logger=token_logger,
+            )
+            self._remember_explanations(explanation_generator, mistakes, explanations)
+            self._finish_task(task, explanations, stream)
+            return explanations
+
+        tasks = self._explanation_tasks(jobs, known)
+        explanations = self._task_explanations(jobs, tasks, self._map(explain, tasks), known)
+        return self._sentence_explanation_documents(
+            original_essay, corrected_essay, all_mistakes, jobs, explanations
+        )
 
-            else:  # there is (are) mistake(s)
-                for mistake in sentence_mistakes:
-                    explanation_generator = self._get_explanation_generator(
-                        mistake.type
-                    )
+    async def _agenerate_sentence_explanation_documents(
+        self,
+        original_essay: Essay,
+        corrected_essay: Essay,
+        all_mistakes: List[List[Type[Mistake]]],
+        token_logger: TokenLogger,
+        emit: Optional[Callable[[TensakuEvent], None]] = None,
+    ) -> List[SentenceExplanationDocument]:
+        jobs = self._explanation_jobs(all_mistakes)
+        stream = None
+        if emit is not None:
+            stream = _SentenceExplanationStream(self, original_essay, corrected_essay, all_mistakes, jobs, emit)
+            stream.start()
+
+        known = self._known_explanations(jobs)
+        self._finish_task([[job_index] for job_index in known], list(known.values()), stream)
+
+        async def explain(task: List[List[int]]) -> List[MistakeExplanationDocument]:
+            explanation_generator, mistakes = self._task_mistakes(jobs, task)
+            explanations = await explanation_generator.agenerate_batch(
+                [self._mistake_triple(mistake) for mistake in mistakes], token_logger=token_logger
+            )
+            self._remember_explanations(explanation_generator, mistakes, explanations)
+            self._finish_task(task, explanations, stream)
+            return explanations
+
+        tasks = self._explanation_tasks(jobs, known)
+        explanations = self._task_explanations(jobs, tasks, await self._amap(explain, tasks), known)
+        return self._sentence_explanation_documents(
+            original_essay, corrected_essay, all_mistakes, jobs, explanations
+        )
 
-                    if explanation_generator != None:
-                        explanation = explanation_generator.generate(
-                            mistake.original_sentence,
-                            mistake.corrected_sentence,
-                            mistake.get_change_prompt(),
-                            token_logger=self.token_logger,
-                        )
-
-                        sentence_explanations.append(explanation)
-                all_explanations.append(
-                    SentenceExplanationDocument(
-                        original_sentence,
-                        corrected_sentence,
-                        sentence_explanations,
-                        self.japanese,
-                    )
+    def _explanation_tasks(
+        self, jobs: List[tuple[int, ExplanationGenerator, Mistake]], known: dict[int, MistakeExplanationDocument]
+    ) -> List[List[List[int]]]:
+        """
+        Groups the jobs into requests. A task is a list of groups of job indexes, every group is explained once.
+        Jobs in known already have an explanation from the knowledge base.
+        With batch_explanations, identical changes of the essay share one explanation,
+        and the mistakes of generators that support it are packed into batches by a token budget.
+        """
+        if not self.batch_explanations:
+            return [[[job_index]] for job_index in range(len(jobs)) if job_index not in known]
+
+        groups: dict[tuple, List[int]] = {}
+        for job_index, (_, explanation_generator, mistake) in enumerate(jobs):
+            if job_index in known:
+                continue
+            groups.setdefault((type(explanation_generator), mistake.get_change_prompt()), []).append(job_index)
+
+        tasks, batchable = [], []
+        for group in groups.values():
+            if jobs[group[0]][1].supports_batch:
+                batchable.append(group)
+            else:
+                tasks.append([group])
+        tasks.extend(GeneralGenerator.split_into_batches(
+            batchable, key=lambda group: self._mistake_triple(jobs[group[0]][2])
+        ))
+        return tasks
+
+    def _task_mistakes(
+        self, jobs: List[tuple[int, ExplanationGenerator, Mistake]], task: List[List[int]]
+    ) -> tuple[ExplanationGenerator, List[Mistake]]:
+        # all the groups of a task use the same kind of generator
+        return jobs[task[0][0]][1], [jobs[group[0]][2] for group in task]
+
+    def _finish_task(
+        self,
+        task: List[List[int]],
+        explanations: List[MistakeExplanationDocument],
+        stream: Optional[_SentenceExplanationStream],
+    ) -> None:
+        if stream is None:
+            return
+        for group, explanation in zip(task, explanations):
+            for job_index in group:
+                stream.done(job_index, explanation)
+
+    def _task_explanations(
+        self,
+        jobs: List[tuple[int, ExplanationGenerator, Mistake]],
+        tasks: List[List[List[int]]],
+        task_explanations: List[List[MistakeExplanationDocument]],
+        known: dict[int, MistakeExplanationDocument],
+    ) -> List[MistakeExplanationDocument]:
+        # explanation of every job, in the order of jobs
+        explanations = [known.get(job_index) for job_index in range(len(jobs))]
+        for task, one_task_explanations in zip(tasks, task_explanations):
+            for group, explanation in zip(task, one_task_explanations):
+                for job_index in group:
+                    explanations[job_index] = explanation
+        return explanations
+
+    def _knowledge_base_key(self, explanation_generator: ExplanationGenerator, mistake: Mistake) -> Optional[str]:
+        return self.explanation_knowledge_base.make_key(
+            mistake.get_change_prompt(), mistake.type, type(explanation_generator).__name__, self.japanese
+        )
+
+    def _known_explanations(
+        self, jobs: List[tuple[int, ExplanationGenerator, Mistake]]
+    ) -> dict[int, MistakeExplanationDocument]:
+        # explanations of recurring changes from the knowledge base, by job index
+        if self.explanation_knowledge_base is None:
+            return {}
+        explanations_by_key = {}
+        known = {}
+        for job_index, (_, explanation_generator, mistake) in enumerate(jobs):
+            key = self._knowledge_base_key(explanation_generator, mistake)
+            if key not in explanations_by_key:
+                explanations_by_key[key] = self.explanation_knowledge_base.get(key)
+            if explanations_by_key[key] is not None:
+                known[job_index] = explanations_by_key[key]
+        return known
+
+    def _remember_explanations(
+        self,
+        explanation_generator: ExplanationGenerator,
+        mistakes: List[Mistake],
+        explanations: List[MistakeExplanationDocument],
+    ) -> None:
+        if self.explanation_knowledge_base is None:
+            return
+        for mistake, explanation in zip(mistakes, explanations):
+            self.explanation_knowledge_base.set(self._knowledge_base_key(explanation_generator, mistake), explanation)
+
+    @staticmethod
+    def _mistake_triple(mistake: Mistake) -> tuple[str, str, str]:
+        return (mistake.original_sentence, mistake.corrected_sentence, mistake.get_change_prompt())
+
+    def _sentence_explanation_documents(
+        self,
+        original_essay: Essay,
+        corrected_essay: Essay,
+        all_mistakes: List[List[Type[Mistake]]],
+        jobs: List[tuple[int, ExplanationGenerator, Mistake]],
+        explanations: List[MistakeExplanationDocument],
+    ) -> List[SentenceExplanationDocument]:
+        sentence_explanations = [[] for _ in all_mistakes]
+        for (sentence_index, _, _), explanation in zip(jobs, explanations):
+            sentence_explanations[sentence_index].append(explanation)
+
+        all_explanations = []
+        for original_sentence, corrected_sentence, sentence_mistakes, explanations in zip(
+            original_essay.sentences, corrected_essay.sentences, all_mistakes, sentence_explanations
+        ):
+            all_explanations.append(
+                self._sentence_explanation_document(
+                    original_sentence, corrected_sentence, sentence_mistakes, explanations
                 )
+            )
         return all_explanations
 
+    def _sentence_explanation_document(
+        self,
+        original_sentence: str,
+        corrected_sentence: str,
+        sentence_mistakes: List[Mistake],
+        explanations: List[MistakeExplanationDocument],
+    ) -> SentenceExplanationDocument:
+        if sentence_mistakes == []:  # No mistake
+            return SentenceExplanationDocument(
+                original_sentence,
+                corrected_sentence,
+                [],
+                self.japanese,
+                complement_comment="Perfect!",
+            )
+        # there is (are) mistake(s)
+        return SentenceExplanationDocument(
+            original_sentence,
+            corrected_sentence,
+            explanations,
+            self.japanese,
+            spans=[mistake.span for mistake in sentence_mistakes if mistake.span is not None],
+        )
+
 
 def main():
     tensaku = TensakuGenerator()
@@ -1,19 +1,42 @@
 import openai
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
+from collections import deque
+from contextvars import ContextVar
 import os
-from typing import Optional, Callable
+import warnings
+from typing import Optional, Callable, Awaitable, Iterator, Iterable, AsyncIterator, AsyncIterable
 import subprocess
 import json
+import asyncio
+import functools
+import threading
+import time
+import weakref
 from datetime import datetime
-from retry import retry
+
+from tensaku.utils.cache import LLMCache, make_cache_key
+from tensaku.utils.rate_limit import RateLimiter, estimate_request_tokens, estimate_text_tokens, retry_after_seconds
+from tensaku.utils.pipeline import current_stage
 
 
 MODELS = [
-        {"name": "gpt-4", "azure_name": "gpt-4", "cost_prompt_per_k": 0.03, "cost_completion_per_k": 0.06},
-        {"name": "gpt-3.5-turbo", "azure_name": "gpt-35", "cost_prompt_per_k": 0.0015, "cost_completion_per_k": 0.002},
+        {"name": "gpt-4", "azure_name": "gpt-4", "cost_prompt_per_k": 0.03, "cost_completion_per_k": 0.06, "requests_per_minute": 10000, "tokens_per_minute": 300000},
+        {"name": "gpt-3.5-turbo", "azure_name": "gpt-35", "cost_prompt_per_k": 0.0015, "cost_completion_per_k": 0.002, "requests_per_minute": 10000, "tokens_per_minute": 1000000},
+        {"name": "gpt-4-1106-preview", "azure_name": "gpt-4-1106", "cost_prompt_per_k": 0.01, "cost_completion_per_k": 0.03, "requests_per_minute": 10000, "tokens_per_minute": 300000},
+        {"name": "gpt-4-vision-preview", "azure_name": "gpt-4-vision", "cost_prompt_per_k": 0.01, "cost_completion_per_k": 0.03, "requests_per_minute": 10000, "tokens_per_minute": 300000},
     ]
 
-client = openai.Client()
+# used for models that are not in MODELS
+DEFAULT_REQUESTS_PER_MINUTE = 10000
+DEFAULT_TOKENS_PER_MINUTE = 300000
+# pause after a 429 without a Retry-After header
+RATE_LIMIT_PAUSE_SECONDS = 5
+# share of the interactive price paid for the requests of a Batch API job
+BATCH_PRICE_MULTIPLIER = 0.5
+
+# the SDK does not retry, so that every 429 reaches the shared rate limiter and retry_request / async_retry
+client = openai.Client(max_retries=0)
+async_client = openai.AsyncClient(max_retries=0)
 
 SEED = 42
 
@@ -36,25 +59,434 @@ class GPTConfig():
             if m["name"] == model:
                 return m["azure_name"]
 
+
+def get_cost(model: str, prompt_tokens: int, completion_tokens: int, batch: bool = False) -> float:
+    """
+    Price in USD. model can be the OpenAI name or the Azure deployment name. Unknown models cost 0.
+    batch is the discounted price of a request of a Batch API job.
+    """
+    model_info = next((m for m in MODELS if model in (m["name"], m["azure_name"])), None)
+    if model_info is None:
+        warnings.warn(f"No price for model {model}")
+        return 0.0
+    cost = (
+        prompt_tokens / 1000 * model_info["cost_prompt_per_k"]
+        + completion_tokens / 1000 * model_info["cost_completion_per_k"]
+    )
+    return cost * BATCH_PRICE_MULTIPLIER if batch else cost
+
+
 @dataclass
 class InferenceLog():
     prompt_tokens: int
     completion_tokens: int
     model: str
+    latency: float = 0.0  # seconds
+    retries: int = 0
+    cache_hit: bool = False
+    stage: Optional[str] = None
+    cost: float = 0.0
+    batch: bool = False
+
+
+@dataclass
+class UsageStats():
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    latency: float = 0.0  # sum of the latencies of all calls
+    retries: int = 0
+    cache_hits: int = 0
+
+    def add(self, other: "UsageStats") -> None:
+        for name in ("calls", "prompt_tokens", "completion_tokens", "cost", "latency", "retries", "cache_hits"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self) -> dict:
+        return {
+            **asdict(self),
+            "mean_latency": self.latency / self.calls if self.calls else 0.0,
+            "cache_hit_rate": self.cache_hits / self.calls if self.calls else 0.0,
+        }
+
 
 class TokenLogger():
-    logs: list[InferenceLog] = []
+    """
+    Ledger of the GPT calls of one request (one essay).
+    Only the latest max_logs calls are kept, but the aggregated stats cover every call.
+    """
+
+    def __init__(self, max_logs: int = 1000) -> None:
+        self.logs: deque[InferenceLog] = deque(maxlen=max_logs)
+        self._stats: dict[tuple[Optional[str], str], UsageStats] = {}
+        self._lock = threading.Lock()
+
+    def get_total_cost(self) -> float:
+        return self.total().cost
+
+    def log(
+        self,
+        prompt_tokens: int,
+        completion_tokens: int,
+        model: str,
+        latency: float = 0.0,
+        retries: int = 0,
+        cache_hit: bool = False,
+        stage: Optional[str] = None,
+        batch: bool = False,
+    ):
+        # batch: the call was a request of a Batch API job, logged at its discounted price
+        stage = stage if stage is not None else current_stage.get()
+        cost = get_cost(model, prompt_tokens, completion_tokens, batch=batch)
+        log = InferenceLog(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            model=model,
+            latency=latency,
+            retries=retries,
+            cache_hit=cache_hit,
+            stage=stage,
+            cost=cost,
+            batch=batch,
+        )
+        with self._lock:
+            self.logs.append(log)
+            self._stats.setdefault((stage, model), UsageStats()).add(
+                UsageStats(1, prompt_tokens, completion_tokens, cost, latency, retries, int(cache_hit))
+            )
+
+    def total(self) -> UsageStats:
+        total = UsageStats()
+        with self._lock:
+            for stats in self._stats.values():
+                total.add(stats)
+        return total
+
+    def summary(self) -> dict:
+        """
+        Aggregated stats: {"total": {...}, "by_stage": {stage: {...}}, "by_model": {model: {...}}}
+        """
+        by_stage: dict[str, UsageStats] = {}
+        by_model: dict[str, UsageStats] = {}
+        with self._lock:
+            for (stage, model), stats in self._stats.items():
+                by_stage.setdefault(stage or "unknown", UsageStats()).add(stats)
+                by_model.setdefault(model, UsageStats()).add(stats)
+        return {
+            "total": self.total().to_dict(),
+            "by_stage": {stage: stats.to_dict() for stage, stats in by_stage.items()},
+            "by_model": {model: stats.to_dict() for model, stats in by_model.items()},
+        }
+
+
+# number of failed attempts of the request currently being retried
+_current_retries: ContextVar[int] = ContextVar("current_retries", default=0)
+
+
+def _log_usage(token_logger: Optional[TokenLogger], result, model: str, latency: float) -> None:
+    if token_logger and getattr(result, "usage", None) is not None:
+        token_logger.log(
+            prompt_tokens=result.usage.prompt_tokens,
+            completion_tokens=result.usage.completion_tokens,
+            model=model,
+            latency=latency,
+            retries=_current_retries.get(),
+        )
+
+
+# response cache shared by create_chat / create_completion. None disables caching.
+llm_cache: Optional[LLMCache] = None
+
+
+def set_llm_cache(cache: Optional[LLMCache]) -> None:
+    """
+    Enable (or disable with None) the response cache, e.g. set_llm_cache(LLMCache(SQLiteCache("cache.sqlite3"))).
+    Only deterministic requests (temperature 0, one completion) are cached, sampled ones (e.g. the comment) are always sent.
+    """
+    global llm_cache
+    llm_cache = cache
+
+
+rate_limiters: dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def set_rate_limit(model: str, requests_per_minute: Optional[int], tokens_per_minute: Optional[int]) -> None:
+    """
+    Set the quota of your account / Azure deployment for a model. None disables that limit.
+    """
+    with _rate_limiters_lock:
+        rate_limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute)
+
 
-    def get_total_cost(self):
-        total_cost = 0
-        for log in self.logs:
-            cost_prompt_per_k = next(m["cost_prompt_per_k"] for m in MODELS if m["name"] == log.model)
-            cost_completion_per_k = next(m["cost_completion_per_k"] for m in MODELS if m["name"] == log.model)
-            total_cost += log.prompt_tokens * cost_prompt_per_k
-            total_cost += log.completion_tokens * cost_completion_per_k
+def get_rate_limiter(model: str) -> RateLimiter:
+    with _rate_limiters_lock:
+        if model not in rate_limiters:
+            model_info = next((m for m in MODELS if model in (m["name"], m["azure_name"])), {})
+            rate_limiters[model] = RateLimiter(
+                model_info.get("requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE),
+                model_info.get("tokens_per_minute", DEFAULT_TOKENS_PER_MINUTE),
+            )
+        return rate_limiters[model]
 
-    def log(self, prompt_tokens: int, completion_tokens: int, model: str):
-        self.logs.append(InferenceLog(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, model=model))
+
+class RequestSlots():
+    """
+    Budget of simultaneous requests shared by all the calls of a batch (generate_batch, score_essays).
+    Every request sent from a function started with run, also from the threads it starts with parallel_map
+    (they copy the context), holds one slot while it is in flight. So nested fan-outs stay within max_concurrency,
+    and a slot is never held while waiting for other requests.
+    """
+
+    def __init__(self, max_concurrency: int) -> None:
+        assert max_concurrency >= 1, "max_concurrency must be at least 1"
+        self.max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def run(self, function: Callable, *args, **kwargs):
+        token = _request_slots.set(self)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _request_slots.reset(token)
+
+    def acquire(self) -> Callable[[], None]:
+        # returns the release function, releasing more than once is ignored
+        self._semaphore.acquire()
+        released = threading.Event()
+
+        def release() -> None:
+            if not released.is_set():
+                released.set()
+                self._semaphore.release()
+
+        return release
+
+
+# slots of the batch the current thread works for, None outside of a batch (the requests are not limited)
+_request_slots: ContextVar[Optional[RequestSlots]] = ContextVar("request_slots", default=None)
+
+
+def _acquire_request_slot() -> Callable[[], None]:
+    slots = _request_slots.get()
+    return slots.acquire() if slots is not None else (lambda: None)
+
+
+def _on_rate_limit_error(limiter: RateLimiter, error: "openai.RateLimitError") -> None:
+    headers = error.response.headers if getattr(error, "response", None) is not None else None
+    limiter.update_from_headers(headers)
+    limiter.pause(retry_after_seconds(headers) or RATE_LIMIT_PAUSE_SECONDS)
+
+
+def chat_completion(token_logger: TokenLogger = None, **request):
+    """
+    client.chat.completions.create behind the shared rate limiter of the model.
+    The usage, latency and retries of the call are recorded in token_logger.
+    """
+    limiter = get_rate_limiter(request["model"])
+    release_slot = _acquire_request_slot()
+    try:
+        limiter.acquire(estimate_request_tokens(request))
+        started_at = time.monotonic()
+        response = client.chat.completions.with_raw_response.create(**request)
+    except openai.RateLimitError as e:
+        _on_rate_limit_error(limiter, e)
+        raise
+    finally:
+        release_slot()
+    limiter.update_from_headers(response.headers)
+    result = response.parse()
+    _log_usage(token_logger, result, request.get("model") or request.get("deployment_id"), time.monotonic() - started_at)
+    return result
+
+
+async def achat_completion(token_logger: TokenLogger = None, **request):
+    """
+    asyncio version of chat_completion.
+    """
+    limiter = get_rate_limiter(request["model"])
+    await limiter.aacquire(estimate_request_tokens(request))
+    started_at = time.monotonic()
+    try:
+        response = await async_client.chat.completions.with_raw_response.create(**request)
+    except openai.RateLimitError as e:
+        _on_rate_limit_error(limiter, e)
+        raise
+    limiter.update_from_headers(response.headers)
+    result = response.parse()
+    _log_usage(token_logger, result, request.get("model") or request.get("deployment_id"), time.monotonic() - started_at)
+    return result
+
+
+def _log_stream_usage(token_logger: Optional[TokenLogger], request: dict, usage, output: str, latency: float, retries: int) -> None:
+    # usage is None when the API does not send the usage chunk (e.g. older Azure api versions), then it is estimated
+    if not token_logger:
+        return
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt_tokens = estimate_request_tokens({**request, "max_tokens": 0})
+        completion_tokens = estimate_text_tokens(output)
+    token_logger.log(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        model=request.get("model") or request.get("deployment_id"),
+        latency=latency,
+        retries=retries,
+    )
+
+
+def _stream_request(request: dict) -> dict:
+    return {**request, "stream": True, "stream_options": {"include_usage": True}}
+
+
+def _chunk_text(chunk) -> Optional[str]:
+    if not chunk.choices:
+        return None
+    return chunk.choices[0].delta.content
+
+
+def chat_completion_stream(token_logger: TokenLogger = None, **request) -> Iterator[str]:
+    """
+    chat_completion with stream=True. The request is sent right away (so errors can be retried),
+    and the returned iterator yields the text as it arrives. The usage is logged when the stream ends.
+    """
+    limiter = get_rate_limiter(request["model"])
+    # the slot is held until the stream ends
+    release_slot = _acquire_request_slot()
+    try:
+        limiter.acquire(estimate_request_tokens(request))
+        started_at = time.monotonic()
+        response = client.chat.completions.with_raw_response.create(**_stream_request(request))
+    except openai.RateLimitError as e:
+        release_slot()
+        _on_rate_limit_error(limiter, e)
+        raise
+    except BaseException:
+        release_slot()
+        raise
+    limiter.update_from_headers(response.headers)
+    retries = _current_retries.get()
+
+    def deltas():
+        try:
+            usage, output = None, ""
+            for chunk in response.parse():
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+                text = _chunk_text(chunk)
+                if text:
+                    output += text
+                    yield text
+            _log_stream_usage(token_logger, request, usage, output, time.monotonic() - started_at, retries)
+        finally:
+            release_slot()
+
+    stream = deltas()
+    # a stream that is dropped before it is read gives its slot back as well
+    weakref.finalize(stream, release_slot)
+    return stream
+
+
+async def achat_completion_stream(token_logger: TokenLogger = None, **request) -> AsyncIterator[str]:
+    """
+    asyncio version of chat_completion_stream.
+    """
+    limiter = get_rate_limiter(request["model"])
+    await limiter.aacquire(estimate_request_tokens(request))
+    started_at = time.monotonic()
+    try:
+        response = await async_client.chat.completions.with_raw_response.create(**_stream_request(request))
+    except openai.RateLimitError as e:
+        _on_rate_limit_error(limiter, e)
+        raise
+    limiter.update_from_headers(response.headers)
+    retries = _current_retries.get()
+
+    async def deltas():
+        usage, output = None, ""
+        async for chunk in response.parse():
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            text = _chunk_text(chunk)
+            if text:
+                output += text
+                yield text
+        _log_stream_usage(token_logger, request, usage, output, time.monotonic() - started_at, retries)
+
+    return deltas()
+
+
+def text_completion(token_logger: TokenLogger = None, **request):
+    """
+    client.completions.create behind the shared rate limiter of the model.
+    """
+    limiter = get_rate_limiter(request.get("model") or request.get("deployment_id") or "")
+    release_slot = _acquire_request_slot()
+    try:
+        limiter.acquire(estimate_request_tokens(request))
+        started_at = time.monotonic()
+        response = client.completions.with_raw_response.create(**request)
+    except openai.RateLimitError as e:
+        _on_rate_limit_error(limiter, e)
+        raise
+    finally:
+        release_slot()
+    limiter.update_from_headers(response.headers)
+    result = response.parse()
+    _log_usage(token_logger, result, request.get("model") or request.get("deployment_id"), time.monotonic() - started_at)
+    return result
+
+
+def retry_request(tries=3, delay=5, backoff=2, rate_limit_tries=6):
+    """
+    Like retry.retry, but a rate limit error does not sleep blindly: the rate limiter already holds every
+    request of the model back until Retry-After has passed. Rate limit errors have their own number of tries.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            remaining_tries, remaining_rate_limit_tries, current_delay = tries, rate_limit_tries, delay
+            while True:
+                retries = _current_retries.set((tries - remaining_tries) + (rate_limit_tries - remaining_rate_limit_tries))
+                try:
+                    return function(*args, **kwargs)
+                except openai.RateLimitError:
+                    remaining_rate_limit_tries -= 1
+                    if remaining_rate_limit_tries == 0:
+                        raise
+                except Exception:
+                    remaining_tries -= 1
+                    if remaining_tries == 0:
+                        raise
+                    time.sleep(current_delay)
+                    current_delay *= backoff
+                finally:
+                    _current_retries.reset(retries)
+        return wrapper
+    return decorator
+
+
+def _is_deterministic(request: dict) -> bool:
+    # a sampled request must give a new output every time, so it is not cached
+    return (request.get("temperature") or 0) == 0 and (request.get("n") or 1) == 1
+
+
+def _cache_lookup(request: dict, token_logger: TokenLogger = None) -> tuple[Optional[str], Optional[str]]:
+    # returns (cache key, cached output). Both are None when caching is disabled or the request is sampled.
+    if llm_cache is None or not _is_deterministic(request):
+        return None, None
+    cache_key = make_cache_key({**request, "seed": SEED})
+    output = llm_cache.get(cache_key)
+    if output is not None and token_logger:
+        token_logger.log(0, 0, model=request.get("model") or request.get("deployment_id"), cache_hit=True)
+    return cache_key, output
+
+
+def _cache_store(cache_key: Optional[str], output: Optional[str]) -> None:
+    if llm_cache is not None and cache_key is not None and output is not None:
+        llm_cache.set(cache_key, output)
 
 
 class ParsingError(Exception):
@@ -64,7 +496,7 @@ class JsonParsingError(Exception):
     pass
 
 
-@retry(tries=3, delay=5, backoff=2)
+@retry_request(tries=3, delay=5, backoff=2)
 def create_completion(prompt,
                       print_prompt=False,
                       gpt_config: GPTConfig = GPTConfig(),
@@ -72,7 +504,7 @@ def create_completion(prompt,
                       token_logger: TokenLogger = None):
     if print_prompt:
       print(prompt)
-    result = client.completions.create(
+    request = dict(
       prompt=prompt,
       model=gpt_config.model if openai.api_type == "open_ai" else None,
       deployment_id = gpt_config.get_azure_deployment_id(gpt_config.model) if openai.api_type == "azure" else None,
@@ -82,61 +514,147 @@ def create_completion(prompt,
       max_tokens=gpt_config.max_tokens,
       temperature=gpt_config.temperature
     )
-
-    if token_logger:
-        prompt_tokens = result.usage.prompt_tokens
-        completion_tokens = result.usage.completion_tokens
-        token_logger.log(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, model=gpt_config.model)
+    cache_key, output = _cache_lookup(request, token_logger)
+    if output is None:
+        result = text_completion(token_logger=token_logger, **request)
+        output = result.choices[0].text
+        _cache_store(cache_key, output)
 
     if clean_output:
-      return result.choices[0].text.strip()
+      return output.strip()
     else:
-      return result.choices[0].text
-
-@retry(tries=3, delay=5, backoff=2)
-def create_chat(messages,
-                gpt_config: GPTConfig = GPTConfig(model="gpt-4"),
-                functions = None,
-                function_call = "auto",
-                clean_output = True,
-                token_logger: TokenLogger = None):
-    print("------------------------------------")
-    print(messages)
-    print("------------------------------------")
-
-    if functions:
-        result = client.chat.completions.create(
+      return output
+
+
+def async_retry(tries=3, delay=5, backoff=2, rate_limit_tries=6):
+    """asyncio version of retry_request. Sleeps with asyncio.sleep so that the event loop is not blocked."""
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            remaining_tries, remaining_rate_limit_tries, current_delay = tries, rate_limit_tries, delay
+            while True:
+                retries = _current_retries.set((tries - remaining_tries) + (rate_limit_tries - remaining_rate_limit_tries))
+                try:
+                    return await function(*args, **kwargs)
+                except openai.RateLimitError:
+                    remaining_rate_limit_tries -= 1
+                    if remaining_rate_limit_tries == 0:
+                        raise
+                except Exception:
+                    remaining_tries -= 1
+                    if remaining_tries == 0:
+                        raise
+                    await asyncio.sleep(current_delay)
+                    current_delay *= backoff
+                finally:
+                    _current_retries.reset(retries)
+        return wrapper
+    return decorator
+
+
+def _chat_kwargs(messages, gpt_config: GPTConfig, functions=None, function_call="auto") -> dict:
+    kwargs = dict(
         messages=messages,
         model=gpt_config.model if openai.api_type == "open_ai" else gpt_config.get_azure_deployment_id(gpt_config.model),
-        function_call=function_call,
-        functions=functions,
         top_p=gpt_config.top_p,
         presence_penalty=gpt_config.presence_penalty,
         frequency_penalty=gpt_config.frequency_penalty,
         max_tokens=gpt_config.max_tokens,
         temperature=gpt_config.temperature
-        )
+    )
+    if functions:
+        kwargs["function_call"] = function_call
+        kwargs["functions"] = functions
+    return kwargs
+
+
+def _clean(output: str, clean_output: bool) -> str:
+    if clean_output and output is not None:
+      return output.strip()
     else:
-        result = client.chat.completions.create(
-        messages=messages,
-        model=gpt_config.model if openai.api_type == "open_ai" else gpt_config.get_azure_deployment_id(gpt_config.model),
-        top_p=gpt_config.top_p,
-        presence_penalty=gpt_config.presence_penalty,
-        frequency_penalty=gpt_config.frequency_penalty,
-        max_tokens=gpt_config.max_tokens,
-        temperature=gpt_config.temperature
-        )
+      return output
 
-    if token_logger:
-        prompt_tokens = result.usage.prompt_tokens
-        completion_tokens = result.usage.completion_tokens
-        token_logger.log(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, model=gpt_config.model)
 
+def _finish_stream(deltas: Iterable[str], cache_key: Optional[str], clean_output: bool) -> Iterator[str]:
+    # strips the leading whitespace and caches the whole output once the stream ends
+    output = ""
+    for delta in deltas:
+        if clean_output and output == "":
+            delta = delta.lstrip()
+            if delta == "":
+                continue
+        output += delta
+        yield delta
+    _cache_store(cache_key, output)
+
+
+async def _afinish_stream(deltas: AsyncIterable[str], cache_key: Optional[str], clean_output: bool) -> AsyncIterator[str]:
+    output = ""
+    async for delta in deltas:
+        if clean_output and output == "":
+            delta = delta.lstrip()
+            if delta == "":
+                continue
+        output += delta
+        yield delta
+    _cache_store(cache_key, output)
+
+
+async def _aiterate(items: Iterable[str]) -> AsyncIterator[str]:
+    for item in items:
+        yield item
+
+
+@retry_request(tries=3, delay=5, backoff=2)
+def create_chat(messages,
+                gpt_config: GPTConfig = GPTConfig(model="gpt-4"),
+                functions = None,
+                function_call = "auto",
+                clean_output = True,
+                token_logger: TokenLogger = None,
+                stream = False):
+    """
+    stream=True returns an iterator of the text as it is generated instead of the whole text.
+    Only opening the stream is retried.
+    """
+    request = _chat_kwargs(messages, gpt_config, functions, function_call)
+    cache_key, output = _cache_lookup(request, token_logger)
+    if stream:
+        if output is not None:
+            return iter([_clean(output, clean_output)])
+        return _finish_stream(chat_completion_stream(token_logger=token_logger, **request), cache_key, clean_output)
+    if output is None:
+        result = chat_completion(token_logger=token_logger, **request)
+        output = result.choices[0].message.content
+        _cache_store(cache_key, output)
+
+    return _clean(output, clean_output)
+
+
+@async_retry(tries=3, delay=5, backoff=2)
+async def acreate_chat(messages,
+                       gpt_config: GPTConfig = GPTConfig(model="gpt-4"),
+                       functions = None,
+                       function_call = "auto",
+                       clean_output = True,
+                       token_logger: TokenLogger = None,
+                       stream = False):
+    """
+    stream=True returns an async iterator of the text: async for delta in await acreate_chat(..., stream=True)
+    """
+    request = _chat_kwargs(messages, gpt_config, functions, function_call)
+    cache_key, output = _cache_lookup(request, token_logger)
+    if stream:
+        if output is not None:
+            return _aiterate([_clean(output, clean_output)])
+        return _afinish_stream(await achat_completion_stream(token_logger=token_logger, **request), cache_key, clean_output)
+    if output is None:
+        result = await achat_completion(token_logger=token_logger, **request)
+        output = result.choices[0].message.content
+        _cache_store(cache_key, output)
+
+    return _clean(output, clean_output)
 
-    if clean_output:
-      return result.choices[0].message.content.strip()
-    else:
-      return result.choices[0].message.content
 
 def create_chat_and_parse(messages, parsing_function: Callable, gpt_config: GPTConfig = GPTConfig(model="gpt-4"), clean_output = True, max_tries=2, token_logger: TokenLogger = None):
     return generate_and_parse(gpt_function=lambda gpt_config: create_chat(messages, gpt_config, clean_output=clean_output, token_logger=token_logger),
@@ -167,6 +685,29 @@ def generate_and_parse(gpt_function: Callable[[GPTConfig], str], parsing_functio
     return parsed_output
 
 
+async def acreate_chat_and_parse(messages, parsing_function: Callable, gpt_config: GPTConfig = GPTConfig(model="gpt-4"), clean_output = True, max_tries=2, token_logger: TokenLogger = None):
+    return await agenerate_and_parse(gpt_function=lambda gpt_config: acreate_chat(messages, gpt_config, clean_output=clean_output, token_logger=token_logger),
+                       parsing_function=parsing_function,
+                       gpt_config=gpt_config,
+                       max_tries=max_tries)
+
+async def agenerate_and_parse(gpt_function: Callable[[GPTConfig], Awaitable[str]], parsing_function: Callable[[str], any], gpt_config, max_tries=4):
+    # run gpt function until parsable.
+    for i in range(max_tries):
+        output = await gpt_function(gpt_config)
+        try:
+            parsed_output = parsing_function(output)
+            break
+        except:
+            if gpt_config.temperature < 0.3:
+                gpt_config.temperature += 0.1
+
+    else:
+        raise ParsingError(f"Failed to parse output. GPT output: \n{output}")
+
+    return parsed_output
+
+
 def fine_tune(X: list[str], y: list[str], base_model: str, new_model_suffix: str = None):
 
     TRAIN_FILE_NAME_WITHOUT_EXTENSION = 'train'
@@ -0,0 +1,159 @@
+import asyncio
+import inspect
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+# name of the stage the current code runs in. Used to attribute GPT calls to stages in the TokenLogger.
+current_stage: ContextVar[Optional[str]] = ContextVar("current_stage", default=None)
+
+
+class PipelineStopped(Exception):
+    """
+    Raised by Pipeline.run when it was stopped before all the stages ran.
+    """
+
+
+@dataclass
+class Stage():
+    """
+    One step of a pipeline.
+    function is called with the outputs of the stages listed in inputs as keyword arguments.
+    """
+    name: str
+    function: Callable[..., Any]
+    inputs: list[str] = field(default_factory=list)
+
+
+@dataclass
+class StageTiming():
+    start: float  # unix time
+    end: float  # unix time
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Pipeline():
+    """
+    Runs a small DAG of stages. A stage starts as soon as all of its inputs are ready,
+    so the total latency is the critical path of the graph instead of the sum of all stages.
+    """
+
+    def __init__(self, stages: list[Stage]) -> None:
+        self.stages = {stage.name: stage for stage in stages}
+        assert len(self.stages) == len(stages), "stage names must be unique"
+        for stage in stages:
+            for input_name in stage.inputs:
+                assert input_name in self.stages, f"stage {stage.name} depends on unknown stage {input_name}"
+        self._check_acyclic()
+
+        self.results: dict[str, Any] = {}
+        self.timings: dict[str, StageTiming] = {}
+
+    def _check_acyclic(self) -> None:
+        visited, visiting = set(), set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            assert name not in visiting, f"pipeline has a cycle through stage {name}"
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _ready_stages(self, started: set[str]) -> list[Stage]:
+        return [
+            stage for name, stage in self.stages.items()
+            if name not in started and all(input_name in self.results for input_name in stage.inputs)
+        ]
+
+    def _run_stage(self, stage: Stage) -> Any:
+        start = time.time()
+        token = current_stage.set(stage.name)
+        try:
+            output = stage.function(**{input_name: self.results[input_name] for input_name in stage.inputs})
+        finally:
+            current_stage.reset(token)
+        self.timings[stage.name] = StageTiming(start=start, end=time.time())
+        return output
+
+    async def _arun_stage(self, stage: Stage) -> Any:
+        start = time.time()
+        kwargs = {input_name: self.results[input_name] for input_name in stage.inputs}
+        token = current_stage.set(stage.name)
+        try:
+            if inspect.iscoroutinefunction(stage.function):
+                output = await stage.function(**kwargs)
+            else:
+                output = await asyncio.to_thread(stage.function, **kwargs)
+        finally:
+            current_stage.reset(token)
+        self.timings[stage.name] = StageTiming(start=start, end=time.time())
+        return output
+
+    def run(
+        self,
+        max_workers: Optional[int] = None,
+        on_stage_done: Optional[Callable[[str, Any], None]] = None,
+        stop: Optional[threading.Event] = None,
+    ) -> dict[str, Any]:
+        """
+        Runs every stage in a thread pool and returns the outputs by stage name.
+        The first exception raised by a stage is re-raised after the running stages finish.
+        on_stage_done(name, output) is called as soon as each stage finishes.
+        Once stop is set no more stages are started, and PipelineStopped is raised after the running stages finish.
+        """
+        started: set[str] = set()
+        with ThreadPoolExecutor(max_workers=max_workers or len(self.stages) or 1) as executor:
+            running = {}
+            while len(self.results) < len(self.stages):
+                if stop is not None and stop.is_set():
+                    wait(running)
+                    raise PipelineStopped()
+                for stage in self._ready_stages(started):
+                    started.add(stage.name)
+                    # the stages run in a copy of the caller's context, so its context variables are kept
+                    running[executor.submit(copy_context().run, self._run_stage, stage)] = stage.name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.results[name] = future.result()
+                    if on_stage_done is not None:
+                        on_stage_done(name, self.results[name])
+
+        return self.results
+
+    async def arun(self, on_stage_done: Optional[Callable[[str, Any], None]] = None) -> dict[str, Any]:
+        """
+        asyncio version of run. Coroutine functions are awaited, plain functions run in a worker thread.
+        """
+        started: set[str] = set()
+        running = {}
+        try:
+            while len(self.results) < len(self.stages):
+                for stage in self._ready_stages(started):
+                    started.add(stage.name)
+                    running[asyncio.ensure_future(self._arun_stage(stage))] = stage.name
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    self.results[name] = task.result()
+                    if on_stage_done is not None:
+                        on_stage_done(name, self.results[name])
+        finally:
+            for task in running:
+                task.cancel()
+
+        return self.results
@@ -0,0 +1,214 @@
+import asyncio
+import re
+import threading
+import time
+from collections import deque
+from itertools import count
+from typing import Mapping, Optional
+
+# tokens counted for every message on top of its content (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# rough cost of one image part of a vision request
+IMAGE_TOKENS = 765
+
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    Cheap token estimate without a tokenizer: ~4 ascii characters per token,
+    and about one token per character for Japanese and other non ascii text.
+    """
+    ascii_characters = sum(1 for character in text if ord(character) < 128)
+    return ascii_characters // 4 + (len(text) - ascii_characters) + 1
+
+
+def estimate_request_tokens(request: dict) -> int:
+    """
+    Tokens a request counts against the tokens-per-minute quota: the prompt plus max_tokens,
+    because the API reserves max_tokens for the completion when it checks the quota.
+    """
+    tokens = 0
+    if "prompt" in request:
+        tokens += estimate_text_tokens(request["prompt"] or "")
+    for message in request.get("messages") or []:
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            tokens += estimate_text_tokens(content)
+        else:
+            for part in content:
+                if part.get("type") == "text":
+                    tokens += estimate_text_tokens(part["text"])
+                else:
+                    tokens += IMAGE_TOKENS
+    tokens += (request.get("max_tokens") or 0) * (request.get("n") or 1)
+    return tokens
+
+
+def parse_reset_time(value: str) -> Optional[float]:
+    """
+    Parses the x-ratelimit-reset-* header format ("1s", "6m0s", "20ms", "1h2m3.5s") into seconds.
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    multipliers = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * multipliers[unit] for number, unit in parts)
+
+
+class TokenBucket():
+    """
+    Classic token bucket. capacity is the budget per minute, and it refills continuously.
+    """
+
+    def __init__(self, capacity: float) -> None:
+        self.capacity = capacity
+        self.available = capacity
+        self.refill_per_second = capacity / 60
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+    def limit_to(self, remaining: float, reset_seconds: Optional[float] = None) -> None:
+        # the server knows better than our estimate (other processes share the quota)
+        self._refill()
+        if remaining < self.available:
+            self.available = remaining
+            if reset_seconds:
+                self.refill_per_second = max(self.capacity / 60, (self.capacity - remaining) / reset_seconds)
+        else:
+            self.refill_per_second = self.capacity / 60
+
+
+class RateLimiter():
+    """
+    Requests-per-minute and tokens-per-minute budget of one model, shared by every thread and event loop
+    of the process. Callers are served first come first served, so one essay with many requests can not
+    starve the others.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None) -> None:
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._queue: deque[int] = deque()
+        self._tickets = count()
+
+    def _wait_time(self, ticket: int, tokens: int) -> float:
+        # must be called with the lock held. Consumes the budget and returns 0 when the ticket may go.
+        if self._queue[0] != ticket:
+            return 0.01
+        wait = max(0.0, self.blocked_until - time.monotonic())
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        if wait > 0:
+            return wait
+
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(tokens)
+        self._queue.popleft()
+        return 0.0
+
+    def _enqueue(self) -> int:
+        with self._lock:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            return ticket
+
+    def _leave(self, ticket: int) -> None:
+        with self._lock:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+
+    def acquire(self, tokens: int = 0) -> None:
+        ticket = self._enqueue()
+        try:
+            while True:
+                with self._lock:
+                    wait = self._wait_time(ticket, tokens)
+                if wait == 0:
+                    return
+                time.sleep(min(wait, 1.0))
+        except BaseException:
+            self._leave(ticket)
+            raise
+
+    async def aacquire(self, tokens: int = 0) -> None:
+        ticket = self._enqueue()
+        try:
+            while True:
+                with self._lock:
+                    wait = self._wait_time(ticket, tokens)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait, 1.0))
+        except BaseException:
+            self._leave(ticket)
+            raise
+
+    def pause(self, seconds: float) -> None:
+        # stop sending for everyone, e.g. after a 429 with Retry-After
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """
+        Adapts to the x-ratelimit-* and retry-after headers of an OpenAI / Azure response.
+        """
+        if headers is None:
+            return
+        with self._lock:
+            remaining_requests = headers.get("x-ratelimit-remaining-requests")
+            if self.requests and remaining_requests is not None:
+                self.requests.limit_to(
+                    float(remaining_requests), parse_reset_time(headers.get("x-ratelimit-reset-requests"))
+                )
+            remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+            if self.tokens and remaining_tokens is not None:
+                self.tokens.limit_to(
+                    float(remaining_tokens), parse_reset_time(headers.get("x-ratelimit-reset-tokens"))
+                )
+
+        retry_after = retry_after_seconds(headers)
+        if retry_after:
+            self.pause(retry_after)
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after") is not None:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            return None
+    return None
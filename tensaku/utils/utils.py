@@ -1,7 +1,14 @@
 import re
-from typing import List, Callable
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, List, Callable, Awaitable, Hashable, Iterable, Iterator, AsyncIterable, AsyncIterator, Optional
 from tensaku.utils.openai_utils import GPTConfig
 
+# default number of calls parallel_map runs at the same time
+DEFAULT_MAX_WORKERS = 8
+
 def concat_examples(examples: List[str], example_index: List[int]=None, separator: str ='\n\n') -> str:
     if example_index == None:
         example_index = range(len(examples))
@@ -19,13 +26,131 @@ def paragraph2sentences(paragraph: str) -> List[str]:
     sentences = [sentence.strip() for sentence in sentences]
     return sentences
 
-def run_function_in_small_batches(function, input_list, batch_size=100):
-    outputs = []
-    for i in range(0, len(input_list), batch_size):
-        batch = input_list[i:i+batch_size]
-        batch_outputs = function(batch)
-        outputs.extend(batch_outputs)
-    return outputs
+def parallel_map(
+    function: Callable[[Any], Any],
+    items: Iterable,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    on_error: Optional[Callable[[Any, Exception], Any]] = None,
+) -> list:
+    """
+    Calls function on every item in a thread pool of max_workers threads and returns the outputs in the order of items.
+    With on_error, an item whose call raises gets on_error(item, exception) as its output and the other items are not affected.
+    Without it the first exception is re-raised.
+    The calls run in a copy of the caller's context, so context variables (e.g. the pipeline stage) are kept.
+    """
+    assert max_workers >= 1, "max_workers must be at least 1"
+    items = list(items)
+
+    def call(context: contextvars.Context, item):
+        try:
+            return context.run(function, item)
+        except Exception as e:
+            if on_error is None:
+                raise
+            return on_error(item, e)
+
+    if max_workers == 1 or len(items) <= 1:
+        return [call(contextvars.copy_context(), item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(call, contextvars.copy_context(), item) for item in items]
+        return [future.result() for future in futures]
+
+async def aparallel_map(
+    function: Callable[[Any], Awaitable],
+    items: Iterable,
+    max_concurrency: int = DEFAULT_MAX_WORKERS,
+    on_error: Optional[Callable[[Any, Exception], Any]] = None,
+) -> list:
+    # asyncio version of parallel_map, at most max_concurrency calls are awaited at the same time
+    assert max_concurrency >= 1, "max_concurrency must be at least 1"
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def call(item):
+        async with semaphore:
+            try:
+                return await function(item)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                return on_error(item, e)
+
+    return list(await asyncio.gather(*[call(item) for item in items]))
+
+def run_function_in_small_batches(function, input_list, batch_size=100, max_workers=1, on_error=None):
+    # with max_workers > 1 the batches run in parallel, outputs keep the order of input_list
+    batches = [input_list[i:i+batch_size] for i in range(0, len(input_list), batch_size)]
+    batch_outputs = parallel_map(function, batches, max_workers=max_workers, on_error=on_error)
+    return [output for outputs in batch_outputs for output in outputs]
+
+async def arun_function_in_small_batches(function: Callable[[list], Awaitable[list]], input_list, batch_size=100, max_concurrency=None, on_error=None):
+    # batches are awaited together, outputs keep the order of input_list
+    batches = [input_list[i:i+batch_size] for i in range(0, len(input_list), batch_size)]
+    batch_outputs = await aparallel_map(function, batches, max_concurrency=max_concurrency or len(batches) or 1, on_error=on_error)
+    return [output for outputs in batch_outputs for output in outputs]
+
+class RequestCoalescer():
+    """
+    Sends identical requests only once. Every caller with the same key gets the result (or the exception)
+    of the first call, also while that call is still running in another thread.
+    """
+
+    def __init__(self) -> None:
+        self._futures: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: Hashable, function: Callable, *args, **kwargs):
+        with self._lock:
+            future = self._futures.get(key)
+            is_first_call = future is None
+            if is_first_call:
+                future = Future()
+                self._futures[key] = future
+
+        if is_first_call:
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+def split_by_token_budget(items: list, count_tokens: Callable[[Any], int], token_budget: int) -> list[list]:
+    """
+    Packs consecutive items into batches of at most token_budget tokens. An item larger than the budget gets its own batch.
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for item in items:
+        tokens = count_tokens(item)
+        if batch and batch_tokens + tokens > token_budget:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def iterate_sections(deltas: Iterable[str], separator: str) -> Iterator[str]:
+    """
+    Joins streamed text and yields each section as soon as the separator (a regex) after it has arrived.
+    The last section is yielded when the stream ends.
+    """
+    buffer = ""
+    for delta in deltas:
+        buffer += delta
+        sections = re.split(separator, buffer)
+        buffer = sections.pop()
+        yield from sections
+    yield buffer
+
+async def aiterate_sections(deltas: AsyncIterable[str], separator: str) -> AsyncIterator[str]:
+    buffer = ""
+    async for delta in deltas:
+        buffer += delta
+        sections = re.split(separator, buffer)
+        buffer = sections.pop()
+        for section in sections:
+            yield section
+    yield buffer
 
 #protocal for gpt function. it only takes gpt_config as argument
     
@@ -0,0 +1,56 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from tensaku.src.documents import SentenceExplanationDocument
+from tensaku.src.edit_classifier.alignment import align, is_unchanged, locate_change
+from tensaku.src.edit_classifier.classifier import Classifier
+
+
+def test_unchanged_sentences_ignore_whitespace():
+    assert is_unchanged("It was  fun.", "It was fun.")
+    assert not is_unchanged("It was fun.", "It was fun!")
+
+
+def test_align_gives_replacements_with_offsets():
+    original = "I looked a moovie with my friends."
+    corrected = "I watched a movie with my friends."
+    spans = align(original, corrected)
+    assert [(span.before, span.after) for span in spans] == [("looked", "watched"), ("moovie", "movie")]
+    for span in spans:
+        assert original[span.original_start:span.original_end] == span.before
+        assert corrected[span.corrected_start:span.corrected_end] == span.after
+
+
+def test_deletions_are_widened_to_a_replacement():
+    spans = align("I went to there yesterday.", "I went there yesterday.")
+    assert [(span.before, span.after) for span in spans] == [("to there", "there")]
+
+
+def test_locate_change():
+    span = locate_change("I looked a moovie.", "I watched a movie.", "a", "a")
+    assert (span.original_start, span.corrected_start) == (9, 10)
+    assert locate_change("I looked a moovie.", "I watched a movie.", "saw", "watched") is None
+
+
+def test_classified_changes_take_the_offsets_of_the_aligned_edit():
+    original = "It is a dog and a cat."
+    corrected = "It is a dog and the cat."
+    mistakes = Classifier()._gptoutput2mistakes("a -> the (Grammar)", original, corrected)
+    # the second "a" was changed, locate_change alone would give the first one
+    assert (mistakes[0].span.original_start, mistakes[0].span.corrected_start) == (16, 16)
+
+
+def test_sentence_html_marks_the_changed_words():
+    original = "I looked a moovie."
+    corrected = "I watched a movie."
+    document = SentenceExplanationDocument(original, corrected, [], False, spans=align(original, corrected))
+    html = document.generate_html()
+    assert "I <b>looked</b> a <b>moovie</b>." in html
+    assert "I <b>watched</b> a <b>movie</b>." in html
+
+
+def test_unchanged_sentences_are_not_classified():
+    # no request is made, so this works without an API key
+    assert Classifier().classify("It was fun.", "It was fun.") == []
+    assert Classifier().classify_chunk([("It was fun.", "It was fun."), ("Hi.", "Hi.")]) == [[], []]
@@ -0,0 +1,122 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import json
+
+import pytest
+
+from tensaku.src.cyten import batch
+from tensaku.src.cyten.batch import BulkScoringJob, LocalBatchBackend
+from tensaku.src.cyten.cyten import Category, Criteria, ScoreCategorySettings, ScoreSettings, WordsCountSettings
+from tensaku.utils.openai_utils import TokenLogger, get_cost
+
+SCORE_SETTINGS = ScoreSettings(
+    topic="Do you like summer?",
+    words_count=WordsCountSettings(min=3, subtractions=[]),
+    score_categories={
+        Category.content: ScoreCategorySettings(points_allocated=2, criteria=[Criteria(point=0, content="a"), Criteria(point=2, content="b")]),
+        Category.grammar: ScoreCategorySettings(points_allocated=2, criteria=[Criteria(point=0, content="a"), Criteria(point=2, content="b")]),
+    },
+)
+ESSAYS = ["I like summer very much.", "Hi", "Summer is too hot for me.", "I like summer very much."]
+
+
+def complete(body: dict) -> dict:
+    prompt = body["messages"][0]["content"]
+    if "Summer is too hot" in prompt and "文法だけ" in prompt:
+        content = "not json"
+    else:
+        content = json.dumps({"reason": "", "score": 2 if "I like summer" in prompt else 1})
+    return {"choices": [{"message": {"role": "assistant", "content": content}}], "usage": {"prompt_tokens": 100, "completion_tokens": 10}}
+
+
+class CountingBackend(LocalBatchBackend):
+    def __init__(self) -> None:
+        super().__init__(complete)
+        self.submitted = 0
+
+    def submit(self, input_path: str) -> str:
+        self.submitted += 1
+        return super().submit(input_path)
+
+
+def test_bulk_scoring_maps_results_and_retries_failed_requests(tmp_path, monkeypatch):
+    retried = []
+    monkeypatch.setattr(batch, "_score_category", lambda essay, *args, **kwargs: retried.append(essay) or 0)
+    job = BulkScoringJob(ESSAYS, SCORE_SETTINGS, state_path=str(tmp_path / "job.json"), backend=CountingBackend())
+
+    results = job.run(poll_interval=0)
+
+    # identical essays are sent once and the rejected essay is not sent
+    assert job.write_requests() == 4
+    assert results[0] == results[3] == {"message": "success", "scores": {"content": 2, "grammar": 2, "words_penalty": 0, "total": 4}}
+    assert results[1]["message"] == "too few words"
+    # the request with an invalid output is scored with the interactive request
+    assert retried == ["Summer is too hot for me."]
+    assert results[2]["scores"] == {"content": 1, "grammar": 0, "words_penalty": 0, "total": 1}
+
+
+def test_bulk_scoring_resumes_from_the_state_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "_score_category", lambda *args, **kwargs: 0)
+    state_path = str(tmp_path / "job.json")
+    backend = CountingBackend()
+    BulkScoringJob(ESSAYS, SCORE_SETTINGS, state_path=state_path, backend=backend).submit()
+
+    # after a crash the job is found in the state file and not submitted again
+    job = BulkScoringJob(ESSAYS, SCORE_SETTINGS, state_path=state_path, backend=backend)
+    assert job.state["status"] == "submitted"
+    assert len(job.run(poll_interval=0)) == len(ESSAYS)
+    assert backend.submitted == 1
+
+    with pytest.raises(ValueError):
+        BulkScoringJob(ESSAYS[:2], SCORE_SETTINGS, state_path=state_path, backend=backend)
+
+
+class FailedBackend(CountingBackend):
+    def status(self, job_id: str) -> str:
+        return "expired"
+
+
+def test_bulk_scoring_falls_back_to_interactive_requests_only_when_asked(tmp_path, monkeypatch):
+    retried = []
+    monkeypatch.setattr(batch, "_score_category", lambda essay, *args, **kwargs: retried.append(essay) or 1)
+    job = BulkScoringJob(ESSAYS, SCORE_SETTINGS, state_path=str(tmp_path / "job.json"), backend=FailedBackend())
+
+    with pytest.raises(RuntimeError):
+        job.run(poll_interval=0)
+    assert retried == []
+
+    # the expired job has its partial output, only the requests without an output are sent again
+    results = job.results(fallback_interactive=True)
+    assert retried == ["Summer is too hot for me."]
+    assert results[0]["scores"]["total"] == 4
+    assert not os.path.exists(f"{job.output_path}.tmp")
+
+
+class RunningBackend(CountingBackend):
+    def status(self, job_id: str) -> str:
+        return "in_progress"
+
+
+def test_bulk_scoring_refuses_a_running_job(tmp_path, monkeypatch):
+    retried = []
+    monkeypatch.setattr(batch, "_score_category", lambda essay, *args, **kwargs: retried.append(essay) or 1)
+    job = BulkScoringJob(ESSAYS, SCORE_SETTINGS, state_path=str(tmp_path / "job.json"), backend=RunningBackend())
+    job.submit()
+    assert job.poll() == "in_progress"
+
+    with pytest.raises(RuntimeError, match="still in_progress"):
+        job.results(fallback_interactive=True)
+    assert retried == []
+
+
+def test_bulk_scoring_logs_the_batch_price(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "_score_category", lambda *args, **kwargs: 0)
+    token_logger = TokenLogger()
+    job = BulkScoringJob(ESSAYS, SCORE_SETTINGS, state_path=str(tmp_path / "job.json"), backend=CountingBackend(), token_logger=token_logger)
+    job.run(poll_interval=0)
+
+    # 4 requests of 100 prompt and 10 completion tokens, half the interactive price
+    assert token_logger.get_total_cost() == pytest.approx(get_cost(batch.CRITERIA_MODEL, 400, 40) / 2)
+    assert all(log.batch for log in token_logger.logs)
@@ -0,0 +1,48 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import time
+
+from tensaku.utils import openai_utils
+from tensaku.utils.cache import InMemoryCache, LLMCache, SQLiteCache, make_cache_key
+from tensaku.utils.openai_utils import _cache_lookup, _cache_store
+
+
+def test_cache_key_is_order_independent():
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}], "temperature": 0, "seed": 42}
+    assert make_cache_key(request) == make_cache_key(dict(reversed(list(request.items()))))
+    assert make_cache_key(request) != make_cache_key({**request, "temperature": 0.1})
+
+
+def test_in_memory_cache_lru_and_ttl():
+    cache = InMemoryCache(max_size=2, ttl=0.1)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")  # evicts b, the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    time.sleep(0.15)
+    assert cache.get("a") is None
+
+
+def test_sqlite_cache_persists(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    SQLiteCache(path).set("key", "value")
+    llm_cache = LLMCache(SQLiteCache(path))
+    assert llm_cache.get("key") == "value"
+    assert llm_cache.get("missing") is None
+    assert llm_cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_only_deterministic_requests_are_cached(monkeypatch):
+    monkeypatch.setattr(openai_utils, "llm_cache", LLMCache())
+    request = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+    cache_key, _ = _cache_lookup(request)
+    _cache_store(cache_key, "output")
+    assert _cache_lookup(request)[1] == "output"
+
+    # a comment written at temperature 0.7 or several samples must be new every time
+    assert _cache_lookup({**request, "temperature": 0.7}) == (None, None)
+    assert _cache_lookup({**request, "n": 3}) == (None, None)
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from tensaku.src.edit_classifier import classifier
+from tensaku.src.edit_classifier.classifier import Classifier, MistakeType
+from tensaku.utils.openai_utils import ParsingError
+
+PAIRS = [
+    ("I looked a moovie.", "I watched a movie."),
+    ("It was fun.", "It was fun."),
+]
+
+
+def test_essay_output_is_parsed_per_sentence():
+    output = "1.\nlooked -> watched (Word Choice)\nmoovie -> movie (Spelling)\n2.\nNo mistakes"
+    mistakes = Classifier()._essay_output2mistakes(output, PAIRS)
+    assert [mistake.type for mistake in mistakes[0]] == [MistakeType.WORD_CHOICE, MistakeType.SPELLING]
+    assert mistakes[0][1].get_change_prompt() == "moovie -> movie"
+    assert mistakes[0][0].original_sentence == PAIRS[0][0]
+    assert mistakes[1] == []
+
+
+def test_essay_output_with_missing_numbers_fails():
+    with pytest.raises(ParsingError):
+        Classifier()._essay_output2mistakes("1.\nlooked -> watched (Word Choice)", PAIRS)
+
+
+def test_split_into_chunks_keeps_order_and_budget():
+    chunks = Classifier.split_into_chunks(PAIRS * 5, token_budget=30)
+    assert [pair for chunk in chunks for pair in chunk] == PAIRS * 5
+    assert len(chunks) > 1
+    assert Classifier.split_into_chunks(PAIRS * 5) == [PAIRS * 5]
+
+
+def test_unparsable_chunk_falls_back_to_one_request_per_sentence(monkeypatch):
+    pairs = [("I looked a movie.", "I watched a movie."), ("He go home.", "He went home.")]
+    outputs = iter(["not numbered", "looked -> watched (Word Choice)", "go -> went (Grammar)"])
+    monkeypatch.setattr(classifier, "create_chat", lambda **kwargs: next(outputs))
+    with pytest.warns(UserWarning, match="classified one by one"):
+        mistakes = Classifier().classify_chunk(pairs)
+    assert [[mistake.get_change_prompt() for mistake in sentence_mistakes] for sentence_mistakes in mistakes] == [
+        ["looked -> watched"], ["go -> went"]
+    ]
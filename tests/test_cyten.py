@@ -1,4 +1,11 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from tensaku.src.cyten import cyten
 from tensaku.src.cyten.cyten import *
+from tensaku.utils import openai_utils
+from tensaku.utils.cache import LLMCache
 
 
 def test_cyten():
@@ -50,3 +57,188 @@ def test_cyten():
     print(score_essay(essay, score_settings))
     short_essay="hey"
     print(score_essay(short_essay, score_settings))
+
+
+def test_parse_combined_scores():
+    from tensaku.src.cyten.cyten import _parse_combined_scores
+
+    score_settings = ScoreSettings(
+        score_categories={
+            Category.content: ScoreCategorySettings(points_allocated=4, criteria=[]),
+            Category.vocabulary: ScoreCategorySettings(points_allocated=3, criteria=[]),
+            Category.grammar: ScoreCategorySettings(points_allocated=3, criteria=[]),
+        }
+    )
+    content = json.dumps({
+        "content": {"reason": "ok", "score": 3},
+        "vocabulary": {"reason": "ok", "score": "2"},
+        "grammar": {"reason": "out of range", "score": 5},
+    })
+    # grammar is left out and scored on its own
+    assert _parse_combined_scores(content, score_settings) == {Category.content: 3, Category.vocabulary: 2}
+    assert _parse_combined_scores("not json", score_settings) == {}
+
+
+def test_parse_score_distribution():
+    import math
+    from types import SimpleNamespace
+    from tensaku.src.cyten.cyten import _parse_score_distribution
+
+    top_logprobs = [
+        SimpleNamespace(token=token, logprob=math.log(probability))
+        for token, probability in [("2", 0.5), ("3", 0.25), (" 2", 0.1), ("5", 0.1), ("The", 0.05)]
+    ]
+    choice = SimpleNamespace(
+        message=SimpleNamespace(content="2"),
+        logprobs=SimpleNamespace(content=[SimpleNamespace(token="2", logprob=math.log(0.5), top_logprobs=top_logprobs)]),
+    )
+    # "5" is out of range and "The" is not a score, the rest is normalized
+    distribution = _parse_score_distribution(choice, 3, with_reason=False)
+    assert distribution.score == 2
+    assert math.isclose(distribution.probabilities[2], 0.6 / 0.85)
+    assert math.isclose(distribution.expected_score, (2 * 0.6 + 3 * 0.25) / 0.85)
+    assert math.isclose(distribution.confidence, 0.6 / 0.85)
+
+    # without logprobs the output is taken as certain
+    choice = SimpleNamespace(message=SimpleNamespace(content="1\n理由"), logprobs=None)
+    distribution = _parse_score_distribution(choice, 3, with_reason=True)
+    assert (distribution.score, distribution.confidence, distribution.reason) == (1, 1.0, "理由")
+
+
+def test_aggregate_samples():
+    from tensaku.src.cyten.cyten import _parse_sampled_scores
+
+    majority = aggregate_samples([3, 1, 3, 2, 3])
+    assert (majority.score, majority.agreement) == (3, 0.6)
+    # a tie goes to the score closest to the median
+    assert aggregate_samples([0, 0, 2, 3, 3, 2]).score == 2
+    assert aggregate_samples([0, 1, 3, 3], SampleAggregation.median).score == 1
+
+    contents = [json.dumps({"reason": "", "score": 2}), "not json", json.dumps({"reason": "", "score": 7})]
+    assert _parse_sampled_scores(contents, 3) == [2]
+
+
+def test_parse_packed_scores():
+    from tensaku.src.cyten.cyten import _parse_packed_scores
+
+    content = json.dumps({"scores": [
+        {"essay": 1, "reason": "", "score": 2},
+        {"essay": 3, "reason": "", "score": 9},
+        {"essay": 4, "reason": "", "score": 1},
+        {"essay": 4, "reason": "", "score": 0},
+        {"essay": 5, "reason": "", "score": 3},
+    ]})
+    # 2 is missing, 3 is out of range and 4 is duplicated, they are retried on their own
+    assert _parse_packed_scores(content, 5, 3) == [2, None, None, None, 3]
+    assert _parse_packed_scores("{}", 2, 3) == [None, None]
+
+
+def test_compile_score_settings():
+    score_settings = ScoreSettings(
+        topic="Do you like summer?",
+        words_count=WordsCountSettings(min=3, subtractions=[SubtractionWithWordsMoreThan(key=0, words_more_than=2, subtract_points=1)]),
+        score_categories={
+            Category.content: ScoreCategorySettings(points_allocated=2, criteria=[Criteria(point=2, content="b"), Criteria(point=0, content="a")]),
+        },
+    )
+    compiled = compile_score_settings(score_settings)
+    # settings with the same content share the compiled settings
+    assert compile_score_settings(score_settings.model_copy(deep=True)) is compiled
+    assert compile_score_settings(compiled) is compiled
+
+    # the rubric comes first and the essay last, so the prompts of the rubric share their prefix
+    first = compiled.criteria_prompt(Category.content, "I like summer.")
+    second = compiled.criteria_prompt(Category.content, "Summer is too hot.")
+    assert first.endswith("I like summer.\n") and second.endswith("Summer is too hot.\n")
+    assert first[: -len("I like summer.\n")] == second[: -len("Summer is too hot.\n")]
+    assert first.index("0点: a") < first.index("2点: b") < first.index("I like summer.")
+    assert compiled.words_penalty("I like summer.") == -1
+
+
+def test_vision_preflight():
+    from tensaku.src.cyten.cyten import _vision_preflight
+
+    score_settings = compile_score_settings(ScoreSettings(
+        topic="Which do you want to use for a day trip?",
+        words_count=WordsCountSettings(
+            min=10, max=30, additional_info='最初の"I want to enjoy a day trip by + 交通機関"は語数に含めない。',
+        ),
+        score_categories={
+            Category.content: ScoreCategorySettings(points_allocated=2, criteria=[Criteria(point=0, content="a"), Criteria(point=2, content="b")]),
+        },
+    ))
+    opening = "I want to enjoy a day trip by train. "
+    # the words of the opening and the one word filled in after them are removed
+    assert score_settings.strip_excluded_opening(opening + "It is fast.") == "It is fast."
+    assert score_settings.strip_excluded_opening("By train, I want to enjoy a day trip.") is None
+
+    # the opening is not counted: 5 words are clearly too few
+    rejected, _ = _vision_preflight(opening + "It is fast and fun.", score_settings, 0.2)
+    assert rejected == {"message": "too few words", "scores": {"content": 0, "total": 0}}
+    # a long first sentence is counted after the opening: 18 words are clearly within the limits
+    long_first_sentence = "I want to enjoy a day trip by train because " + " ".join(["word"] * 17) + "."
+    assert _vision_preflight(long_first_sentence, score_settings, 0.2) == (None, True)
+    assert _vision_preflight("", score_settings, 0.2)[0]["message"] == "too few words"
+    # without the exact opening the count is left to the vision model
+    assert _vision_preflight("I like trains. It is fast and fun.", score_settings, 0.2) == (None, False)
+    assert _vision_preflight(opening + " ".join(["word"] * 40), score_settings, 0.2)[0]["message"] == "too many words"
+    # close to the limits or garbled, the vision model counts the words
+    assert _vision_preflight(opening + " ".join(["word"] * 11), score_settings, 0.2) == (None, False)
+    assert _vision_preflight(opening + "%$ ## 12 3 -- ~~ a", score_settings, 0.2) == (None, False)
+
+
+def test_score_essays_without_categories():
+    score_settings = ScoreSettings(topic="t", words_count=WordsCountSettings(min=2, subtractions=[]), score_categories={})
+    for mode in (ScoringMode.concurrent, ScoringMode.packed):
+        results = dict(score_essays(["Hi", "I like summer.", "I like summer."], score_settings, mode=mode))
+        assert results[0]["message"] == "too few words"
+        assert results[1] == results[2] == {"message": "success", "scores": {"words_penalty": 0, "total": 0}}
+
+
+def test_score_essays_sequential_sends_one_request_at_a_time(monkeypatch):
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def score_category(*args, **kwargs):
+        with lock:
+            running.append(1)
+            most_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        return 1
+
+    monkeypatch.setattr(cyten, "_score_category", score_category)
+    category = ScoreCategorySettings(points_allocated=1, criteria=[Criteria(point=0, content="a"), Criteria(point=1, content="b")])
+    score_settings = ScoreSettings(
+        topic="t",
+        words_count=WordsCountSettings(min=1, subtractions=[]),
+        score_categories={Category.content: category, Category.grammar: category},
+    )
+    results = dict(score_essays(["I like summer.", "I like winter."], score_settings, max_concurrency=8, mode=ScoringMode.sequential))
+    assert len(results) == 2
+    assert len(most_running) == 4
+    assert max(most_running) == 1
+
+
+def test_score_essay_with_vision_is_answered_from_the_response_cache(tmp_path, monkeypatch):
+    requests = []
+    content = "content:\n  reason: good\n  score: 2\nfixed_essay: I like summer.\ncomments: good"
+
+    def chat_completion(token_logger=None, **request):
+        requests.append(request)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    monkeypatch.setattr(cyten, "_chat_completion", chat_completion)
+    monkeypatch.setattr(openai_utils, "llm_cache", LLMCache())
+    scan = tmp_path / "scan.png"
+    scan.write_bytes(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32)
+    category = ScoreCategorySettings(points_allocated=2, criteria=[Criteria(point=0, content="a"), Criteria(point=2, content="b")])
+    score_settings = ScoreSettings(topic="t", score_categories={Category.content: category})
+
+    image_settings = ImageSettings(preprocess=False)
+    first = score_essay_with_vision("I like summer.", str(scan), score_settings, image_settings=image_settings)
+    second = score_essay_with_vision("I like summer.", str(scan), score_settings, image_settings=image_settings)
+    assert first == second and first["scores"]["content"] == 2
+    assert len(requests) == 1
@@ -0,0 +1,23 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from tensaku.src.explanation_generator.general import GeneralGenerator, EXPLANATION_TOKENS
+
+
+def test_parse_batch_returns_none_for_missing_items():
+    result = "[1]\nfeels ではなく feel です。\n\n[3]\nthere に to は不要です。\n[2]\n"
+    assert GeneralGenerator._parse_batch(result, 3) == ["feels ではなく feel です。", None, "there に to は不要です。"]
+
+
+def test_batch_messages_are_numbered():
+    mistakes = [("I feels happy.", "I feel happy.", "feels -> feel"), ("I go to there.", "I go there.", "to there -> there")]
+    content = GeneralGenerator()._batch_messages(mistakes)[-1]["content"]
+    assert content.startswith("[1]\nOriginal: I feels happy.")
+    assert "[2]\nOriginal: I go to there.\nEdited: I go there.\nto there -> there" in content
+
+
+def test_split_into_batches_by_token_budget():
+    mistakes = [("I feels happy.", "I feel happy.", "feels -> feel")] * 7
+    batches = GeneralGenerator.split_into_batches(mistakes, token_budget=3 * EXPLANATION_TOKENS + 100)
+    assert [len(batch) for batch in batches] == [3, 3, 1]
@@ -1,11 +1,21 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
 from tensaku.tensaku_generator import TensakuGenerator
+from tensaku.src.correction_generator.correction import CorrectionGenerator
+from tensaku.src.edit_classifier.classifier import ChangeReplace, Mistake, MistakeType
+from tensaku.src.essay import Essay
+from tensaku.utils import openai_utils
 import json
 import importlib
 from dataclasses import asdict
 from dotenv import dotenv_values
+from types import SimpleNamespace
 import openai
+import threading
 import time
-import os
+import warnings
 
 def test_generator():
     tensaku = TensakuGenerator()
@@ -46,3 +56,53 @@ def test_generator():
     result_dicionatry = asdict(all_tensaku_document_azure)
     result_json_string = json.dumps(result_dictionary)
     print(result_json_string)
+
+
+class _CountingClient():
+    # fake OpenAI client that counts the requests in flight
+    def __init__(self, content: str) -> None:
+        self.content = content
+        self.in_flight = 0
+        self.peak = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(with_raw_response=self))
+
+    def create(self, **request):
+        with self.lock:
+            self.in_flight += 1
+            self.requests += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        message = SimpleNamespace(content=self.content)
+        result = SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+        return SimpleNamespace(headers={}, parse=lambda: result)
+
+
+def test_generate_batch_keeps_the_quiz_requests_within_max_concurrency(monkeypatch):
+    original = Essay([f"I speaked to him {number} times." for number in range(6)])
+    corrected = Essay([f"I spoke to him {number} times." for number in range(6)])
+    mistakes = [
+        [Mistake(before, after, MistakeType.Grammar, ChangeReplace(f"speaked{number}", "spoke"))]
+        for number, (before, after) in enumerate(zip(original.sentences, corrected.sentences))
+    ]
+    monkeypatch.setattr(CorrectionGenerator, "generate", lambda self, essay_text, token_logger=None: (original, corrected))
+    monkeypatch.setattr(TensakuGenerator, "_generate_mistakes", lambda self, *args: mistakes)
+    monkeypatch.setattr(TensakuGenerator, "_generate_sentence_explanation_documents", lambda self, *args, **kwargs: [])
+    client = _CountingClient("1. Yes\n2. Yes\n3. Yes")
+    monkeypatch.setattr(openai_utils, "client", client)
+
+    tensaku = TensakuGenerator()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        documents = list(tensaku.generate_batch(
+            ["essay"] * 4, generate_quiz=True, generate_comment=False,
+            generate_native_example=False, generate_native_explanation=False, max_concurrency=2,
+        ))
+
+    assert len(documents) == 4
+    # the check and the quiz batches of every essay (2 + 2 each) are sent
+    assert client.requests >= 16
+    assert client.peak <= 2
@@ -0,0 +1,61 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import base64
+import io
+
+import pytest
+
+from tensaku.src.cyten import image
+from tensaku.src.cyten.image import ImageSettings, detect_image_format, encode_image_url, preprocess_image
+from tensaku.utils.cache import InMemoryCache
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+
+def test_detect_image_format():
+    assert detect_image_format(PNG) == "image/png"
+    assert detect_image_format(b"\xff\xd8\xff\xe0rest") == "image/jpeg"
+    assert detect_image_format(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert detect_image_format(b"%PDF-1.7") is None
+
+
+def test_encode_image_url_is_cached_by_content(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(image, "preprocess_image", lambda data, settings: calls.append(data) or (data, "image/png"))
+    cache = InMemoryCache()
+    first, second = tmp_path / "first.png", tmp_path / "second.png"
+    first.write_bytes(PNG)
+    second.write_bytes(PNG)
+
+    url = encode_image_url(str(first), cache=cache)
+    assert url == "data:image/png;base64," + base64.b64encode(PNG).decode("utf-8")
+    # the same scan under another name is not encoded again
+    assert encode_image_url(str(second), cache=cache) == url
+    assert len(calls) == 1
+    # other settings are another entry
+    encode_image_url(str(first), ImageSettings(grayscale=False), cache=cache)
+    assert len(calls) == 2
+
+
+def test_preprocess_image_warns_without_pillow(monkeypatch):
+    monkeypatch.setattr(image, "Image", None)
+    with pytest.warns(UserWarning, match="Pillow is not installed"):
+        assert preprocess_image(PNG) == (PNG, "image/png")
+
+
+def test_preprocess_image_crops_and_scales_down():
+    Image = pytest.importorskip("PIL.Image")
+    ImageDraw = pytest.importorskip("PIL.ImageDraw")
+    scan = Image.new("RGB", (3000, 4000), "white")
+    ImageDraw.Draw(scan).rectangle((500, 1000, 2500, 3000), fill="black")
+    data = io.BytesIO()
+    scan.save(data, format="PNG")
+
+    processed, mime_type = preprocess_image(data.getvalue())
+    result = Image.open(io.BytesIO(processed))
+    assert mime_type == "image/jpeg" and result.mode == "L"
+    # cropped to the text (a square with the padding) and its short side scaled down to 768
+    assert result.size == (768, 768)
+    assert len(processed) < len(data.getvalue())
@@ -0,0 +1,53 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from tensaku.src.documents import MistakeExplanationDocument
+from tensaku.src.explanation_generator.knowledge_base import ExplanationKnowledgeBase, normalize_change
+
+
+def test_normalize_change_keeps_the_words():
+    assert normalize_change("Because  -> because of.") == normalize_change("because -> Because of")
+    assert normalize_change("feels -> feel") != normalize_change("feel -> feels")
+
+
+def test_hits_misses_and_usage_counts():
+    knowledge_base = ExplanationKnowledgeBase(":memory:")
+    key = knowledge_base.make_key("speaked -> spoke", "Grammar", "GeneralGenerator", True)
+    assert knowledge_base.get(key) is None
+
+    document = MistakeExplanationDocument("Grammar", "speak の過去形は spoke です。", True)
+    knowledge_base.set(key, document)
+    assert knowledge_base.get(knowledge_base.make_key("Speaked -> spoke", "Grammar", "GeneralGenerator", True)) == document
+    assert knowledge_base.get(knowledge_base.make_key("speaked -> spoke", "Spelling", "GeneralGenerator", True)) is None
+    assert knowledge_base.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3, "entries": 1}
+
+
+def test_long_changes_are_not_stored():
+    knowledge_base = ExplanationKnowledgeBase(":memory:", max_change_words=2)
+    assert knowledge_base.make_key("went for a walk -> walked", "Unnatural Expression", "GeneralGenerator", True) is None
+
+
+def test_least_used_entries_are_evicted():
+    knowledge_base = ExplanationKnowledgeBase(":memory:", max_entries=2)
+    keys = [knowledge_base.make_key(f"word{index} -> word", "Grammar", "GeneralGenerator", True) for index in range(3)]
+    knowledge_base.set(keys[0], MistakeExplanationDocument("Grammar", "0", True))
+    knowledge_base.set(keys[1], MistakeExplanationDocument("Grammar", "1", True))
+    knowledge_base.get(keys[0])
+    knowledge_base.set(keys[2], MistakeExplanationDocument("Grammar", "2", True))
+    assert len(knowledge_base) == 2
+    assert knowledge_base.get(keys[1]) is None
+    assert knowledge_base.get(keys[0]) is not None
+
+
+def test_a_full_store_keeps_the_new_entry():
+    knowledge_base = ExplanationKnowledgeBase(":memory:", max_entries=2)
+    keys = [knowledge_base.make_key(f"word{index} -> word", "Grammar", "GeneralGenerator", True) for index in range(4)]
+    for index, key in enumerate(keys):
+        knowledge_base.set(key, MistakeExplanationDocument("Grammar", str(index), True))
+        # the stored entries are used more than a new one
+        knowledge_base.get(key)
+        knowledge_base.get(key)
+    assert len(knowledge_base) == 2
+    assert knowledge_base.get(keys[3]).explanation == "3"
+    assert knowledge_base.get(keys[2]).explanation == "2"
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import time
+from contextvars import ContextVar
+
+import pytest
+
+from tensaku.utils.pipeline import Pipeline, PipelineStopped, Stage
+
+
+def test_pipeline_runs_independent_stages_in_parallel():
+    def slow(value):
+        def function(**kwargs):
+            time.sleep(0.2)
+            return value
+        return function
+
+    pipeline = Pipeline([
+        Stage("a", slow(1)),
+        Stage("b", slow(2)),
+        Stage("c", lambda a, b: a + b, ["a", "b"]),
+    ])
+    start = time.time()
+    results = pipeline.run()
+
+    assert results == {"a": 1, "b": 2, "c": 3}
+    assert time.time() - start < 0.35
+    assert pipeline.timings["c"].start >= max(pipeline.timings["a"].end, pipeline.timings["b"].end)
+
+
+def test_pipeline_arun():
+    async def double(a):
+        await asyncio.sleep(0.01)
+        return a * 2
+
+    pipeline = Pipeline([Stage("a", lambda: 2), Stage("b", double, ["a"])])
+    assert asyncio.run(pipeline.arun()) == {"a": 2, "b": 4}
+    assert set(pipeline.timings) == {"a", "b"}
+
+
+def test_pipeline_reports_finished_stages_in_order():
+    finished = []
+    pipeline = Pipeline([
+        Stage("a", lambda: 1),
+        Stage("b", lambda a: a + 1, ["a"]),
+        Stage("c", lambda b: b + 1, ["b"]),
+    ])
+    pipeline.run(on_stage_done=lambda name, output: finished.append((name, output)))
+    assert finished == [("a", 1), ("b", 2), ("c", 3)]
+
+
+def test_pipeline_stages_keep_the_callers_context():
+    variable = ContextVar("variable", default=None)
+    variable.set("caller")
+    pipeline = Pipeline([Stage("a", lambda: variable.get())])
+    assert pipeline.run() == {"a": "caller"}
+
+
+def test_pipeline_starts_no_stages_after_stop():
+    stop = threading.Event()
+
+    def first():
+        stop.set()
+        return 1
+
+    ran = []
+    pipeline = Pipeline([Stage("a", first), Stage("b", lambda a: ran.append(a), ["a"])])
+    with pytest.raises(PipelineStopped):
+        pipeline.run(stop=stop)
+    assert pipeline.results == {"a": 1}
+    assert ran == []
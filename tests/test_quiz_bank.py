@@ -0,0 +1,78 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import pytest
+
+from tensaku.src.documents import FreeAnswerQuizDocument, MultipleChoiceQuizDocument
+from tensaku.src.quiz_generator import QuizBank, QuizGenerator
+
+BECAUSE = {"original": "I was late because the rain.", "edited": "I was late because of the rain.", "change": "because -> because of"}
+SPEAKED = {"original": "I speaked to him.", "edited": "I spoke to him.", "change": "speaked -> spoke"}
+
+QUIZ_OUTPUT = """4
+Aim: because and because of.
+Type: multiple-choice
+Title: because と because of の用法
+Choices: 1 because, 2 because of
+Questions:
+1. He failed [1 because] he didn't study.
+2. They won [2 because of] their teamwork.
+---
+5
+Aim: irregular past tense.
+Type: fill-in-the-blank
+Title: 不規則動詞の過去形
+Questions:
+1. I [spoke] to her. (speak)
+2. She [went] home. (go)"""
+
+
+def test_lookup_of_new_stored_and_rejected_patterns():
+    quiz_bank = QuizBank(":memory:")
+    assert quiz_bank.lookup(BECAUSE) is None
+
+    quiz = FreeAnswerQuizDocument("不規則動詞の過去形", ["I ____ to her. (speak)"], ["spoke"])
+    quiz_bank.add(SPEAKED, quiz)
+    stored = quiz_bank.lookup(dict(SPEAKED, change="Speaked -> spoke"))
+    assert [(stored_quiz.title, stored_quiz.answers) for stored_quiz in stored] == [(quiz.title, quiz.answers)]
+    assert stored[0].quiz_id != quiz.quiz_id
+    assert quiz_bank.find_by_title("不規則動詞の過去形")[0].questions == quiz.questions
+
+    quiz_bank.mark_without_quiz(BECAUSE)
+    assert quiz_bank.lookup(BECAUSE) == []
+    assert quiz_bank.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "quizzes": 1}
+
+
+def test_quizzes_are_banked_by_their_number():
+    quiz_bank = QuizBank(":memory:")
+    generator = QuizGenerator(quiz_bank=quiz_bank)
+    generator._bank_quizzes([BECAUSE, SPEAKED], QUIZ_OUTPUT)
+
+    banked_quizzes, new_mistakes = generator._banked_quizzes([SPEAKED, BECAUSE, SPEAKED])
+    assert new_mistakes == []
+    assert [type(quiz) for quiz in banked_quizzes] == [FreeAnswerQuizDocument, MultipleChoiceQuizDocument]
+    assert banked_quizzes[1].answers == ["because", "because of"]
+
+
+def test_most_frequent_patterns_without_quizzes():
+    quiz_bank = QuizBank(":memory:")
+    quiz_bank.observe([BECAUSE, SPEAKED, SPEAKED])
+    assert quiz_bank.most_frequent_patterns(1) == [SPEAKED]
+    quiz_bank.add(SPEAKED, FreeAnswerQuizDocument("不規則動詞の過去形", [], []))
+    assert quiz_bank.most_frequent_patterns(5) == [BECAUSE]
+
+
+def test_prefill_keeps_the_patterns_of_failed_batches(monkeypatch):
+    quiz_bank = QuizBank(":memory:")
+    quiz_bank.observe([BECAUSE, SPEAKED])
+    generator = QuizGenerator(quiz_bank=quiz_bank, eligibility="single_pass")
+
+    def timeout(mistakes, token_logger=None):
+        raise TimeoutError("timeout")
+
+    monkeypatch.setattr(generator, "quizzes_from_small_batch_of_mistakes", timeout)
+    with pytest.warns(UserWarning):
+        assert generator.prefill_bank(5) == 0
+    assert quiz_bank.lookup(BECAUSE) is None
+    assert len(quiz_bank.most_frequent_patterns(5)) == 2
@@ -0,0 +1,66 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import pytest
+
+from tensaku.src.quiz_generator import QuizBank, QuizEligibility, QuizGenerator
+
+MISTAKES = [
+    {"original": "That's amazing!", "edited": "That's incredible!", "change": "amazing -> incredible"},
+    {"original": "I speaked to him.", "edited": "I spoke to him.", "change": "speaked -> spoke"},
+    {"original": "He speaked slowly.", "edited": "He spoke slowly.", "change": "speaked -> spoke"},
+]
+
+SINGLE_PASS_OUTPUT = """4
+SKIP
+---
+5
+Aim: irregular past tense.
+Type: fill-in-the-blank
+Title: 不規則動詞の過去形
+Questions:
+1. I [spoke] to her. (speak)"""
+
+
+def test_identical_changes_are_deduplicated():
+    assert QuizGenerator._unique_mistakes(MISTAKES) == MISTAKES[:2]
+
+
+def test_constrained_check_answer_is_parsed():
+    assert QuizGenerator._parse_constrained_check("NY", 2) == [False, True]
+    assert QuizGenerator._parse_constrained_check("1. N 2. Y", 2) == [False, True]
+    with pytest.warns(UserWarning, match="full check"):
+        assert QuizGenerator._parse_constrained_check("Yes", 2) is None
+    with pytest.warns(UserWarning, match="full check"):
+        assert QuizGenerator._parse_constrained_check("NYN", 2) is None
+
+
+def test_constrained_check_uses_a_small_request():
+    generator = QuizGenerator(eligibility=QuizEligibility.CONSTRAINED)
+    assert generator._constrained_check_gpt_config(3).max_tokens == 6
+    messages = generator._constrained_check_messages(MISTAKES[:2])
+    assert generator.constrained_check_instruction in messages[0]["content"]
+    assert "speaked -> spoke" in messages[-1]["content"]
+
+
+def test_single_pass_skips_and_banks_ineligible_mistakes():
+    quiz_bank = QuizBank(":memory:")
+    generator = QuizGenerator(quiz_bank=quiz_bank, eligibility="single_pass")
+    assert generator._eligible_mistakes(MISTAKES) == MISTAKES
+    assert generator.single_pass_instruction in [message["content"] for message in generator._quiz_messages(MISTAKES[:2])]
+
+    quizzes = generator._quiz_result_to_list(SINGLE_PASS_OUTPUT, [])
+    assert [quiz.title for quiz in quizzes] == ["不規則動詞の過去形"]
+
+    quiz_bank.observe(MISTAKES[:2])
+    generator._bank_quizzes(MISTAKES[:2], SINGLE_PASS_OUTPUT)
+    assert quiz_bank.lookup(MISTAKES[0]) == []
+    assert [quiz.answers for quiz in quiz_bank.lookup(MISTAKES[1])] == [["spoke"]]
+
+
+def test_failed_batches_are_skipped_with_a_warning():
+    with pytest.warns(UserWarning, match="creating quizzes"):
+        assert QuizGenerator._skip_failed_quizzes(MISTAKES[:2], RuntimeError("timeout")) == []
+    with pytest.warns(UserWarning, match="checking if quiz should be created"):
+        assert QuizGenerator._skip_failed_check(MISTAKES[:2], RuntimeError("timeout")) == [False, False]
@@ -0,0 +1,48 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tensaku.utils.rate_limit import RateLimiter, estimate_request_tokens, parse_reset_time, retry_after_seconds
+
+
+def test_parse_headers():
+    assert parse_reset_time("6m0s") == 360
+    assert parse_reset_time("20ms") == 0.02
+    assert parse_reset_time("1.5") == 1.5
+    assert retry_after_seconds({"retry-after": "3"}) == 3
+    assert retry_after_seconds({"retry-after-ms": "250"}) == 0.25
+    assert retry_after_seconds({}) is None
+
+
+def test_estimate_request_tokens_counts_max_tokens():
+    request = {"messages": [{"role": "user", "content": "a" * 400}], "max_tokens": 100}
+    assert 200 <= estimate_request_tokens(request) <= 210
+
+
+def test_rate_limiter_holds_back_requests_over_budget():
+    # 600 requests per minute = 10 per second, the bucket starts full.
+    limiter = RateLimiter(requests_per_minute=600)
+    limiter.requests.available = 2
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda _: limiter.acquire(), range(4)))
+    assert time.monotonic() - start >= 0.15
+
+
+def test_rate_limiter_adapts_to_headers():
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=60000)
+    limiter.update_from_headers({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "1s"})
+    assert limiter.tokens.wait_time(100) > 0
+    limiter.update_from_headers({"retry-after": "2"})
+    assert limiter.blocked_until - time.monotonic() > 1.5
+
+
+def test_openai_clients_leave_retries_to_the_rate_limiter():
+    # a 429 retried inside the SDK would never pause the shared rate limiter
+    from tensaku.utils import openai_utils
+
+    assert openai_utils.client.max_retries == 0
+    assert openai_utils.async_client.max_retries == 0
@@ -0,0 +1,55 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from tensaku.src.edit_classifier.classifier import Classifier, MistakeType
+from tensaku.src.edit_classifier.spelling import edit_distance, is_known_word, is_spelling_fix
+
+
+def test_inflections_of_the_word_list_are_known():
+    for word in ["running", "stopped", "visiting", "making", "studied", "happier", "children", "went", "Tokyo"]:
+        assert is_known_word(word)
+    assert not is_known_word("swiming")
+
+
+def test_edit_distance_counts_transpositions_as_one_edit():
+    assert edit_distance("recieve", "receive") == 1
+    assert edit_distance("tommorow", "tomorrow") == 2
+    assert edit_distance("cat", "elephant", max_distance=2) == 3
+
+
+def test_only_confident_spelling_fixes_are_detected():
+    assert is_spelling_fix("moovie", "movie")
+    assert is_spelling_fix("becuase", "because")
+    assert not is_spelling_fix("then", "than")  # a real word, it may be a word choice mistake
+    assert not is_spelling_fix("goed", "went")  # wrong inflection, a grammar mistake
+    assert not is_spelling_fix("i", "I")
+    assert not is_spelling_fix("alot", "a lot")
+
+
+def test_real_words_are_not_spelling_fixes():
+    # real words replaced by similar real words are word choice or grammar mistakes
+    for before, after in [("fell", "feel"), ("affect", "effect"), ("sow", "saw"), ("dairy", "diary"), ("principle", "principal")]:
+        assert not is_spelling_fix(before, after), before
+    mistakes, needs_gpt = Classifier(detect_spelling_locally=True).classify_locally("I fell happy.", "I feel happy.")
+    assert (mistakes, needs_gpt) == ([], True)
+
+
+def test_spelling_only_sentences_are_classified_locally():
+    mistakes, needs_gpt = Classifier(detect_spelling_locally=True).classify_locally("I like swiming.", "I like swimming.")
+    assert not needs_gpt
+    assert [(mistake.type, mistake.get_change_prompt()) for mistake in mistakes] == [(MistakeType.SPELLING, "swiming -> swimming")]
+    assert Classifier(detect_spelling_locally=True).classify("I like swiming.", "I like swimming.") == mistakes
+
+    mistakes, needs_gpt = Classifier(detect_spelling_locally=True).classify_locally("I looked a moovie.", "I watched a movie.")
+    assert needs_gpt
+    assert [mistake.get_change_prompt() for mistake in mistakes] == ["moovie -> movie"]
+    assert Classifier().classify_locally("I like swiming.", "I like swimming.") == ([], True)
+
+
+def test_gpt_mistakes_are_merged_without_duplicates():
+    original, corrected = "I looked a moovie.", "I watched a movie."
+    local_mistakes, _ = Classifier(detect_spelling_locally=True).classify_locally(original, corrected)
+    gpt_mistakes = Classifier()._gptoutput2mistakes("looked -> watched (Word Choice)\nmoovie -> movie (Spelling)", original, corrected)
+    mistakes = Classifier._merge_local(local_mistakes, gpt_mistakes)
+    assert [mistake.get_change_prompt() for mistake in mistakes] == ["looked -> watched", "moovie -> movie"]
@@ -0,0 +1,38 @@
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from tensaku.utils.openai_utils import TokenLogger, get_cost
+from tensaku.utils.pipeline import current_stage
+
+
+def test_cost_is_per_thousand_tokens():
+    assert get_cost("gpt-4-1106-preview", 1000, 1000) == 0.01 + 0.03
+
+
+def test_token_logger_summary_by_stage_and_model():
+    token_logger = TokenLogger()
+    token = current_stage.set("correction")
+    try:
+        token_logger.log(1000, 0, "gpt-4-1106-preview", latency=1.0)
+    finally:
+        current_stage.reset(token)
+    token_logger.log(0, 1000, "gpt-4-1106-preview", latency=3.0, retries=1, stage="comment")
+    token_logger.log(0, 0, "gpt-4-1106-preview", cache_hit=True, stage="comment")
+
+    summary = token_logger.summary()
+    assert summary["total"]["calls"] == 3
+    assert summary["total"]["retries"] == 1
+    assert abs(token_logger.get_total_cost() - 0.04) < 1e-9
+    assert summary["by_stage"]["correction"]["prompt_tokens"] == 1000
+    assert summary["by_stage"]["comment"]["cache_hits"] == 1
+    assert summary["by_model"]["gpt-4-1106-preview"]["calls"] == 3
+
+
+def test_token_logger_keeps_a_bounded_log():
+    token_logger = TokenLogger(max_logs=2)
+    for _ in range(5):
+        token_logger.log(10, 10, "gpt-4")
+    assert len(token_logger.logs) == 2
+    assert token_logger.summary()["total"]["calls"] == 5
+    assert TokenLogger().logs is not token_logger.logs
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from tensaku.utils.utils import iterate_sections, aiterate_sections, parallel_map, aparallel_map, run_function_in_small_batches
+
+
+def test_iterate_sections_yields_each_section_when_complete():
+    seen = []
+
+    def deltas():
+        for delta in ["4\nAim: a\n--", "-\n5\nAim", ": b\n---", "\n6"]:
+            seen.append(delta)
+            yield delta
+
+    sections = iterate_sections(deltas(), "---")
+    assert next(sections) == "4\nAim: a\n"
+    assert len(seen) == 2  # the first section is ready before the rest of the stream arrives
+    assert list(sections) == ["\n5\nAim: b\n", "\n6"]
+
+
+def test_aiterate_sections_with_lookahead_separator():
+    async def deltas():
+        for delta in ["intro\n# a\n- x\n", "\n#", " b\n- y\n"]:
+            yield delta
+
+    async def collect():
+        return [section async for section in aiterate_sections(deltas(), r"\n(?=# )")]
+
+    assert asyncio.run(collect()) == ["intro", "# a\n- x\n", "# b\n- y\n"]
+
+
+def test_parallel_map_keeps_order_and_isolates_errors():
+    def slow_square(item):
+        time.sleep(0.05 * (5 - item))
+        if item == 3:
+            raise ValueError("broken item")
+        return item * item
+
+    start = time.time()
+    outputs = parallel_map(slow_square, range(5), max_workers=5, on_error=lambda item, error: None)
+    assert outputs == [0, 1, 4, None, 16]
+    assert time.time() - start < 0.5  # one by one it takes 0.75 seconds
+
+    with pytest.raises(ValueError):
+        parallel_map(slow_square, range(5), max_workers=5)
+
+
+def test_parallel_map_bounds_concurrency():
+    running, max_running, lock = [0], [0], threading.Lock()
+
+    def call(item):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return item
+
+    assert parallel_map(call, range(10), max_workers=3) == list(range(10))
+    assert max_running[0] <= 3
+    assert run_function_in_small_batches(lambda batch: [sum(batch)], list(range(10)), batch_size=4, max_workers=3) == [6, 22, 17]
+
+
+def test_aparallel_map_bounds_concurrency_and_isolates_errors():
+    running, max_running = [0], [0]
+
+    async def call(item):
+        running[0] += 1
+        max_running[0] = max(max_running[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        if item == 2:
+            raise ValueError("broken item")
+        return item
+
+    outputs = asyncio.run(aparallel_map(call, range(6), max_concurrency=2, on_error=lambda item, error: -1))
+    assert outputs == [0, 1, -1, 3, 4, 5]
+    assert max_running[0] == 2